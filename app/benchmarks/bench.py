@@ -0,0 +1,371 @@
+"""
+Benchmarks of the metadata, tile, upload, and request paths, and of the
+startup of workers.
+
+    python3 -m benchmarks.bench --output results.json
+    python3 -m benchmarks.bench --quick --baseline results.json
+
+Synthetic GeoTIFFs of several sizes, data types, band counts, and coordinate
+systems are generated in --workdir (and reused on later runs). Redis is
+replaced by fakeredis, so no services are needed. Every benchmark reports
+p50/p95 latency, operations per second (tiles per second for tiles), and
+the peak RSS of the process while it ran.
+
+Results are written as JSON with --output. With --baseline, the p50 of
+every benchmark is compared to that of an earlier run, and the command
+exits with status 1 when any of them got slower by more than --threshold
+percent.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+from .data import make_raster, raster_name
+
+# (width, height, dtype, bands, epsg) of the synthetic rasters
+DATASETS = [
+    (1024, 1024, 'uint8', 1, 4326),
+    (2048, 2048, 'int16', 1, 32631),
+    (2048, 2048, 'float32', 1, 3857),
+    (2048, 2048, 'uint8', 3, 4326),
+    (8192, 8192, 'float32', 1, 32631)
+]
+QUICK_DATASETS = DATASETS[:4]
+
+FORMATS = ['png', 'jpeg', 'utfgrid']
+MODES = ['linear', 'discrete']
+
+# Tile sizes besides 256 (as served for @2x URLs), benchmarked with PNG only
+LARGE_TILES = [512]
+
+# Upload sizes in megabytes
+UPLOADS = [16, 128]
+QUICK_UPLOADS = [16]
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of the process (Linux only), so it can be measured
+    for each benchmark separately.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """
+    Return the peak RSS of the process in kilobytes.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, q):
+    values = sorted(values)
+    index = (len(values) - 1) * q / 100.0
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+
+def measure(name, fn, items, warmup=1, unit='ops', count=lambda item: 1):
+    """
+    Call `fn` for every item and return the statistics of the durations.
+    The first `warmup` items are called before measuring as well.
+    """
+    for item in items[:warmup]:
+        fn(item)
+
+    reset_peak_rss()
+    durations = []
+    operations = 0
+    for item in items:
+        start = time.perf_counter()
+        fn(item)
+        durations.append(time.perf_counter() - start)
+        operations += count(item)
+
+    return summarize(name, durations, operations, unit, peak_rss())
+
+
+def summarize(name, durations, operations, unit, peak_rss_kb):
+    """
+    Print and return the statistics of the durations of a benchmark.
+    """
+    total = sum(durations)
+    result = {
+        'name':name,
+        'n':len(durations),
+        'p50_ms':percentile(durations, 50) * 1000,
+        'p95_ms':percentile(durations, 95) * 1000,
+        'mean_ms':total / len(durations) * 1000,
+        'unit':unit,
+        'per_sec':operations / total if total else 0.0,
+        'peak_rss_kb':peak_rss_kb
+    }
+    print("{name:<50} {p50_ms:>10.2f} {p95_ms:>10.2f} {per_sec:>10.1f} {unit:<8} {peak_rss_kb:>10}".format(**result))
+    return result
+
+
+def setup(workdir):
+    """
+    Configure and import the application with its data directory in
+    `workdir` and fakeredis in place of Redis.
+    """
+    import fakeredis
+
+    os.environ['MAPDROP_DATA'] = os.path.join(workdir, 'data')
+    os.environ.setdefault('MAPDROP_TILE_CACHE', 'memory')
+    os.environ.setdefault('MAPDROP_METRICS', 'none')
+    # Queued jobs are left in (fake) Redis, so ingesting uploads does not
+    # run in the background of the benchmarks.
+    os.environ['MAPDROP_JOBS'] = 'redis'
+
+    from mapdrop import app, redis_store
+    redis_store._redis_client = fakeredis.FakeStrictRedis()
+    return app
+
+
+def ingest(path):
+    from mapdrop.mapdropfile.jobs import run_job, TASKS
+    job = run_job({'path':path, 'tasks':TASKS})
+    if job['state'] != 'ready':
+        raise Exception("Ingesting {} failed: {}".format(path, job['error']))
+
+
+def tiles_of(mf, count=32):
+    """
+    Return up to `count` tiles at the zoom level where the raster is a few
+    tiles wide, in metatile order.
+    """
+    import mercantile
+    west, south, east, north = mf.ds.bounds
+    z = 0
+    while z < 20 and len(list(mercantile.tiles(west, south, east, north, z))) < count:
+        z += 1
+    tiles = sorted(mercantile.tiles(west, south, east, north, z), key=lambda t: (t.x // 4, t.y // 4, t.x, t.y))
+    return tiles[:count]
+
+
+def bench_metadata(paths, repeat):
+    from mapdrop.mapdropfile import MapdropFile
+    results = []
+    for path in paths:
+        mf = MapdropFile(path)
+        results.append(measure('metadata {}'.format(path), lambda n: mf.ds.get_metadata(), list(range(repeat)), warmup=0))
+    return results
+
+
+def bench_tiles(paths, count):
+    from mapdrop.mapdropfile import MapdropFile
+    from mapdrop.mapdropfile.cache import tile_cache
+
+    results = []
+    for path in paths:
+        mf = MapdropFile(path)
+        tiles = tiles_of(mf, count)
+        modes = ['rgb'] if len(mf.metadata['layers']) == 3 else MODES
+        for format in FORMATS:
+            for mode in modes:
+                def render(tile):
+                    mf.ds.tile(tile.z, tile.x, tile.y, format=format, request_args={'mode':mode})
+                # Start every run with an empty cache, so tiles are
+                # rendered (and metatiles shared) as on a fresh server.
+                if hasattr(tile_cache, 'entries'):
+                    tile_cache.entries.clear()
+                    tile_cache.bytes = 0
+                results.append(measure('tile {} {} {}'.format(path, format, mode), render, tiles, warmup=0, unit='tiles'))
+        for size in LARGE_TILES:
+            def render(tile):
+                mf.ds.tile(tile.z, tile.x, tile.y, format='png', width=size, height=size, request_args={'mode':modes[0]})
+            if hasattr(tile_cache, 'entries'):
+                tile_cache.entries.clear()
+                tile_cache.bytes = 0
+            results.append(measure('tile {} png {} {}px'.format(path, modes[0], size), render, tiles, warmup=0, unit='tiles'))
+    return results
+
+
+def bench_uploads(app, sizes):
+    client = app.test_client()
+    results = []
+    for size in sizes:
+        body = os.urandom(1024 * 1024) * size
+
+        def upload(n):
+            path = '/bench-upload-{}.bin'.format(n)
+            response = client.put(path, data=body)
+            if response.status_code != 200:
+                raise Exception("Upload failed: {}".format(response.data))
+            client.delete(path)
+
+        results.append(measure('upload {}MB'.format(size), upload, list(range(3)), warmup=0, unit='MB',
+                               count=lambda n: size))
+    return results
+
+
+def bench_requests(app, paths, count):
+    from mapdrop.mapdropfile import MapdropFile
+    from mapdrop.mapdropfile.cache import tile_cache
+
+    client = app.test_client()
+
+    def get(url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise Exception("Request to {} failed with {}".format(url, response.status_code))
+
+    results = [measure('request directory listing', get, ['/'] * 20)]
+    for path in paths:
+        tiles = tiles_of(MapdropFile(path), count)
+        urls = ['/{}~/tiles/{}/{}/{}.png'.format(path, tile.z, tile.x, tile.y) for tile in tiles]
+        results.append(measure('request metadata {}'.format(path), get, ['/{}~/metadata/metadata.json'.format(path)] * 20))
+        if hasattr(tile_cache, 'entries'):
+            tile_cache.entries.clear()
+            tile_cache.bytes = 0
+        results.append(measure('request tile {} uncached'.format(path), get, urls, warmup=0, unit='tiles'))
+        results.append(measure('request tile {} cached'.format(path), get, urls, warmup=0, unit='tiles'))
+    return results
+
+
+def bench_startup(workdir, path, repeat):
+    """
+    Time importing the application and the first tile of a fresh worker,
+    both for a worker that imports the application itself and for one that
+    is forked from a preloaded master (see benchmarks/startup.py). Every
+    run is a new interpreter.
+    """
+    from mapdrop import redis_store
+    from mapdrop.mapdropfile import MapdropFile
+
+    metadata = os.path.join(workdir, 'startup-metadata.json')
+    with open(metadata, 'w') as f:
+        json.dump({path:redis_store.get(path).decode()}, f)
+    tile = tiles_of(MapdropFile(path), 1)[0]
+    url = '/{}~/tiles/{}/{}/{}.png'.format(path, tile.z, tile.x, tile.y)
+
+    def run(preload):
+        command = [sys.executable, '-m', 'benchmarks.startup', workdir, metadata, url] + (['--preload'] if preload else [])
+        return json.loads(subprocess.check_output(command, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).decode())
+
+    cold = [run(False) for n in range(repeat)]
+    preloaded = [run(True) for n in range(repeat)]
+    return [
+        summarize('startup import', [r['import_s'] for r in cold], repeat, 'starts', max(r['peak_rss_kb'] for r in cold)),
+        summarize('startup first tile', [r['import_s'] + r['first_tile_s'] for r in cold], repeat, 'starts',
+                  max(r['peak_rss_kb'] for r in cold)),
+        summarize('startup first tile preloaded', [r['first_tile_s'] for r in preloaded], repeat, 'starts',
+                  max(r['peak_rss_kb'] for r in preloaded))
+    ]
+
+
+def environment():
+    from osgeo import gdal
+    import numpy
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time':time.time(),
+        'commit':commit,
+        'python':platform.python_version(),
+        'gdal':gdal.__version__,
+        'numpy':numpy.__version__,
+        'platform':platform.platform(),
+        'cpus':os.cpu_count()
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the change in p50 latency of every benchmark compared to a
+    baseline, and return the names of those that got slower by more than
+    `threshold` percent.
+    """
+    previous = {result['name']:result for result in baseline['results']}
+    regressions = []
+    print("\n{:<50} {:>10} {:>10} {:>8}".format('benchmark', 'base p50', 'p50', 'change'))
+    for result in results:
+        base = previous.get(result['name'])
+        if base is None:
+            continue
+        change = (result['p50_ms'] - base['p50_ms']) / base['p50_ms'] * 100 if base['p50_ms'] else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(result['name'])
+            flag = ' slower'
+        print("{:<50} {:>10.2f} {:>10.2f} {:>+7.1f}%{}".format(result['name'], base['p50_ms'], result['p50_ms'], change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Mapdrop benchmarks.")
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'mapdrop-bench'), help="directory for the generated files")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare the results to those in this JSON file")
+    parser.add_argument('--threshold', type=float, default=10.0, help="p50 change in percent that counts as a regression (default 10)")
+    parser.add_argument('--quick', action='store_true', help="skip the largest raster and upload")
+    parser.add_argument('--only', choices=['metadata', 'tiles', 'uploads', 'requests', 'startup'], action='append', help="only run these benchmarks")
+    parser.add_argument('--tiles', type=int, default=32, help="number of tiles per raster (default 32)")
+    parser.add_argument('--repeat', type=int, default=3, help="repetitions of the metadata benchmarks (default 3)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic data")
+    args = parser.parse_args()
+
+    datadir = os.path.join(args.workdir, 'data')
+    os.makedirs(datadir, exist_ok=True)
+    datasets = QUICK_DATASETS if args.quick else DATASETS
+    print(" * Generating {} rasters in {}".format(len(datasets), datadir))
+    for definition in datasets:
+        make_raster(datadir, *definition, seed=args.seed)
+    paths = [raster_name(*definition) for definition in datasets]
+
+    app = setup(args.workdir)
+    for path in paths:
+        ingest(path)
+
+    only = args.only or ['metadata', 'tiles', 'uploads', 'requests', 'startup']
+    print("\n{:<50} {:>10} {:>10} {:>10} {:<8} {:>10}".format('benchmark', 'p50 ms', 'p95 ms', 'per sec', 'unit', 'peak KB'))
+    results = []
+    if 'metadata' in only:
+        results += bench_metadata(paths, args.repeat)
+    if 'tiles' in only:
+        results += bench_tiles(paths, args.tiles)
+    if 'uploads' in only:
+        results += bench_uploads(app, QUICK_UPLOADS if args.quick else UPLOADS)
+    if 'requests' in only:
+        results += bench_requests(app, paths, args.tiles)
+    if 'startup' in only:
+        results += bench_startup(args.workdir, paths[0], args.repeat)
+
+    run = {'environment':environment(), 'options':vars(args), 'results':results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2)
+        print("\n * Results written to {}".format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\n * {} benchmarks are more than {:.0f}% slower than the baseline".format(len(regressions), args.threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Synthetic rasters for the benchmarks. Files are generated from a seed, so
+the same definition always results in the same file, and files that exist
+already are reused.
+"""
+import os
+
+import numpy as np
+
+from osgeo import gdal, osr
+
+# Top left corner and pixel size of the synthetic rasters, around the
+# Netherlands, for each of the supported coordinate systems
+ORIGINS = {
+    4326:(3.0, 54.0, 0.0005),
+    3857:(330000.0, 7180000.0, 50.0),
+    32631:(500000.0, 5980000.0, 30.0)
+}
+
+NODATA = {
+    'uint8':0,
+    'int16':-9999,
+    'float32':-9999.0
+}
+
+
+def raster_name(width, height, dtype, bands, epsg):
+    return 'bench-{}x{}-{}-{}b-{}.tif'.format(width, height, dtype, bands, epsg)
+
+
+def field(width, rows, row_offset, band, rng):
+    """
+    Return a smooth field with some noise, scaled to 0..1, for a strip of
+    rows of a raster.
+    """
+    x = np.linspace(0, 6 * np.pi, width)[None,:]
+    y = np.linspace(0, 6 * np.pi, rows)[:,None] + row_offset * 6 * np.pi / width
+    data = 0.5 + 0.25 * np.sin(x * (1 + band * 0.3)) * np.cos(y) + 0.1 * np.sin(x * 7 + y * 5)
+    data += rng.normal(0, 0.05, size=data.shape)
+    return np.clip(data, 0, 1)
+
+
+def make_raster(directory, width, height, dtype='float32', bands=1, epsg=4326, seed=0, strip=512):
+    """
+    Write a tiled GeoTIFF with the given size, data type, band count, and
+    coordinate system to `directory`, and return its filename. The top left
+    corner has no data. Rows are written in strips, so large rasters don't
+    need to fit in memory.
+    """
+    filename = os.path.join(directory, raster_name(width, height, dtype, bands, epsg))
+    if os.path.isfile(filename):
+        return filename
+
+    gdal_type = {'uint8':gdal.GDT_Byte, 'int16':gdal.GDT_Int16, 'float32':gdal.GDT_Float32}[dtype]
+    driver = gdal.GetDriverByName('GTiff')
+    tmpfilename = filename + '.tmp'
+    ds = driver.Create(tmpfilename, width, height, bands, gdal_type,
+                       options=['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256'])
+
+    x_min, y_max, size = ORIGINS[epsg]
+    ds.SetGeoTransform((x_min, size, 0, y_max, 0, -size))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    ds.SetProjection(srs.ExportToWkt())
+
+    scale = {'uint8':(1, 254), 'int16':(-500, 3000), 'float32':(-10.0, 40.0)}[dtype]
+    for b in range(1, bands + 1):
+        band = ds.GetRasterBand(b)
+        if bands == 1:
+            band.SetNoDataValue(NODATA[dtype])
+        rng = np.random.default_rng(seed + b)
+        for row in range(0, height, strip):
+            rows = min(strip, height - row)
+            data = scale[0] + field(width, rows, row, b, rng) * (scale[1] - scale[0])
+            if bands == 1 and row < height // 8:
+                data[:, :width // 8] = NODATA[dtype]
+            band.WriteArray(data.astype(dtype), 0, row)
+    ds = None
+    os.rename(tmpfilename, filename)
+    return filename
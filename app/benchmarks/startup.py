@@ -0,0 +1,94 @@
+"""
+A single worker startup, run in a fresh interpreter by the startup benchmark
+of benchmarks.bench:
+
+    python3 -m benchmarks.startup <workdir> <metadata.json> <tile url> [--preload]
+
+Times importing the application and requesting a first tile, and prints the
+results as JSON. The metadata of the file is loaded into fakeredis before
+the application is imported, as a running server would have it in Redis
+already. With --preload the application is imported and warmed up first,
+and the tile is requested from a forked process, as in a gunicorn worker
+forked from a preloaded master.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+
+def first_tile(app, url):
+    started = time.perf_counter()
+    response = app.test_client().get(url)
+    if response.status_code != 200:
+        raise Exception("Request to {} failed with {}".format(url, response.status_code))
+    return time.perf_counter() - started
+
+
+def peak_rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the startup of a worker.")
+    parser.add_argument('workdir')
+    parser.add_argument('metadata')
+    parser.add_argument('url')
+    parser.add_argument('--preload', action='store_true')
+    args = parser.parse_args()
+
+    os.environ['MAPDROP_DATA'] = os.path.join(args.workdir, 'data')
+    os.environ.setdefault('MAPDROP_TILE_CACHE', 'memory')
+    os.environ.setdefault('MAPDROP_METRICS', 'none')
+    os.environ['MAPDROP_JOBS'] = 'redis'
+
+    import fakeredis
+    client = fakeredis.FakeStrictRedis()
+    with open(args.metadata) as f:
+        for key, value in json.load(f).items():
+            client.set(key, value)
+
+    started = time.perf_counter()
+    from mapdrop import app, redis_store
+    redis_store._redis_client = client
+    result = {'import_s':time.perf_counter() - started}
+
+    if not args.preload:
+        result['first_tile_s'] = first_tile(app, args.url)
+        result['peak_rss_kb'] = peak_rss()
+        print(json.dumps(result))
+        return
+
+    from mapdrop.startup import warm, after_fork
+    started = time.perf_counter()
+    warm()
+    result['warm_s'] = time.perf_counter() - started
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # The forked worker never returns into the code of the master
+        try:
+            os.close(read)
+            after_fork()
+            result['first_tile_s'] = first_tile(app, args.url)
+            result['peak_rss_kb'] = peak_rss()
+            os.write(write, json.dumps(result).encode())
+        finally:
+            os._exit(0)
+
+    os.close(write)
+    with os.fdopen(read) as f:
+        output = f.read()
+    os.waitpid(pid, 0)
+    if not output:
+        sys.exit("The forked worker failed.")
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""
+Gunicorn configuration of Mapdrop.
+
+    gunicorn -c gunicorn.conf.py mapdrop:app
+
+Other settings (like --bind and --workers) are passed in GUNICORN_CMD_ARGS.
+
+With MAPDROP_PRELOAD=1 (the default) the application is imported and warmed
+up once in the master, and workers are forked from it, so they start
+handling requests right away and share the imported modules. Handles that
+can't be shared are reset in every worker after the fork.
+"""
+import os
+
+preload_app = os.environ.get('MAPDROP_PRELOAD', '1').lower() in ('1', 'true', 'yes')
+
+
+def when_ready(server):
+    if preload_app:
+        from mapdrop.startup import warm
+        warm()
+
+
+def post_fork(server, worker):
+    from mapdrop.startup import after_fork
+    after_fork()
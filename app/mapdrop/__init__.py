@@ -43,5 +43,8 @@ else:
 from mapdrop.blueprints.main import main
 app.register_blueprint(main)
 
+from mapdrop.blueprints.metrics import metrics
+app.register_blueprint(metrics)
+
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
@@ -1,15 +1,28 @@
+import io
 import os
 import re
+import csv
+import glob
 import json
+import math
+import uuid
+import mimetypes
 
-from slugify import slugify
-from flask import Blueprint, Response, render_template, abort, render_template_string, request, jsonify, redirect, url_for, current_app
-from shapely.geometry import mapping, shape
+import numpy as np
+
+from urllib.parse import quote
+from werkzeug.wsgi import wrap_file
+from flask import Blueprint, Response, render_template, request, jsonify, current_app, stream_with_context, send_file
 from functools import wraps
-from shapely.wkt import loads
 from mapdrop import redis_store
 
-from ...mapdropfile import MapdropFile
+from ...mapdropfile import MapdropFile, Mosaic, pool, series
+from ...mapdropfile.jobs import JobPending, JobFailed, enqueue, TASKS
+from ...mapdropfile.optimize import optimized_filename, remove_optimized
+from ...mapdropfile.cache import invalidate
+from ...mapdropfile.query import parse_stats
+from ...mapdropfile.directory import directory_index, summaries, discard_summary
+from .upload import UploadError, receive, receive_range, parse_digest
 
 main = Blueprint('main', __name__, template_folder='templates', url_prefix='/')
 
@@ -17,12 +30,13 @@ main = Blueprint('main', __name__, template_folder='templates', url_prefix='/')
 class APIException(Exception):
     status_code = 400
 
-    def __init__(self, message, status_code=None, payload=None):
+    def __init__(self, message, status_code=None, payload=None, headers=None):
         Exception.__init__(self)
         self.message = message
         if status_code is not None:
             self.status_code = status_code
         self.payload = payload
+        self.headers = headers or {}
 
     def to_dict(self):
         rv = dict(self.payload or ())
@@ -35,6 +49,30 @@ class APIException(Exception):
 def handle_api_error(error):
     response = jsonify(error.to_dict())
     response.status_code = error.status_code
+    response.headers.extend(error.headers)
+    return response
+
+@main.errorhandler(JobPending)
+def handle_job_pending(error):
+    """
+    Files that are still being processed are temporarily unavailable for
+    requests that need their metadata, and clients are asked to try again
+    in a moment. Raster tiles and the info page are served in the meantime
+    (see Dataset.allow_provisional).
+    """
+    response = jsonify({'message':str(error), 'status_code':503, 'job':error.job})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(current_app.config.get('MAPDROP_JOB_RETRY_AFTER'))
+    return response
+
+@main.errorhandler(JobFailed)
+def handle_job_failed(error):
+    """
+    Files whose ingest job failed can't be served until they are replaced.
+    The error of the job is in the response.
+    """
+    response = jsonify({'message':str(error), 'status_code':422, 'error':error.job.get('error'), 'job':error.job})
+    response.status_code = 422
     return response
 
 
@@ -57,13 +95,7 @@ def path_validate(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         path = kwargs.get("path", "")
-        print("args=")
-        print(args)
-
-
-        print("checking path {}".format(path))
         directory, filename = os.path.split(path)
-        print("directory={} filename={}".format(directory, filename))
 
         if filename == '':
             # Working with directory
@@ -88,7 +120,6 @@ def path_exists_or_404(f):
         path = kwargs.get("path", "")
         directory, filename = os.path.split(path)
         fullpath = os.path.join(current_app.config.get("MAPDROP_DATA"), directory, filename)
-        print(fullpath)
         kwargs.update({'fullpath':fullpath})
         if os.path.isfile(fullpath) or os.path.isdir(fullpath):
             return f(*args, **kwargs)
@@ -96,6 +127,61 @@ def path_exists_or_404(f):
             raise APIException("Path not found", status_code=404)
     return decorated_function
 
+def listing_options():
+    """
+    Return the (sort, reverse, page, per_page) options of a directory
+    listing request.
+    """
+    sort = request.args.get('sort', 'name')
+    if sort not in ('name', 'size', 'mtime'):
+        raise APIException("Unknown sort order.", status_code=400)
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise APIException("Order must be asc or desc.", status_code=400)
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = int(request.args.get('per_page', current_app.config.get('MAPDROP_DIRECTORY_PAGE_SIZE')))
+    except ValueError:
+        raise APIException("Invalid page.", status_code=400)
+    per_page = min(max(per_page, 1), current_app.config.get('MAPDROP_DIRECTORY_MAX_PAGE_SIZE'))
+    return (sort, order == 'desc', page, per_page)
+
+def listing_entry(path, entry):
+    """
+    Return an entry of a directory listing as it is sent in JSON listings.
+    """
+    if entry['type'] == 'dir':
+        return {'name':entry['name'], 'type':'dir', 'path':os.path.join(path, entry['name'])+'/',
+                'mtime':entry['mtime'], 'children':entry['children']}
+    return {'name':entry['name'], 'type':'file', 'path':os.path.join(path, entry['name']),
+            'mtime':entry['mtime'], 'size':entry['size'], 'summary':entry.get('summary')}
+
+def file_info(entry):
+    """
+    Return a short description of a file in a directory listing.
+    """
+    size = entry['size']
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    info = ["{:.0f} {}".format(size, unit) if unit == 'B' else "{:.1f} {}".format(size, unit)]
+    summary = entry.get('summary')
+    if summary is not None and summary['type'] == 'raster':
+        info.insert(0, "raster, {} band{}".format(summary['bands'], '' if summary['bands'] == 1 else 's'))
+    elif summary is not None and summary['type'] == 'vector':
+        info.insert(0, "vector, {} features".format(summary['features']))
+    return ", ".join(info)
+
+def directory_mosaic(path):
+    """
+    Return the Mosaic of the rasters in a directory.
+    """
+    mosaic = Mosaic(path)
+    if mosaic.index.metadata is None and not mosaic.index.pending:
+        raise APIException("Directory has no rasters to serve as a mosaic.", status_code=404)
+    return mosaic
+
 @main.route('/', methods=['GET'])
 @main.route('/<path:path>', methods=['GET'])
 @path_validate
@@ -117,46 +203,95 @@ def info(*args, **kwargs):
         path_components.append({'name':comp, 'path': path_item})
 
     if kwargs.get("filename") == '':
-        # Directory view
+        # Directory view, from the directory index
+        listing = directory_index.listing(path)
+        sort, reverse, page, per_page = listing_options()
+        num_items = len(listing)
+        num_pages = max(int(math.ceil(num_items / per_page)), 1)
+        entries = summaries(path, listing.page(page, per_page, sort=sort, reverse=reverse))
+
+        if request.args.get('format') == 'json':
+            return jsonify({
+                'path':path,
+                'total':num_items,
+                'page':page,
+                'per_page':per_page,
+                'pages':num_pages,
+                'sort':sort,
+                'order':'desc' if reverse else 'asc',
+                'entries':[listing_entry(path, entry) for entry in entries]
+            })
+
         contents = []
-        fullpath = os.path.join(current_app.config.get("MAPDROP_DATA"), path)
-        for item in os.listdir(fullpath):
-            item_localpath = os.path.join(path, item)
-            item_path = os.path.join(fullpath, item)
-            if os.path.isfile(item_path):
-                contents.append({'type':'file','name':item, 'info':'', 'path':item_localpath, 'icon':'far fa-map'})
-            if os.path.isdir(item_path):
-                info = "{}".format(len(os.listdir(os.path.join(fullpath, item))))
-                contents.append({'type':'dir','name':item+'/', 'info':info, 'path':item_localpath+'/', 'icon':'far fa-folder'})
-        num_items = len(contents)
+        for entry in entries:
+            item_localpath = os.path.join(path, entry['name'])
+            if entry['type'] == 'file':
+                contents.append({'type':'file', 'name':entry['name'], 'info':file_info(entry), 'path':item_localpath, 'icon':'far fa-map'})
+            else:
+                contents.append({'type':'dir', 'name':entry['name']+'/', 'info':"{}".format(entry['children']), 'path':item_localpath+'/', 'icon':'far fa-folder'})
+        order = 'desc' if reverse else 'asc'
         return render_template("main/directory.html", **locals())
     else:
-        # File view
+        # File view, which shows the state of the ingest job while the
+        # file is being processed, or when it could not be processed.
         path = kwargs.get("path")
         mf = MapdropFile(path)
+        mf.ds.allow_provisional = True
+        try:
+            metadata = mf.metadata
+            job = mf.ds.job
+        except (JobPending, JobFailed) as e:
+            metadata = None
+            job = e.job
         return render_template("main/info.html", **locals())
 
 # Views related to derived data from individial files (tiles, previews, etc) below
+def tile_size(scale):
+    """
+    Return the size in pixels of the tiles of a request: the `tilesize`
+    parameter (default 256) times the scale of @2x and @3x tile URLs.
+    """
+    try:
+        size = int(request.args.get('tilesize', 256)) * scale
+    except ValueError:
+        raise APIException("Invalid tile size.", status_code=400)
+    if size < 64 or size > current_app.config.get('MAPDROP_MAX_TILE_SIZE'):
+        raise APIException("Tile size must be between 64 and {} pixels.".format(current_app.config.get('MAPDROP_MAX_TILE_SIZE')), status_code=400)
+    return size
+
 @main.route('/<path:path>~/tiles/<int:z>/<int:x>/<int:y>.<string:format>', methods=['GET'])
+@main.route('/<path:path>~/tiles/<int:z>/<int:x>/<int:y>@<int:scale>x.<string:format>', methods=['GET'])
 @path_validate
 @path_exists_or_404
-def tile(path, z, x, y, format, **kwargs):
-    fullpath = os.path.join(current_app.config.get("MAPDROP_DATA"), path)
-    mf = MapdropFile(fullpath)
-    return mf.ds.tile(z, x, y, format=format, request_args=request.args)
+def tile(path, z, x, y, format, scale=1, **kwargs):
+    size = tile_size(scale)
+    if kwargs.get("filename") == '':
+        ds = directory_mosaic(path)
+    else:
+        ds = MapdropFile(path).ds
+        ds.allow_provisional = True
+    return ds.tile(z, x, y, format=format, width=size, height=size, request_args=request.args, if_none_match=request.if_none_match)
 
 @main.route('/<path:path>~/metadata/metadata.json', methods=['GET'])
 @path_validate
 @path_exists_or_404
 def metadata(path, **kwargs):
-    mf = MapdropFile(path)
-    return jsonify(mf.metadata)
+    try:
+        if kwargs.get("filename") == '':
+            return jsonify(directory_mosaic(path).metadata)
+        mf = MapdropFile(path)
+        return jsonify(mf.metadata)
+    except JobPending as e:
+        return jsonify({'job':e.job}), 202, {'Retry-After':str(current_app.config.get('MAPDROP_JOB_RETRY_AFTER'))}
 
 @main.route('/<path:path>~/metadata/extent.<string:format>', methods=['GET'])
 @path_validate
 @path_exists_or_404
 def metadata_extent(path, format, **kwargs):
     mf = MapdropFile(path)
+    mf.ds.allow_provisional = True
+    from shapely.wkt import loads
+    from shapely.geometry import mapping
     geom = loads(mf.metadata.get("extent"))
     if format == 'json':
         return jsonify(mapping(geom))
@@ -168,17 +303,354 @@ def metadata_extent(path, format, **kwargs):
 @path_exists_or_404
 def metadata_crs(path, format, **kwargs):
     mf = MapdropFile(path)
+    mf.ds.allow_provisional = True
     if format == 'wkt':
         return Response(mf.metadata.get("crs"), mimetype='text/plain')
 
 
+def request_geometries():
+    """
+    Return a list of (id, geometry) tuples for a query, either from the WKT
+    in the `geom` parameter, or from a GeoJSON FeatureCollection, Feature,
+    or geometry in the body of a POST request.
+    """
+    from shapely.wkt import loads
+    from shapely.geometry import shape
+    try:
+        if request.method == 'POST':
+            data = request.get_json(force=True)
+            if data.get('type') == 'FeatureCollection':
+                features = data.get('features', [])
+            elif data.get('type') == 'Feature':
+                features = [data]
+            else:
+                features = [{'geometry':data}]
+            return [(feature.get('id'), shape(feature['geometry'])) for feature in features]
+        else:
+            return [(None, loads(request.args['geom']))]
+    except Exception as e:
+        raise APIException("No valid geometry found in request.", status_code=400)
+
+def stream_results(results, ids):
+    """
+    Stream query results as newline delimited JSON.
+    """
+    for result in results:
+        result['id'] = ids[result['index']]
+        yield json.dumps(result) + '\n'
+
+@main.route('/<path:path>~/query/stats.<string:format>', methods=['GET','POST'])
+@path_validate
+@path_exists_or_404
+def query_stats(path, format, **kwargs):
+    """
+    Zonal statistics for one or more geometries. Results of large batches
+    (or with the .ndjson format) are streamed as newline delimited JSON.
+    """
+    if format not in ('json', 'ndjson'):
+        raise APIException("Unknown format.", status_code=400)
+
+    features = request_geometries()
+    ids = [id for (id, geom) in features]
+    try:
+        names = parse_stats(request.args.get('stats'))
+        band = int(request.args.get('band', 1))
+    except Exception as e:
+        raise APIException("Invalid query: {}".format(e), status_code=400)
+
+    mf = MapdropFile(path)
+    try:
+        results = mf.ds.zonal_stats([geom for (id, geom) in features], names,
+                                    crs=request.args.get('crs', 'EPSG:4326'),
+                                    band=band,
+                                    all_touched=request.args.get('all_touched', '').lower() in ('1', 'true'))
+    except Exception as e:
+        raise APIException("Invalid query: {}".format(e), status_code=400)
+
+    if format == 'ndjson' or len(features) > current_app.config.get('MAPDROP_QUERY_STREAM_THRESHOLD'):
+        return Response(stream_with_context(stream_results(results, ids)), mimetype='application/x-ndjson')
+
+    try:
+        results = sorted(results, key=lambda result: result['index'])
+    except Exception as e:
+        raise APIException("Invalid query: {}".format(e), status_code=400)
+    for result in results:
+        result['id'] = ids[result['index']]
+    return jsonify({'results':results})
+
+def request_points():
+    """
+    Return (ids, xs, ys) for a point query, either from a WKT point or
+    multipoint in the `geom` parameter, or from a GeoJSON FeatureCollection
+    of points, Feature, or geometry in the body of a POST request. GeoJSON
+    is read without building a geometry for every point, which matters
+    when sampling tens of thousands of them.
+    """
+    from shapely.wkt import loads
+    ids = []
+    coords = []
+    try:
+        if request.method == 'POST':
+            data = request.get_json(force=True)
+            if data.get('type') == 'FeatureCollection':
+                features = data.get('features', [])
+            elif data.get('type') == 'Feature':
+                features = [data]
+            else:
+                features = [{'geometry':data}]
+            for feature in features:
+                geometry = feature['geometry']
+                if geometry['type'] == 'Point':
+                    points = [geometry['coordinates']]
+                elif geometry['type'] == 'MultiPoint':
+                    points = geometry['coordinates']
+                else:
+                    raise Exception("Not a point geometry")
+                for point in points:
+                    ids.append(feature.get('id'))
+                    coords.append(point[:2])
+        else:
+            geom = loads(request.args['geom'])
+            for point in (geom.geoms if geom.geom_type == 'MultiPoint' else [geom]):
+                ids.append(None)
+                coords.append((point.x, point.y))
+        coords = np.array(coords, dtype=np.float64).reshape(-1, 2)
+    except Exception as e:
+        raise APIException("No valid points found in request.", status_code=400)
+
+    if len(coords) > current_app.config.get('MAPDROP_QUERY_MAX_POINTS'):
+        raise APIException("Too many points in request.", status_code=400)
+    return (ids, coords[:,0], coords[:,1])
+
+def sample_options():
+    try:
+        return {
+            'crs': request.args.get('crs', 'EPSG:4326'),
+            'band': int(request.args.get('band', 1)),
+            'interpolation': request.args.get('interpolation', 'nearest')
+        }
+    except Exception as e:
+        raise APIException("Invalid query: {}".format(e), status_code=400)
+
+def csv_line():
+    """
+    Return a function that formats a row as a line of CSV. Ids, filenames,
+    and errors can contain commas, quotes, and newlines, so rows are
+    written by the csv module into a buffer that is emptied for every row.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    def line(row):
+        writer.writerow(row)
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+    return line
+
+def sample_response(format, columns, ids=None):
+    """
+    Return sampled values as JSON, as a streamed CSV, or as a binary stream
+    of little endian doubles, one row of columns after the other. Values of
+    nodata pixels are null in JSON, empty in CSV, and NaN in binary output.
+    """
+    names = [name for (name, values) in columns]
+    if format == 'bin':
+        data = np.column_stack([values for (name, values) in columns]).astype('<f8')
+        return Response(data.tobytes(), mimetype='application/octet-stream', headers={'X-Columns':','.join(names)})
+
+    rows = zip(*[values.tolist() for (name, values) in columns])
+    if ids is not None:
+        names = ['id'] + names
+        rows = ((id,) + row for (id, row) in zip(ids, rows))
+
+    if format == 'json':
+        return jsonify({'results':[dict(zip(names, [None if isinstance(v, float) and math.isnan(v) else v for v in row])) for row in rows]})
+
+    if format == 'csv':
+        line = csv_line()
+
+        def lines():
+            yield line(names)
+            for row in rows:
+                yield line(['' if v is None or (isinstance(v, float) and math.isnan(v)) else v for v in row])
+        return Response(lines(), mimetype='text/csv')
+
+    raise APIException("Unknown format.", status_code=400)
+
+@main.route('/<path:path>~/query/sample.<string:format>', methods=['GET','POST'])
+@path_validate
+@path_exists_or_404
+def query_sample(path, format, **kwargs):
+    """
+    Values of a band at one or many points.
+    """
+    ids, xs, ys = request_points()
+    mf = MapdropFile(path)
+    try:
+        values = mf.ds.sample(xs, ys, **sample_options())
+    except Exception as e:
+        raise APIException("Invalid query: {}".format(e), status_code=400)
+    return sample_response(format, [('x', xs), ('y', ys), ('value', values)], ids=ids)
+
+@main.route('/<path:path>~/query/transect.<string:format>', methods=['GET'])
+@path_validate
+@path_exists_or_404
+def query_transect(path, format, **kwargs):
+    """
+    Values of a band at evenly spaced points along a line.
+    """
+    from shapely.wkt import loads
+    try:
+        line = loads(request.args['geom'])
+        points = int(request.args.get('points', 100))
+        if line.geom_type != 'LineString':
+            raise Exception("Not a linestring")
+    except Exception as e:
+        raise APIException("No valid line found in request.", status_code=400)
+    if points > current_app.config.get('MAPDROP_QUERY_MAX_POINTS'):
+        raise APIException("Too many points in request.", status_code=400)
+
+    mf = MapdropFile(path)
+    try:
+        distances, xs, ys, values = mf.ds.transect(line, points, **sample_options())
+    except Exception as e:
+        raise APIException("Invalid query: {}".format(e), status_code=400)
+    return sample_response(format, [('distance', distances), ('x', xs), ('y', ys), ('value', values)])
+
+@main.route('/<path:path>~/query/series.<string:format>', methods=['GET'])
+@path_validate
+@path_exists_or_404
+def query_series(path, format, **kwargs):
+    """
+    Values at points, or statistics within a geometry, for every raster in
+    a directory that matches the `glob` parameter and has a time between
+    `start` and `end`. Results are streamed in order of time.
+    """
+    import pyproj
+    from shapely.wkt import loads
+    if kwargs.get("filename") != '':
+        raise APIException("Series can only be queried on directories.", status_code=400)
+    if format not in ('ndjson', 'csv'):
+        raise APIException("Unknown format.", status_code=400)
+    try:
+        geom = loads(request.args['geom'])
+        start = series.parse_time(request.args['start']) if request.args.get('start') else None
+        end = series.parse_time(request.args['end']) if request.args.get('end') else None
+        options = {
+            'crs': request.args.get('crs', 'EPSG:4326'),
+            'band': int(request.args.get('band', 1)),
+            'interpolation': request.args.get('interpolation', 'nearest'),
+            'stats': parse_stats(request.args.get('stats')),
+            'all_touched': request.args.get('all_touched', '').lower() in ('1', 'true')
+        }
+        pyproj.CRS.from_user_input(options['crs'])
+    except Exception as e:
+        raise APIException("Invalid query: {}".format(e), status_code=400)
+
+    if geom.geom_type in ('Point', 'MultiPoint'):
+        kind = 'sample'
+        points = geom.geoms if geom.geom_type == 'MultiPoint' else [geom]
+        if len(points) > current_app.config.get('MAPDROP_QUERY_MAX_POINTS'):
+            raise APIException("Too many points in request.", status_code=400)
+        xs = np.array([point.x for point in points])
+        ys = np.array([point.y for point in points])
+        geoms = (xs, ys)
+    else:
+        kind = 'stats'
+        geoms = [geom]
+
+    files = series.series_files(path, pattern=request.args.get('glob', '*'), start=start, end=end, geom=geom, crs=options['crs'])
+    if len(files) > current_app.config.get('MAPDROP_SERIES_MAX_FILES'):
+        raise APIException("Too many files in series.", status_code=400)
+    results = series.query_series(current_app.config.get("MAPDROP_DATA"), path, files, kind, geoms, options,
+                                  workers=current_app.config.get('MAPDROP_SERIES_WORKERS'))
+
+    if format == 'ndjson':
+        return Response(stream_with_context(json.dumps(result) + '\n' for result in results), mimetype='application/x-ndjson')
+
+    def value(v):
+        return '' if v is None or (isinstance(v, float) and math.isnan(v)) else str(v)
+
+    line = csv_line()
+
+    def lines():
+        if kind == 'sample':
+            yield line(['name', 'time', 'x', 'y', 'value', 'error'])
+            for result in results:
+                values = result.get('values') or [None] * len(xs)
+                for x, y, v in zip(xs.tolist(), ys.tolist(), values):
+                    yield line([result['name'], result['time'], x, y, value(v), result.get('error', '')])
+        else:
+            yield line(['name', 'time'] + options['stats'] + ['error'])
+            for result in results:
+                stats = result.get('stats') or {}
+                yield line([result['name'], result['time']] + [value(stats.get(name)) for name in options['stats']] + [result.get('error', '')])
+    return Response(stream_with_context(lines()), mimetype='text/csv')
+
 @main.route('/<path:path>~/raw', methods=['GET'])
 @path_validate
 @path_exists_or_404
-def raw(path, **kwargs):
-    #mf = MapdropFile(kwargs.get("fullpath"))
-    #return jsonify(mf.ds.metadata)
-    return "RAW file"
+def raw(path, fullpath, **kwargs):
+    """
+    Download the original file, with support for range and conditional
+    requests. When MAPDROP_RAW_ACCEL_REDIRECT is set, the file is sent by
+    nginx instead, through an X-Accel-Redirect to that internal location.
+    A subset of a raster can be downloaded with the `bbox` parameter.
+    """
+    if not os.path.isfile(fullpath):
+        raise APIException("Only files can be downloaded.", status_code=400)
+    if 'bbox' in request.args:
+        return raw_subset(path, fullpath)
+
+    filename = os.path.basename(path)
+    accel_redirect = current_app.config.get('MAPDROP_RAW_ACCEL_REDIRECT')
+    if accel_redirect:
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = accel_redirect.rstrip('/') + '/' + quote(path)
+        response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+        return response
+
+    return send_file(fullpath, as_attachment=True, attachment_filename=filename, conditional=True)
+
+def raw_subset(path, fullpath):
+    """
+    Download the part of a raster within `bbox` (west,south,east,north in
+    `crs`) as a GeoTIFF. GDAL writes the subset to a temporary file, which
+    is unlinked right away and then streamed from its open handle, so it
+    is never held in memory and never left behind.
+    """
+    try:
+        bounds = [float(v) for v in request.args['bbox'].split(',')]
+        if len(bounds) != 4:
+            raise ValueError()
+    except ValueError:
+        raise APIException("Invalid bbox.", status_code=400)
+    format = request.args.get('format', 'cog')
+    if format not in ('cog', 'tif'):
+        raise APIException("Unknown format.", status_code=400)
+
+    mf = MapdropFile(path)
+    if not mf.is_raster:
+        raise APIException("Subsets can only be downloaded from rasters.", status_code=400)
+
+    directory, filename = os.path.split(fullpath)
+    tmpfilename = os.path.join(directory, '.{}.subset-{}.tif'.format(filename, uuid.uuid4().hex))
+    try:
+        mf.ds.subset(bounds, tmpfilename, crs=request.args.get('crs', 'EPSG:4326'), format=format)
+        f = open(tmpfilename, 'rb')
+    except Exception as e:
+        raise APIException("Could not create subset: {}".format(e), status_code=400)
+    finally:
+        if os.path.exists(tmpfilename):
+            os.remove(tmpfilename)
+
+    response = Response(wrap_file(request.environ, f, current_app.config.get('MAPDROP_UPLOAD_CHUNK_SIZE')),
+                        mimetype='image/tiff', direct_passthrough=True)
+    response.headers['Content-Length'] = str(os.fstat(f.fileno()).st_size)
+    response.headers['Content-Disposition'] = 'attachment; filename="{}.subset.tif"'.format(os.path.splitext(filename)[0])
+    return response
 
 @main.route('/<path:path>~/view', methods=['GET'])
 @path_validate
@@ -202,6 +674,11 @@ def catchall(*args, **kwargs):
 @main.route('/<path:path>', methods=['PUT','POST'])
 @path_validate
 def put(path, **kwargs):
+    """
+    Upload a file. The request body is streamed to disk and moved into
+    place once it has been received completely. Large files can be sent in
+    parts using Content-Range headers, see upload.receive_range().
+    """
     directory, filename = os.path.split(path)
     fullpath = os.path.join(current_app.config.get("MAPDROP_DATA"), directory, filename)
     fulldirectory = os.path.join(current_app.config.get("MAPDROP_DATA"), directory)
@@ -214,6 +691,48 @@ def put(path, **kwargs):
                 os.makedirs(fulldirectory)
             except: 
                 raise APIException("Could not create directory.", status_code=500)
-        with open(fullpath, 'wb') as f:
-            f.write(request.data)
-        return 'PUT {}'.format(path), 200
+
+        chunk_size = current_app.config.get('MAPDROP_UPLOAD_CHUNK_SIZE')
+        expected_digest = parse_digest(request.headers.get('Digest'))
+        try:
+            if 'Content-Range' in request.headers:
+                digest = receive_range(request.stream, fullpath, request.headers['Content-Range'], expected_digest=expected_digest, chunk_size=chunk_size, ttl=current_app.config.get('MAPDROP_UPLOAD_PARTIAL_TTL'))
+            else:
+                digest = receive(request.stream, fullpath, content_length=request.content_length, expected_digest=expected_digest, chunk_size=chunk_size)
+        except UploadError as e:
+            raise APIException(e.message, status_code=e.status_code, headers=e.headers)
+
+        # Only now that the file is complete can it be processed. The
+        # optimize parameter overrides MAPDROP_OPTIMIZE for this file.
+        tasks = [task for task in TASKS if task != 'optimize']
+        optimize = request.args.get('optimize')
+        if (optimize is None and 'optimize' in TASKS) or (optimize or '').lower() in ('1', 'true', 'yes', 'cog'):
+            tasks.insert(0, 'optimize')
+        redis_store.delete(path)
+        discard_summary(path)
+        invalidate(path)
+        enqueue(path, tasks=tasks)
+        return 'PUT {}'.format(path), 200, {'Digest':'sha-256={}'.format(digest)}
+
+@main.route('/<path:path>', methods=['DELETE'])
+@path_validate
+@path_exists_or_404
+def delete(path, fullpath, **kwargs):
+    if not os.path.isfile(fullpath):
+        raise APIException("Only files can be deleted.", status_code=400)
+
+    os.remove(fullpath)
+    if os.path.isfile(fullpath + '.ovr'):
+        os.remove(fullpath + '.ovr')
+    directory, filename = os.path.split(fullpath)
+    for index in glob.glob(os.path.join(directory, '.{}.*.rtree.npz'.format(glob.escape(filename)))):
+        os.remove(index)
+    pool.evict(optimized_filename(fullpath))
+    remove_optimized(fullpath)
+
+    # Drop the metadata and open handle, and invalidate cached tiles
+    redis_store.delete(path, path + '.job')
+    discard_summary(path)
+    invalidate(path)
+    pool.evict(fullpath)
+    return 'DELETE {}'.format(path), 200
@@ -0,0 +1,206 @@
+import os
+import re
+import time
+import uuid
+import fcntl
+import base64
+import hashlib
+
+
+class UploadError(Exception):
+    def __init__(self, message, status_code=400, headers=None):
+        Exception.__init__(self)
+        self.message = message
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def parse_content_range(value):
+    """
+    Parse a 'bytes start-end/total' or 'bytes */total' Content-Range header
+    into a (start, end, total) tuple. Start and end are None for the
+    latter, which is used to ask how much of an upload was received.
+    """
+    match = re.match(r'^bytes (?:(\d+)-(\d+)|\*)/(\d+)$', value.strip())
+    if not match:
+        raise UploadError("Invalid Content-Range header.", status_code=400)
+    start, end, total = match.groups()
+    if start is None:
+        return (None, None, int(total))
+    start, end, total = int(start), int(end), int(total)
+    if start > end or end >= total:
+        raise UploadError("Invalid Content-Range header.", status_code=416)
+    return (start, end, total)
+
+
+def parse_digest(value):
+    """
+    Return the base64 encoded sha-256 digest from a Digest header, or None.
+    """
+    for item in (value or '').split(','):
+        algorithm, _, digest = item.strip().partition('=')
+        if algorithm.lower() == 'sha-256':
+            return digest
+    return None
+
+
+def copy_stream(stream, f, chunk_size, checksum=None, limit=None):
+    """
+    Copy a request stream to a file in chunks, updating a checksum on the
+    way. Returns the number of bytes copied.
+    """
+    copied = 0
+    while limit is None or copied < limit:
+        size = chunk_size if limit is None else min(chunk_size, limit - copied)
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        f.write(chunk)
+        if checksum is not None:
+            checksum.update(chunk)
+        copied += len(chunk)
+    return copied
+
+
+def file_checksum(filename, chunk_size):
+    checksum = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum
+
+
+def commit(tmpfilename, fullpath, checksum, expected_digest=None):
+    """
+    Verify the checksum of a fully received file and atomically move it
+    into place. Returns the base64 encoded sha-256 digest.
+
+    The file is hard linked into place instead of renamed, which fails
+    instead of replacing a file that a concurrent upload put there first.
+    """
+    digest = base64.b64encode(checksum.digest()).decode()
+    if expected_digest is not None and expected_digest != digest:
+        os.remove(tmpfilename)
+        raise UploadError("Checksum of the uploaded file does not match the Digest header.", status_code=400)
+    try:
+        os.link(tmpfilename, fullpath)
+    except FileExistsError:
+        raise UploadError("File already exists. Delete old one first", status_code=409)
+    finally:
+        os.remove(tmpfilename)
+    return digest
+
+
+def receive(stream, fullpath, content_length=None, expected_digest=None, chunk_size=1048576):
+    """
+    Receive a complete upload. The body is streamed to a temporary file
+    next to `fullpath` while its checksum is calculated, and only renamed
+    into place once all of it has been received, so a dropped connection
+    never leaves a partial file behind.
+    """
+    directory, filename = os.path.split(fullpath)
+    tmpfilename = os.path.join(directory, '.{}.upload-{}'.format(filename, uuid.uuid4().hex))
+    checksum = hashlib.sha256()
+    try:
+        with open(tmpfilename, 'wb') as f:
+            received = copy_stream(stream, f, chunk_size, checksum=checksum)
+            f.flush()
+            os.fsync(f.fileno())
+    except:
+        if os.path.exists(tmpfilename):
+            os.remove(tmpfilename)
+        raise
+
+    if content_length is not None and received != content_length:
+        os.remove(tmpfilename)
+        raise UploadError("Upload incomplete, received {} of {} bytes.".format(received, content_length), status_code=400)
+
+    return commit(tmpfilename, fullpath, checksum, expected_digest=expected_digest)
+
+
+def received_range(received):
+    """
+    Return the Range header telling a client how many bytes of an upload
+    were received, which is no header at all for none.
+    """
+    return {'Range':'bytes=0-{}'.format(received - 1)} if received else {}
+
+
+def expire_uploads(directory, ttl):
+    """
+    Remove partial uploads (and temporary files of uploads that never
+    finished) in a directory that were not written to for `ttl` seconds.
+    """
+    if not ttl:
+        return
+    now = time.time()
+    for name in os.listdir(directory):
+        if not re.match(r'^\..+\.upload(?:-[0-9a-f]{32}|\.\d+)$', name):
+            continue
+        try:
+            if now - os.path.getmtime(os.path.join(directory, name)) > ttl:
+                os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+
+
+def receive_range(stream, fullpath, content_range, expected_digest=None, chunk_size=1048576, ttl=86400):
+    """
+    Receive one part of a resumable upload, sent with a Content-Range
+    header. Parts are appended to a partial file next to `fullpath`, and
+    must be sent in order. Returns the digest once the upload is complete,
+    or raises an UploadError with status 308 and a Range header telling the
+    client which bytes were received so far. A part that does not continue
+    where the previous one ended gets a 416 with the same Range header, so
+    the client can resume from there.
+
+    The total size is part of the name of the partial file, so parts of an
+    upload of another size never continue it. A part at byte 0 starts the
+    upload over. Partial files that were not written to for `ttl` seconds
+    are removed.
+    """
+    start, end, total = parse_content_range(content_range)
+    directory, filename = os.path.split(fullpath)
+    partfilename = os.path.join(directory, '.{}.upload.{}'.format(filename, total))
+    expire_uploads(directory, ttl)
+
+    if start is None:
+        # Status probes are answered without creating the partial file
+        received = os.path.getsize(partfilename) if os.path.exists(partfilename) else 0
+        raise UploadError("Upload incomplete.", status_code=308, headers=received_range(received))
+    if start != 0 and not os.path.exists(partfilename):
+        raise UploadError("Part does not continue at byte 0.", status_code=416)
+
+    with open(partfilename, 'ab') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise UploadError("Another part of this upload is being received.", status_code=409)
+
+        if start == 0:
+            # Start over, dropping what was received of this upload or of
+            # an upload of the same file with another size.
+            f.truncate(0)
+            f.seek(0)
+            pattern = r'^\.{}\.upload\.(\d+)$'.format(re.escape(filename))
+            for name in os.listdir(directory):
+                match = re.match(pattern, name)
+                if match and int(match.group(1)) != total:
+                    try: os.remove(os.path.join(directory, name))
+                    except OSError: pass
+
+        received = f.tell()
+        if start != received:
+            raise UploadError("Part does not continue at byte {}.".format(received), status_code=416, headers=received_range(received))
+
+        received += copy_stream(stream, f, chunk_size, limit=end - start + 1)
+        f.flush()
+        os.fsync(f.fileno())
+
+        if received < total:
+            raise UploadError("Upload incomplete.", status_code=308, headers=received_range(received))
+
+        # The checksum of a resumable upload can't be carried over between
+        # requests, so it is calculated over the complete file instead.
+        checksum = file_checksum(partfilename, chunk_size)
+        return commit(partfilename, fullpath, checksum, expected_digest=expected_digest)
@@ -0,0 +1 @@
+from .metrics import metrics
@@ -0,0 +1,52 @@
+import time
+
+from flask import Blueprint, Response, request, jsonify, current_app, g
+
+from ...mapdropfile import metrics as stages
+
+metrics = Blueprint('metrics', __name__)
+
+
+@metrics.before_app_request
+def start_timer():
+    g.started = time.perf_counter()
+    if stages.sampler is not None:
+        stages.sampler.begin()
+
+@metrics.after_app_request
+def server_timing(response):
+    """
+    Record the total time of the request, and report the time spent in
+    each stage in a Server-Timing header.
+    """
+    started = g.get('started')
+    if started is None:
+        return response
+    duration = time.perf_counter() - started
+    stages.record('total', duration)
+    if stages.sampler is not None:
+        stages.sampler.end(duration, request.full_path)
+
+    if current_app.config.get('MAPDROP_SERVER_TIMING'):
+        timings = g.get('timings', {})
+        response.headers['Server-Timing'] = ', '.join('{};dur={:.1f}'.format(stage, seconds * 1000) for (stage, seconds) in timings.items())
+    return response
+
+@metrics.route('/metrics', methods=['GET'])
+def prometheus():
+    """
+    Latency histograms and cache counters in the Prometheus text format.
+    """
+    if stages.metrics is None:
+        return Response("Metrics are disabled.\n", status=404, mimetype='text/plain')
+    return Response(stages.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@metrics.route('/metrics/profiles', methods=['GET'])
+def profiles():
+    """
+    Sampled stacks of the slowest requests, when MAPDROP_PROFILE_SLOWEST
+    is set.
+    """
+    if stages.sampler is None:
+        return jsonify({'profiles':[]})
+    return jsonify({'profiles':stages.sampler.profiles()})
@@ -1,5 +1,5 @@
 import os
-import base64
+import math
 
 import json
 import time
@@ -8,208 +8,193 @@ import numpy as np
 import numpy.ma as ma
 
 import mercantile 
-import matplotlib.cm as mpcm
-
-import itertools
 
 from osgeo import ogr, osr, gdal, gdal_array
-from PIL import Image, ImageFont, ImageDraw
-from io import BytesIO
-
-from shapely.ops import transform
-from shapely.geometry import box,Polygon,mapping
-from shapely.wkt import loads
-
-import pyproj
 
 from flask import Response
 from functools import partial
-from datetime import datetime
-
-from epsg_ident import EpsgIdent
-
-from mapdrop import redis_store
-
-from colour import Color
-
-import matplotlib
-
-from matplotlib.colors import LinearSegmentedColormap, ListedColormap
-
-
-class Colormap(object):
-    """
-    Class that translates between our set of "mode", "ranges", and 
-    "colormap" variables and the corresponding matplotlib color mapping.
-    """
-
-    def __init__(self, colormap='', ranges='', mode='', stats=None):
-        self.stats = stats
-
-        self.parse_mode(mode)
-        self.parse_colormap(colormap)
-        self.parse_ranges(ranges)
-
-    def __repr__(self):
-        return "<Colormap mode={} ranges={} colormap={}>".format(self.mode, self.ranges, self.colormap)
 
-    def parse_mode(self, mode):
-        if mode in ('discrete','linear','exact','rgb'):
-            self.mode = mode
-        else:
-            raise Exception("Invalid mode")
-
-    def parse_colormap(self, colormap):
-        self.cmap = None
-        self.colormap = colormap
+# shapely, pyproj, and epsg_ident take a good part of a second to import
+# together, and most requests (like tiles of ingested files) never need
+# them, so they are imported in the methods that use them.
+
+from mapdrop import app, redis_store
+
+from .pool import DatasetPool
+from .colormap import Colormap
+from .stats import band_stats
+from .overviews import existing_factors, overview_factors
+from .cache import tile_cache, tile_key, generation, metadata_cache
+from .singleflight import SingleFlight, coalesce
+from . import query
+from . import utfgrid
+from . import mvt
+from . import encode
+from .rtree import PackedRTree, IndexCache
+from .jobs import JobPending, JobFailed, ingest
+from .directory import store_summary
+from .metrics import timed, count
+from .optimize import open_optimized
+from .buffers import TileBuffers
+from .mosaic import mosaic_index
+
+# Open dataset handles are shared between requests handled by the same
+# worker process, so a file is opened once per worker instead of once for
+# every tile.
+pool = DatasetPool(max_handles=app.config.get('MAPDROP_POOL_MAX_HANDLES', 64),
+                   max_bytes=app.config.get('MAPDROP_POOL_MAX_BYTES', 0))
+
+# Concurrent renders of the same metatile within a worker share one render
+metatile_flight = SingleFlight()
+
+# Concurrent requests for metadata that is not in Redis yet within a
+# worker share one fetch or build
+metadata_flight = SingleFlight()
+
+# Encoded empty tiles, shared by all tiles outside the extent of a file
+empty_tiles = {}
+
+# Buffers that each thread reads tile data into
+tile_buffers = TileBuffers(max_bytes=app.config.get('MAPDROP_TILE_BUFFER_MAX_BYTES', 67108864))
+
+# Spatial indexes of vector layers that were loaded by this worker
+indexes = IndexCache()
 
-        # Try to parse colormap as a matplotlib named colormap
-        try:
-            self.cmap = matplotlib.cm.get_cmap(colormap)
-            return
-        except:
-            self.cmap = None
 
-        # Apparently something else was passed. Only option is 
-        # a list of individual colors. Lets parse that then.
-        try:
-            colorlist = []
-            for c in colormap.split(","):
-                colorlist.append(Color(c).rgb)
-
-            if self.mode == 'exact':
-                print('creating ListedColormap with colorlist:')
-                print(colorlist)
-                self.cmap = ListedColormap(colorlist, 'custom')
-                return
-            else:
-                print('creating LinearSegmentedColormap with colorlist:')
-                print(colorlist)
-                if len(colorlist) < 2:
-                    raise Exception("Need at least two colors in colormap.")
-                else:
-                    self.cmap = LinearSegmentedColormap.from_list('custom', colorlist, N=256)
-                    return
-        except:
-            self.cmap = None
-
-        # If all else fails, fall back to 'Spectral'
-        self.cmap = matplotlib.cm.get_cmap('Spectral')
-        return
-
-    def parse_ranges(self, ranges):
-        #TODO: check if stats are tehre
-        self.ranges = []
-        for r in ranges.split(","):
-            print("r={}".format(r))
-            if r == 'avg':
-                self.ranges.append(self.stats.get("avg"))
-            elif r == 'min':
-                self.ranges.append(self.stats.get("min"))
-            elif r == 'max':
-                self.ranges.append(self.stats.get("max"))
-            else:
-                try:
-                    self.ranges.append(float(r))
-                except:
-                    pass
+class Dataset(object):
+    def __init__(self, path, signature=None):
+        self.path = path
+        self.signature = signature
+        self._metadata = None
+        self._version = None
+        # Set allow_provisional to get provisional metadata instead of a
+        # JobPending while the file is being ingested, see metadata.
+        self.allow_provisional = False
+        self.provisional = False
+        self.job = None
 
-    def rgba(self, array):
+    @property
+    def version(self):
         """
-        Apply the settings to an array
+        Version token of the file, which changes whenever the file is
+        replaced on disk, uploaded, or deleted.
         """
-        data = array
-        if self.mode != 'rgb':
-            data = array[:,:,0]
-
-        if self.mode == 'discrete':
-            print("discrete mode with ranges: {}".format(self.ranges))
-            norm = matplotlib.colors.BoundaryNorm(boundaries=self.ranges, ncolors=256)
-            sm = matplotlib.cm.ScalarMappable(norm=norm, cmap=self.cmap)
-            rgba = sm.to_rgba(data, bytes=True)
-
-        elif self.mode == 'linear':
-            print("linear mode normalized between {} and {}".format(self.ranges[0],self.ranges[-1]))
-            norm = matplotlib.colors.Normalize(self.ranges[0],self.ranges[-1])
-
-            sm = matplotlib.cm.ScalarMappable(norm=norm, cmap=self.cmap)
-            rgba = sm.to_rgba(data, bytes=True)            
-
-        elif self.mode == 'exact':
-            print("exact mode. mapping ranges {} to colors {}".format(self.ranges, self.colormap))
-            norm = matplotlib.colors.NoNorm()
-
-            sm = matplotlib.cm.ScalarMappable(norm=norm, cmap=self.cmap)
+        if self._version is None:
+            self._version = [self.signature, generation(self.path)]
+        return self._version
 
-            # Copy and mask the entire array.
-            reclassed = data.copy()
-            reclassed.mask = True
-
-            # For each category, assign values 1..n to the reclass mask
-            for n,r in enumerate(self.ranges):
-                ix = data == r
-                reclassed[ix] = n
-                reclassed.mask[ix] = False
+    @property
+    def metadata(self):
+        """
+        Return the metadata of the file, from the in-process cache or from
+        Redis. Metadata is created by ingest jobs, so this raises JobPending
+        while the job of the file has not finished yet, and queues a job for
+        files that need one (see jobs.ingest()). When the job failed this
+        raises JobFailed, until the file is replaced.
+
+        With `allow_provisional`, files that are still being ingested get
+        metadata that is read from the file right away instead, without
+        anything that takes long to create (like band statistics), and
+        `provisional` is set.
+        """
+        path = self.path
 
-            rgba = sm.to_rgba(reclassed, bytes=True)
+        if self._metadata is not None:
+            return self._metadata
 
-        elif self.mode == 'rgb':
-            sm = matplotlib.cm.ScalarMappable()
-            rgba = sm.to_rgba(data, bytes=True)  
+        metadata = metadata_cache.get(path, self.signature)
+        count('metadata', metadata is not None)
+        if metadata is None:
+            with timed('metadata'):
+                metadata = metadata_flight.do(path, self.fetch_metadata)
+            if metadata is None:
+                job = ingest(path, self.signature)
+                if job['state'] == 'failed':
+                    raise JobFailed(path, job)
+                if not self.allow_provisional:
+                    raise JobPending(path, job)
+                self._metadata = self.provisional_metadata(job)
+                self.provisional = True
+                self.job = job
+                return self._metadata
+            metadata_cache.set(path, self.signature, metadata)
 
-        else:
-            raise Exception("Unknown mode")
+        self._metadata = metadata
+        return self._metadata
 
-        return rgba
+    def provisional_metadata(self, job):
+        """
+        Return metadata to use while the file is being ingested. Only
+        available for rasters.
+        """
+        raise JobPending(self.path, job)
 
-class Dataset(object):
-    def __init__(self, path):
-        self.path = path
-        self._metadata = None
+    def fetch_metadata(self):
+        metadata = redis_store.get(self.path)
+        if metadata is not None:
+            return json.loads(metadata)
 
-    @property
-    def metadata(self):
+    def create_metadata(self):
+        """
+        Return the metadata of the file, creating it when it doesn't exist
+        yet. Creating the metadata of a large file can take a while, so only
+        one worker does it, and other workers that need it in the meantime
+        wait for a notification that it is ready.
+        """
         path = self.path
 
-        if self._metadata != None:
-            return self._metadata
+        def create(lease):
+            metadata = self.get_metadata()
+            # Only store the metadata while we still hold the lock, so a
+            # worker that lost it can't overwrite a newer version.
+            if lease.set(path, json.dumps(metadata)):
+                store_summary(path, self.signature, metadata)
+            return metadata
+
+        def load():
+            return self.fetch_metadata() or coalesce('metadata:' + path, create, self.fetch_metadata, timeout=None,
+                                                     ttl=app.config.get('MAPDROP_METADATA_LOCK_TTL', 10), fenced=True)
+
+        if self._metadata is None:
+            self._metadata = metadata_flight.do(path, load)
+            metadata_cache.set(path, self.signature, self._metadata)
+        return self._metadata
 
-        #redis_store.delete(path)
-        #redis_store.delete(path+'.lock')
-        metadata = redis_store.get(path)
-
-        if metadata == None:
-            # Try and set the 'lock' key, if that works then we're in the
-            # clear to create the metadata.
-            metadata_lock_key = path+'.lock'
-            metadata_lock_timestamp = datetime.utcnow()
-            metadata_lock_result = redis_store.setnx(metadata_lock_key, metadata_lock_timestamp)
-            if metadata_lock_result == True:
-                # We have the lock, save the data.
-                redis_store.expire(metadata_lock_key, 10)
-                metadata = self.get_metadata()
-                redis_store.set(metadata_lock_key, json.dumps(metadata))
-                redis_store.rename(metadata_lock_key, path)
-            else:
-                # We do not have the lock, apparently someone else does. Lets
-                # take a few seconds until the metadata has been generated and 
-                # then keep going.
-                for n in range(0, 5):
-                    time.sleep(0.5)
-                    metadata = redis_store.get(path)
-                    if metadata != None:
-                        break
-                raise Exception("No metadata found.")
-        else:
-            metadata = json.loads(metadata)
+    @property
+    def bounds(self):
+        """
+        Return the (west, south, east, north) bounds of the file.
+        """
+        bounds = self.metadata.get('bounds')
+        if bounds is None:
+            # Metadata created before bounds were stored
+            from shapely.wkt import loads
+            bounds = loads(self.metadata['envelope']).bounds
+        return bounds
+
+    def intersects(self, x, y, z):
+        """
+        Return whether a tile intersects with the bounds of the file.
+        """
+        west, south, east, north = self.bounds
+        tile = mercantile.bounds(x, y, z)
+        return tile.west < east and tile.east > west and tile.south < north and tile.north > south
 
-        self._metadata = metadata
-        return self._metadata
+    def not_modified(self, key, if_none_match):
+        """
+        Return a 304 response when the ETag of a tile matches the
+        If-None-Match header of the request, or None otherwise.
+        """
+        if if_none_match and if_none_match.contains_weak(key):
+            response = Response(status=304)
+            response.set_etag(key)
+            return response
 
 class Raster(Dataset):
-    def __init__(self, path, ds):
-        super().__init__(path)
+    def __init__(self, path, ds, signature=None, optimized=None):
+        super().__init__(path, signature=signature)
         self.ds = ds
+        self.optimized = optimized
 
     def __repr__(self):
         return "<Raster>"
@@ -217,7 +202,7 @@ class Raster(Dataset):
     def close(self):
         self.ds = None
 
-    def get_metadata(self):
+    def get_metadata(self, stats=True):
         """
         return metadata
         """
@@ -229,25 +214,45 @@ class Raster(Dataset):
                 'width':self.ds.RasterXSize,
                 'height':self.ds.RasterYSize
             },
-            'layers':self.get_layers(),
+            'layers':self.get_layers(stats=stats),
+            'overviews':self.get_overviews(),
             'gdal_metadata':self.ds.GetMetadata(),
+            'optimized':self.optimized or {'state':'none', 'original_size':self.signature[1] if self.signature else None, 'optimized_size':None},
             'type':'raster'
         }
         metadata.update(self.get_extent())
         return metadata
 
-    def get_layers(self):
+    def provisional_metadata(self, job):
+        """
+        Return the metadata of the raster without band statistics, which
+        is quick to read, so its tiles can be served while it is being
+        ingested. Ranges like min,max fall back to a fixed range.
+        """
+        metadata = self.get_metadata(stats=False)
+        metadata['job'] = job
+        return metadata
+
+    def get_overviews(self):
+        """
+        return state of the overviews
+        """
+        factors = existing_factors(self.ds)
+        if factors:
+            return {'state':'ready', 'factors':factors}
+        if app.config.get('MAPDROP_OVERVIEWS') in ('external', 'internal') and overview_factors(self.ds.RasterXSize, self.ds.RasterYSize):
+            return {'state':'pending', 'factors':[]}
+        return {'state':'none', 'factors':[]}
+
+    def get_layers(self, stats=True):
         layers = []
         for b in range(1, self.ds.RasterCount+1):
             band = self.ds.GetRasterBand(b)
-            raw = band.ReadAsArray()
-            mask = np.where(raw == band.GetNoDataValue(), 1, 0)
-            data = ma.masked_array(raw, mask=mask).compressed()
             layers.append({
                 'datatype': band.DataType,
                 'nodata': band.GetNoDataValue(),
                 'name': 'b{}'.format(b),
-                'stats':self.get_layer_stats(data),
+                'stats':self.get_layer_stats(band) if stats else None,
                 'gdal_metadata':band.GetMetadata()
             })
         return layers
@@ -256,6 +261,7 @@ class Raster(Dataset):
         """
         return epsg code
         """
+        from epsg_ident import EpsgIdent
         ident = EpsgIdent(prj=self.ds.GetProjectionRef())
         return ident.get_epsg()
 
@@ -263,12 +269,14 @@ class Raster(Dataset):
         """
         return extent and envelope
         """
+        import pyproj
+        from shapely.ops import transform
+        from shapely.geometry import box, Polygon
+
         srs = osr.SpatialReference()
         srs.ImportFromWkt(self.ds.GetProjectionRef())
         proj_init = srs.ExportToProj4()
 
-        print(proj_init)
-
         project = partial(pyproj.transform, pyproj.Proj(proj_init), pyproj.Proj(init="epsg:4326"))
 
         
@@ -295,140 +303,876 @@ class Raster(Dataset):
 
         return {
             'extent':extent.wkt,
-            'envelope':envelope.wkt
+            'envelope':envelope.wkt,
+            'bounds':list(envelope.bounds)
         }
 
-    def get_layer_stats(self, data):
-        stats = {}
-        stats.update({
-            'max': data.max().item(),
-            'min': data.min().item(),
-            'avg': data.mean().item(),
-            'q': np.percentile(data, q=range(0, 105, 5)).tolist()
-        })
-        return stats
+    def get_layer_stats(self, band):
+        """
+        Return statistics of a band, calculated block by block so the band
+        is never read into memory as a whole.
+        """
+        return band_stats(band,
+                          bins=app.config.get('MAPDROP_STATS_BINS', 4096),
+                          pixels=app.config.get('MAPDROP_STATS_WINDOW_PIXELS', 1048576),
+                          approximate=app.config.get('MAPDROP_STATS_APPROXIMATE', False))
+
+    def overview_level(self, tile, width):
+        """
+        Return the index of the overview to warp a tile from, which is the
+        coarsest overview that still has at least the resolution of the
+        tile, or 'NONE' to warp from the full resolution raster.
+        """
+        factors = existing_factors(self.ds)
+        if not factors:
+            return 'NONE'
+
+        # Approximate resolution of the raster in pseudomercator meters
+        if getattr(self, '_resolution', None) is None:
+            west, south, east, north = self.bounds
+            left, _ = mercantile.xy(west, south)
+            right, _ = mercantile.xy(east, north)
+            self._resolution = (right - left) / self.ds.RasterXSize
+
+        tile_resolution = (tile.right - tile.left) / width
+        level = 'NONE'
+        best = 1
+        for n, factor in enumerate(factors):
+            if best < factor and self._resolution * factor <= tile_resolution:
+                level = n
+                best = factor
+        return level
 
     def tile_data(self, z, x, y, width=256, height=256):
         """
         Fetch tile data by warping into a tile.
+        """
+        tile = mercantile.xy_bounds(x, y, z)
+        return self.warp_data(tile, width, height)
+
+    def warp_data(self, bounds, width, height):
+        """
+        Fetch data by warping the raster into pseudomercator `bounds` with
+        the given size in pixels.
 
         TODO: resampling algo
         """
-        tile = mercantile.xy_bounds(x, y, z)
+        if self.is_pseudomercator():
+            return self.read_data(bounds, width, height)
 
         ds = gdal.Warp('', 
                        self.ds, 
+                       options=['-ovr', str(self.overview_level(bounds, width))],
                        format='VRT', 
                        dstSRS='EPSG:3857',
                        outputType=self.metadata['layers'][0].get("datatype"), 
                        width=width, 
                        height=height, 
-                       outputBounds=(tile.left, tile.bottom, tile.right, tile.top))
+                       outputBounds=(bounds.left, bounds.bottom, bounds.right, bounds.top))
+        return self.read_bands(ds, width, height)
 
-        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(self.metadata['layers'][0].get("datatype"))
-        bands = np.empty((256,256, ds.RasterCount), dtype=dtype)
-        masks = np.empty((256,256, ds.RasterCount), dtype=dtype)
-        
-        for b in range(1, ds.RasterCount+1):
-            band = ds.GetRasterBand(b).ReadAsArray()
-            bands[:,:,b-1] = band
+    def read_bands(self, ds, width, height, count=None):
+        """
+        Read the first `count` (default all) bands of a warped dataset of
+        `width` by `height` pixels into the tile buffers of this thread,
+        and return them as a masked (height, width, count) array and its
+        mask. All bands are read in a single call. The mask is taken from
+        the GDAL mask band, so it covers nodata, alpha bands, and pixels
+        that no source covers.
+        """
+        count = count or ds.RasterCount
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(ds.GetRasterBand(1).DataType)
+        bands, masks, valid = tile_buffers.get(dtype, count, width, height)
 
-            mask = np.where(band == self.metadata['layers'][0].get("nodata"), 1, 0)
-            masks[:,:,b-1] = mask
+        if count == ds.RasterCount:
+            ds.ReadAsArray(buf_obj=bands if count > 1 else bands[0])
+        else:
+            for b in range(count):
+                ds.GetRasterBand(b+1).ReadAsArray(buf_obj=bands[b])
+        ds.GetRasterBand(1).GetMaskBand().ReadAsArray(buf_obj=valid)
+        np.equal(valid[None], 0, out=masks)
 
-        data = ma.masked_array(bands, mask=masks)
-        ds = None
+        data = ma.masked_array(bands.transpose(1, 2, 0), mask=masks.transpose(1, 2, 0))
+        return (data, masks[-1])
 
-        return (data, mask)
+    def is_pseudomercator(self):
+        """
+        Return whether the raster is a north-up raster in pseudomercator,
+        whose tiles can be read without warping.
+        """
+        geotransform = self.metadata['raster']['geotransform']
+        return str(self.metadata.get('epsg')) in ('3857', '900913') and geotransform[2] == 0 and geotransform[4] == 0
 
-    def tile(self, z, x, y, **kwargs):
-        #TODO: tile outside extent should return nothing
-        data, mask = self.tile_data(z, x, y, width=kwargs.get("width", 256), height=kwargs.get("height", 256))
-        rows, cols, bands = data.shape
-        format = kwargs.get("format","png").lower()
-        request_args = kwargs.get("request_args", {})
-        im_data = BytesIO()
+    def read_data(self, bounds, width, height):
+        """
+        Fetch data for pseudomercator `bounds` with a single windowed read
+        into the tile buffers, for rasters that are in pseudomercator
+        already. The source window is aligned on whole pixels, and GDAL
+        uses overviews when the window is read at a lower resolution.
+        """
+        x_min, x_size, _, y_max, _, y_size = self.metadata['raster']['geotransform']
+        count = self.ds.RasterCount
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(self.metadata['layers'][0].get("datatype"))
 
+        bands, masks, valid = tile_buffers.get(dtype, count, width, height)
+        bands.fill(0)
+        valid.fill(0)
+
+        # Window of the tile in (fractional) source pixels
+        left = (bounds.left - x_min) / x_size
+        right = (bounds.right - x_min) / x_size
+        top = (bounds.top - y_max) / y_size
+        bottom = (bounds.bottom - y_max) / y_size
+
+        # Whole source pixels that fall within the tile and the raster
+        xoff = max(int(math.floor(left)), 0)
+        yoff = max(int(math.floor(top)), 0)
+        xend = min(int(math.ceil(right)), self.ds.RasterXSize)
+        yend = min(int(math.ceil(bottom)), self.ds.RasterYSize)
+
+        # The part of the tile covered by that window
+        col_start = max(int(round((xoff - left) * width / (right - left))), 0)
+        col_end = min(int(round((xend - left) * width / (right - left))), width)
+        row_start = max(int(round((yoff - top) * height / (bottom - top))), 0)
+        row_end = min(int(round((yend - top) * height / (bottom - top))), height)
+
+        if xend > xoff and yend > yoff and col_end > col_start and row_end > row_start:
+            # Read straight into the part of the buffers the window covers
+            window = bands[:, row_start:row_end, col_start:col_end]
+            self.ds.ReadAsArray(xoff, yoff, xend - xoff, yend - yoff, buf_obj=window if count > 1 else window[0])
+            self.ds.GetRasterBand(1).GetMaskBand().ReadAsArray(xoff, yoff, xend - xoff, yend - yoff,
+                                                               buf_obj=valid[row_start:row_end, col_start:col_end])
+        np.equal(valid[None], 0, out=masks)
+
+        data = ma.masked_array(bands.transpose(1, 2, 0), mask=masks.transpose(1, 2, 0))
+        return (data, masks[-1])
+
+    def render_params(self, request_args):
+        """
+        Return the normalised colormap, mode, and ranges to render tiles
+        with. Settings in the file metadata take precedence over the ones
+        in the request.
+        """
         gdal_metadata = self.metadata.get("gdal_metadata", {})
         colormap = gdal_metadata.get('mapdrop_colormap') or request_args.get("colormap") or 'Spectral'
         mode = gdal_metadata.get('mapdrop_mode') or request_args.get("mode") or 'linear'
         ranges = gdal_metadata.get('mapdrop_ranges') or request_args.get("ranges") or 'min,max'
 
-        if bands == 3:
+        if len(self.metadata['layers']) == 3:
             mode = 'rgb'
 
-        cm = Colormap(colormap=colormap, mode=mode, ranges=ranges, stats=self.metadata['layers'][0]['stats'])
-        rgba = cm.rgba(data)
-        
-        if format == 'png':
-            im = Image.fromarray(rgba, mode='RGBA')
-            im.save(im_data, format="PNG")
-            return Response(im_data.getvalue(), mimetype='image/png')
+        return Colormap.normalise(colormap=colormap, mode=mode, ranges=ranges, stats=self.metadata['layers'][0]['stats'])
 
-        elif format == 'jpeg':
-            im = Image.fromarray(rgba[:,:,:-1], mode='RGB')
-            im.save(im_data, format="JPEG", quality=int(request_args.get("quality",75)), optimize=True, progressive=True)
-            return Response(im_data.getvalue(), mimetype='image/jpeg')
+    def tile_params(self, format, request_args):
+        """
+        Return the render parameters plus the options of the tile format.
+        """
+        params = self.render_params(request_args)
+        if format in ('jpeg', 'webp'):
+            params['quality'] = int(request_args.get("quality",75))
+        if format == 'webp':
+            params['lossless'] = request_args.get("lossless", "").lower() in ('1', 'true', 'yes')
+        if format in ('png', 'base64'):
+            params['png'] = encode.png_options()
+        if format == 'utfgrid':
+            params['resolution'] = int(request_args.get("resolution",4))
+        return params
 
-        elif format == 'base64':
-            im = Image.fromarray(rgba, mode='RGBA')
-            im.save(im_data, format="PNG")
-            return Response(b"data:image/png;base64,"+base64.b64encode(im_data.getvalue()), mimetype='application/base64')
+    def tile(self, z, x, y, **kwargs):
+        """
+        Return a tile response. Rendered tiles are stored in the tile cache
+        under a key built from the file version, the tile coordinates, the
+        format, and the normalised render parameters. The same key is used
+        as ETag for conditional requests.
+        """
+        format = kwargs.get("format","png").lower()
+        request_args = kwargs.get("request_args", {})
+        width = kwargs.get("width", 256)
+        height = kwargs.get("height", 256)
+
+        params = self.tile_params(format, request_args)
+
+        if not self.intersects(x, y, z):
+            return self.empty_tile(width, height, format, params, if_none_match=kwargs.get("if_none_match"))
+
+        if self.provisional:
+            # Rendered with provisional metadata, so it is neither cached
+            # nor given an ETag, and replaced once the file is ingested.
+            mimetype, content = self.render_tile(z, x, y, width, height, format, params)
+            response = Response(content, mimetype=mimetype)
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+
+        key = self.tile_key(z, x, y, width, height, format, params)
+
+        not_modified = self.not_modified(key, kwargs.get("if_none_match"))
+        if not_modified is not None:
+            return not_modified
+
+        with timed('cache'):
+            cached = tile_cache.get(key)
+        count('tile', cached is not None)
+        if cached is None:
+            n = self.metatile_size(z, width, height)
+            if n > 1:
+                cached = self.metatile(z, x - x % n, y - y % n, n, width, height, format, params).get((x, y))
+            else:
+                mimetype, content = self.render_tile(z, x, y, width, height, format, params)
+                tile_cache.set(key, mimetype, content)
+                cached = (mimetype, content)
+        mimetype, content = cached
 
+        response = Response(content, mimetype=mimetype)
+        response.set_etag(key)
+        return response
+
+    def empty_tile(self, width, height, format, params, if_none_match=None):
+        """
+        Return a response for a tile outside of the extent of the raster,
+        which is either a shared pre-encoded empty tile, or a 204 response
+        when MAPDROP_EMPTY_TILE_STATUS is 204. The ETag of the empty tile
+        only depends on its format and parameters, and requests that have
+        it in their If-None-Match header get a 304 response.
+        """
+        if app.config.get('MAPDROP_EMPTY_TILE_STATUS') == 204:
+            return Response(status=204)
+
+        key = (width, height, format, repr(sorted(params.items())))
+        if key not in empty_tiles:
+            if format == 'utfgrid':
+                image = ma.masked_all((height, width, 1), dtype=np.uint8)
+            else:
+                image = np.zeros((height, width, 4), dtype=np.uint8)
+            etag = 'empty-' + tile_key(*key)
+            empty_tiles[key] = (etag,) + tuple(self.encode_tile(image, format, params))
+        etag, mimetype, content = empty_tiles[key]
+
+        not_modified = self.not_modified(etag, if_none_match)
+        if not_modified is not None:
+            return not_modified
+
+        response = Response(content, mimetype=mimetype)
+        response.set_etag(etag)
+        return response
+
+    def tile_key(self, z, x, y, width, height, format, params):
+        return tile_key(self.path, self.version, z, x, y, width, height, format, params)
+
+    def metatile_size(self, z, width, height, n=None):
+        """
+        Return the number of tiles along each side of a metatile at zoom
+        level z, which is n (MAPDROP_METATILE_SIZE by default) unless a
+        metatile of n x n tiles of width x height pixels would have more
+        than MAPDROP_METATILE_MAX_PIXELS pixels. Large tiles get smaller
+        metatiles then, down to rendering them one by one.
+        """
+        if n is None:
+            n = app.config.get('MAPDROP_METATILE_SIZE', 1)
+        n = max(1, min(n, 2**z))
+        max_pixels = app.config.get('MAPDROP_METATILE_MAX_PIXELS')
+        if max_pixels:
+            while n > 1 and n * width * n * height > max_pixels:
+                n -= 1
+        return n
+
+    def metatile_keys(self, z, mx, my, n, width, height, format, params):
+        """
+        Return the cache keys of the tiles in a metatile as a dict of
+        {(x, y): key}.
+        """
+        keys = {}
+        for x in range(mx, min(mx + n, 2**z)):
+            for y in range(my, min(my + n, 2**z)):
+                keys[(x, y)] = self.tile_key(z, x, y, width, height, format, params)
+        return keys
+
+    def metatile(self, z, mx, my, n, width, height, format, params):
+        """
+        Return the tiles of the metatile with top left tile (mx, my) as a
+        dict of {(x, y): (mimetype, content)}. Concurrent requests for the
+        same metatile are coalesced into a single render, both within a
+        worker and, when the tile cache is shared, across workers.
+        """
+        keys = self.metatile_keys(z, mx, my, n, width, height, format, params)
+
+        def render():
+            return self.render_metatile(z, mx, my, n, width, height, format, params, keys)
+
+        def lookup():
+            tiles = {xy:tile_cache.get(key) for (xy, key) in keys.items()}
+            if all(tiles.values()):
+                return tiles
+
+        metakey = tile_key(self.path, self.version, 'metatile', z, mx, my, n, width, height, format, params)
+        if tile_cache.shared:
+            return metatile_flight.do(metakey, lambda: coalesce(metakey, render, lookup))
+        return metatile_flight.do(metakey, render)
+
+    def render_metatile(self, z, mx, my, n, width, height, format, params, keys):
+        """
+        Render a metatile by warping all of its tiles in a single pass, and
+        then slicing, colour mapping, and encoding the individual tiles.
+        All tiles are stored in the tile cache.
+        """
+        cols = min(n, 2**z - mx)
+        rows = min(n, 2**z - my)
+        top_left = mercantile.xy_bounds(mx, my, z)
+        bottom_right = mercantile.xy_bounds(mx + cols - 1, my + rows - 1, z)
+        bounds = mercantile.Bbox(top_left.left, bottom_right.bottom, bottom_right.right, top_left.top)
+
+        with timed('warp'):
+            data, mask = self.warp_data(bounds, width * cols, height * rows)
+        with timed('colormap'):
+            image = self.colorize(data, format, params)
+
+        tiles = {}
+        for (x, y), key in keys.items():
+            i = (x - mx) * width
+            j = (y - my) * height
+            with timed('encode'):
+                mimetype, content = self.encode_tile(image[j:j+height, i:i+width], format, params)
+            with timed('cache'):
+                tile_cache.set(key, mimetype, content)
+            tiles[(x, y)] = (mimetype, content)
+        return tiles
+
+    def render_tile(self, z, x, y, width, height, format, params):
+        """
+        Render a tile and return a tuple of its mimetype and content.
+        """
+        with timed('warp'):
+            data, mask = self.tile_data(z, x, y, width=width, height=height)
+        with timed('colormap'):
+            image = self.colorize(data, format, params)
+        with timed('encode'):
+            return self.encode_tile(image, format, params)
+
+    def colorize(self, data, format, params):
+        """
+        Apply the colormap to warped data. UTFGrid tiles are encoded from
+        the data itself, so it is returned as is for those.
+        """
+        if format == 'utfgrid':
+            return data
+        cm = Colormap.compile(colormap=params['colormap'], mode=params['mode'], ranges=params['ranges'])
+        if cm.mode == 'rgb':
+            return cm.rgba(data)
+        return encode.Indexed(cm.indices(data), cm.palette)
+
+    def encode_tile(self, image, format, params):
+        """
+        Encode colormapped data (or the data itself for UTFGrid tiles) into
+        a tile of the requested format, and return a tuple of its mimetype
+        and content. See encode.encode().
+        """
+        if format == 'utfgrid':
+            return ('application/json', self.utfgrid(image, params))
+        return encode.encode(image, format, params)
+
+    def zonal_stats(self, geoms, names, crs='EPSG:4326', band=1, all_touched=False):
+        """
+        Generate statistics of the pixels within each of a list of shapely
+        geometries in `crs`. See query.zonal_stats().
+        """
+        self.check_band(band)
+        return query.zonal_stats(self.ds, geoms, names, crs=crs, band=band, all_touched=all_touched)
+
+    def subset(self, bounds, filename, crs='EPSG:4326', format='cog'):
+        """
+        Write the part of the raster within (west, south, east, north)
+        `bounds` in `crs` to `filename`, as a cloud optimized GeoTIFF
+        ('cog') or a tiled GeoTIFF ('tif'). GDAL versions without the COG
+        driver write a tiled GeoTIFF in both cases.
+        """
+        xs, ys = query.transform_coords(*edge_points(bounds), crs, self.ds)
+        ulx, uly, lrx, lry = np.nanmin(xs), np.nanmax(ys), np.nanmax(xs), np.nanmin(ys)
+
+        _, x_size, _, _, _, y_size = self.ds.GetGeoTransform()
+        pixels = abs((lrx - ulx) / x_size) * abs((uly - lry) / y_size)
+        if pixels > app.config.get('MAPDROP_RAW_SUBSET_MAX_PIXELS'):
+            raise Exception("Subset of {:.0f} pixels is too large.".format(pixels))
+
+        if format == 'cog' and gdal.GetDriverByName('COG') is not None:
+            driver, options = 'COG', ['COMPRESS=DEFLATE']
         else:
-            raise Exception("Unknown format")
+            driver, options = 'GTiff', ['TILED=YES', 'COMPRESS=DEFLATE']
+
+        ds = gdal.Translate(filename, self.ds, format=driver, projWin=[ulx, uly, lrx, lry], creationOptions=options)
+        if ds is None:
+            raise Exception("Could not create subset.")
+        ds = None
+
+    def check_band(self, band):
+        if band < 1 or band > self.ds.RasterCount:
+            raise Exception("Invalid band: {}".format(band))
+
+    def sample(self, xs, ys, crs='EPSG:4326', band=1, interpolation='nearest'):
+        """
+        Return the values of a band at arrays of coordinates in `crs`, with
+        NaN where there is no data. See query.sample().
+        """
+        self.check_band(band)
+        return query.sample(self.ds, xs, ys, crs=crs, band=band, interpolation=interpolation)
+
+    def transect(self, line, points, crs='EPSG:4326', band=1, interpolation='nearest'):
+        """
+        Sample a band at `points` points along a line in `crs`. Returns
+        (distances, xs, ys, values) arrays.
+        """
+        self.check_band(band)
+        distances, xs, ys = query.densify(line, points, crs=crs)
+        values = query.sample(self.ds, xs, ys, crs=crs, band=band, interpolation=interpolation)
+        return (distances, xs, ys, values)
 
-    def utfgrid(self, **kwargs):
-        pass
+    def utfgrid(self, data, params):
+        """
+        Encode a tile of warped data as UTFGrid, with a key for every color
+        of the colormap that occurs in the tile.
+        """
+        if params['mode'] == 'rgb':
+            raise Exception("UTFGrid tiles are not available for rgb rasters.")
+
+        resolution = params.get('resolution', 4)
+        mask = utfgrid.downsample(ma.getmaskarray(data)[:,:,0], resolution)
+        if mask.all():
+            grid = np.zeros(mask.shape, dtype=np.uint8)
+            legend = [None]
+        else:
+            cm = Colormap.compile(colormap=params['colormap'], mode=params['mode'], ranges=params['ranges'])
+            values = utfgrid.downsample(ma.getdata(data)[:,:,0], resolution)
+            grid = cm.index(values, mask=mask, nodata=self.metadata['layers'][0].get("nodata"))
+            legend = cm.legend()
+        return utfgrid.dumps(utfgrid.encode_grid(grid, legend))
+
+class Mosaic(Raster):
+    """
+    The rasters in a directory served as a single layer. The members that
+    intersect a tile are found in the R-tree of the MosaicIndex of the
+    directory, and only those are opened and warped together into the
+    tile. Statistics are combined over all members, so ranges like min,max
+    are the same for every tile of the mosaic.
+    """
 
-class Vector(object):
     def __init__(self, path):
-        raise NotImplementedError
+        self.index = mosaic_index(path)
+        super().__init__(path, None, signature=self.index.signature)
 
-    def close(self):
-        pass
+    def __repr__(self):
+        return "<Mosaic path='{}'>".format(self.path)
 
     @property
     def metadata(self):
-        return {
-            'type':'vector',
-            'crs':self.ds.GetProjectionRef(),
-            'vector':{},
-            'layers':self.layers
+        """
+        Return the combined metadata of the members. This raises JobPending
+        when none of the files have been ingested yet.
+        """
+        if self.index.metadata is None and self.index.pending:
+            raise JobPending(self.path, {'path':self.path, 'state':'pending', 'files':sorted(self.index.pending)})
+        return self.index.metadata
+
+    def is_pseudomercator(self):
+        return False
+
+    def warp_data(self, bounds, width, height):
+        """
+        Fetch data by warping the members that intersect pseudomercator
+        `bounds` together into a VRT with the given size in pixels. Pixels
+        that none of them cover are masked.
+        """
+        layers = self.metadata['layers']
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(layers[0].get("datatype"))
+        sources = []
+        for name in self.index.query((bounds.left, bounds.bottom, bounds.right, bounds.top)):
+            try:
+                sources.append(MapdropFile(os.path.join(self.path, name)).ds.ds)
+            except Exception:
+                # Removed since the index was updated
+                continue
+
+        if not sources:
+            data = ma.masked_all((height, width, len(layers)), dtype=dtype)
+            return (data, ma.getmaskarray(data)[:,:,-1])
+
+        ds = gdal.Warp('',
+                       sources,
+                       format='VRT',
+                       dstSRS='EPSG:3857',
+                       dstAlpha=True,
+                       outputType=layers[0].get("datatype"),
+                       width=width,
+                       height=height,
+                       outputBounds=(bounds.left, bounds.bottom, bounds.right, bounds.top))
+        # The mask band of the warped bands is the alpha band
+        return self.read_bands(ds, width, height, count=ds.RasterCount - 1)
+
+
+class Vector(Dataset):
+    """
+    Vector file, read through OGR. Every layer gets a spatial index over the
+    bounding boxes of its features, which is built in the same pass over
+    the features as the metadata, and stored in a hidden file next to the
+    vector file. Tiles are served as Mapbox Vector Tiles.
+    """
+
+    def __init__(self, path, ds, fullpath, signature=None):
+        super().__init__(path, signature=signature)
+        self.ds = ds
+        self.fullpath = fullpath
+
+    def __repr__(self):
+        return "<Vector>"
+
+    def close(self):
+        self.ds = None
+
+    def get_metadata(self):
+        """
+        return metadata
+        """
+        from shapely.geometry import box
+        from shapely.ops import unary_union
+
+        layers = []
+        boxes = []
+        for n in range(self.ds.GetLayerCount()):
+            summary, tree = self.scan_layer(n)
+            self.save_index(n, tree)
+            layers.append(summary)
+            if tree.bounds is not None:
+                boxes.append(self.layer_extent(n, tree.bounds))
+
+        layer = self.ds.GetLayer(0)
+        metadata = {
+            'crs':layer.GetSpatialRef().ExportToWkt() if layer.GetSpatialRef() else None,
+            'epsg':self.get_epsg(layer),
+            'vector':{
+                'count':sum(summary['count'] for summary in layers)
+            },
+            'layers':layers,
+            'gdal_metadata':self.ds.GetMetadata(),
+            'type':'vector'
         }
 
-    @property
-    def layers(self):
-        return []
+        extent = unary_union(boxes) if boxes else box(0, 0, 0, 0)
+        metadata.update({
+            'extent':extent.wkt,
+            'envelope':box(*extent.bounds).wkt,
+            'bounds':list(extent.bounds)
+        })
+        return metadata
+
+    def get_epsg(self, layer):
+        srs = layer.GetSpatialRef()
+        if srs is None:
+            return None
+        from epsg_ident import EpsgIdent
+        return EpsgIdent(prj=srs.ExportToWkt()).get_epsg()
+
+    def scan_layer(self, n):
+        """
+        Read all features of a layer in a single pass, collecting the
+        bounding boxes for the spatial index along with the feature count
+        and a summary of every field.
+        """
+        layer = self.ds.GetLayer(n)
+        defn = layer.GetLayerDefn()
+        numeric = (ogr.OFTInteger, ogr.OFTInteger64, ogr.OFTReal)
+
+        fields = []
+        for i in range(defn.GetFieldCount()):
+            field = defn.GetFieldDefn(i)
+            fields.append({
+                'name':field.GetName(),
+                'type':field.GetFieldTypeName(field.GetType()),
+                'numeric':field.GetType() in numeric,
+                'count':0, 'sum':0.0, 'min':None, 'max':None
+            })
+
+        fids = []
+        boxes = []
+        layer.ResetReading()
+        for feature in layer:
+            geom = feature.GetGeometryRef()
+            if geom is not None and not geom.IsEmpty():
+                minx, maxx, miny, maxy = geom.GetEnvelope()
+                fids.append(feature.GetFID())
+                boxes.append((minx, miny, maxx, maxy))
+
+            for i, field in enumerate(fields):
+                if not feature.IsFieldSetAndNotNull(i):
+                    continue
+                field['count'] += 1
+                if field['numeric']:
+                    value = feature.GetFieldAsDouble(i)
+                    field['sum'] += value
+                    field['min'] = value if field['min'] is None else min(field['min'], value)
+                    field['max'] = value if field['max'] is None else max(field['max'], value)
+        layer.ResetReading()
+
+        for field in fields:
+            if field.pop('numeric'):
+                field['avg'] = field['sum'] / field['count'] if field['count'] else None
+            else:
+                del field['sum'], field['min'], field['max']
+
+        tree = PackedRTree.build(np.array(boxes, dtype=np.float64).reshape(-1, 4), np.array(fids, dtype=np.int64))
+        summary = {
+            'name':layer.GetName(),
+            'datatype':ogr.GeometryTypeToName(layer.GetGeomType()),
+            'count':len(fids),
+            'bounds':list(tree.bounds) if tree.bounds is not None else None,
+            'fields':fields
+        }
+        return (summary, tree)
+
+    def index_filename(self, n):
+        directory, filename = os.path.split(self.fullpath)
+        return os.path.join(directory, '.{}.{}.rtree.npz'.format(filename, n))
+
+    def save_index(self, n, tree):
+        try:
+            tree.save(self.index_filename(n), signature=np.array(self.signature[:2]))
+        except OSError as e:
+            print("Could not save spatial index: {}".format(e))
+        indexes.set((self.fullpath, n, self.signature), tree)
+
+    def index(self, n):
+        """
+        Return the spatial index of a layer, from the worker's cache, from
+        disk, or by building it when it is missing or out of date.
+        """
+        key = (self.fullpath, n, self.signature)
+        tree = indexes.get(key)
+        if tree is not None:
+            return tree
+        try:
+            tree, extra = PackedRTree.load(self.index_filename(n))
+            if tuple(extra['signature'].tolist()) != tuple(self.signature[:2]):
+                raise ValueError("Spatial index is out of date")
+            indexes.set(key, tree)
+        except (OSError, ValueError, KeyError):
+            _, tree = self.scan_layer(n)
+            self.save_index(n, tree)
+        return tree
+
+    def layer_srs(self, n):
+        srs = self.ds.GetLayer(n).GetSpatialRef()
+        if srs is None:
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(4326)
+        if hasattr(srs, 'SetAxisMappingStrategy'):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        return srs
+
+    def transformer(self, n, crs):
+        import pyproj
+        return pyproj.Transformer.from_crs(pyproj.CRS.from_wkt(self.layer_srs(n).ExportToWkt()), crs, always_xy=True)
+
+    def layer_extent(self, n, bounds):
+        """
+        Return the bounds of a layer as a polygon in EPSG:4326.
+        """
+        from shapely.geometry import Polygon
+        xs, ys = self.transformer(n, 'EPSG:4326').transform(*edge_points(bounds))
+        return Polygon(list(zip(xs, ys)))
+
+    def layer_bounds(self, n, bounds):
+        """
+        Return pseudomercator bounds in the coordinate system of a layer,
+        densifying the edges so curved edges are covered as well.
+        """
+        import pyproj
+        transformer = pyproj.Transformer.from_crs('EPSG:3857', pyproj.CRS.from_wkt(self.layer_srs(n).ExportToWkt()), always_xy=True)
+        xs, ys = transformer.transform(*edge_points(bounds))
+        return (np.nanmin(xs), np.nanmin(ys), np.nanmax(xs), np.nanmax(ys))
+
+    def tile(self, z, x, y, **kwargs):
+        """
+        Return a Mapbox Vector Tile response, cached and with an ETag just
+        like raster tiles.
+        """
+        format = kwargs.get("format","mvt").lower()
+        if format not in ('mvt', 'pbf'):
+            raise Exception("Unknown format")
+
+        if not self.intersects(x, y, z):
+            response = Response(b'', mimetype='application/vnd.mapbox-vector-tile')
+            response.set_etag('empty-mvt')
+            return response
+
+        key = tile_key(self.path, self.version, z, x, y, 'mvt')
+        not_modified = self.not_modified(key, kwargs.get("if_none_match"))
+        if not_modified is not None:
+            return not_modified
+
+        with timed('cache'):
+            cached = tile_cache.get(key)
+        count('tile', cached is not None)
+        if cached is None:
+            def render():
+                with timed('render'):
+                    content = self.render_tile(z, x, y)
+                tile_cache.set(key, 'application/vnd.mapbox-vector-tile', content)
+                return ('application/vnd.mapbox-vector-tile', content)
+            cached = metatile_flight.do(key, render)
+        mimetype, content = cached
+
+        response = Response(content, mimetype=mimetype)
+        response.set_etag(key)
+        return response
+
+    def render_tile(self, z, x, y, extent=4096, buffer=64):
+        """
+        Render a vector tile with every layer of the file. Only features
+        that the spatial index finds in the (buffered) tile are read, and
+        they are clipped to the buffered tile and simplified to the
+        resolution of the tile. Lines and polygons smaller than a tile
+        pixel are left out.
+        """
+        bounds = mercantile.xy_bounds(x, y, z)
+        resolution = (bounds.right - bounds.left) / extent
+        margin = buffer * resolution
+        clip_bounds = (bounds.left - margin, bounds.bottom - margin, bounds.right + margin, bounds.top + margin)
+        clip = ogr.CreateGeometryFromWkt('POLYGON(({0} {1},{2} {1},{2} {3},{0} {3},{0} {1}))'.format(*clip_bounds))
+
+        mercator = osr.SpatialReference()
+        mercator.ImportFromEPSG(3857)
+        if hasattr(mercator, 'SetAxisMappingStrategy'):
+            mercator.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+        layers = []
+        for n in range(self.ds.GetLayerCount()):
+            layer = self.ds.GetLayer(n)
+            fids = np.sort(self.index(n).query(self.layer_bounds(n, clip_bounds)))
+            ct = osr.CoordinateTransformation(self.layer_srs(n), mercator)
 
-    def tile(self, **kwargs):
-        pass
+            tile_layer = mvt.Layer(layer.GetName(), extent=extent)
+            for fid in fids.tolist():
+                feature = layer.GetFeature(fid)
+                geom = feature.GetGeometryRef().Clone()
+                geom.Transform(ct)
 
-    def utfgrid(self, **kwargs):
-        pass
+                geom_type, parts = tile_geometry(geom, clip, resolution, bounds, extent)
+                if parts:
+                    tile_layer.add_feature(geom_type, parts, properties=feature.items(), id=fid)
+            layers.append(tile_layer)
+
+        return mvt.encode_tile(layers)
+
+
+def edge_points(bounds, points=10):
+    """
+    Return (xs, ys) arrays of points along the edges of bounds, going
+    around them clockwise from the bottom left corner.
+    """
+    left, bottom, right, top = bounds
+    t = np.linspace(0, 1, points, endpoint=False)
+    xs = np.concatenate((np.full(points, left), left + t * (right - left), np.full(points, right), right - t * (right - left)))
+    ys = np.concatenate((bottom + t * (top - bottom), np.full(points, top), top - t * (top - bottom), np.full(points, bottom)))
+    return (xs, ys)
+
+
+def tile_geometry(geom, clip, resolution, bounds, extent):
+    """
+    Clip and simplify an OGR geometry in pseudomercator, and return its
+    Mapbox Vector Tile type with its parts in tile coordinates.
+    """
+    geom_type = ogr.GT_Flatten(geom.GetGeometryType())
+    if geom_type in (ogr.wkbPoint, ogr.wkbMultiPoint):
+        kind = mvt.POINT
+    elif geom_type in (ogr.wkbLineString, ogr.wkbMultiLineString):
+        kind = mvt.LINESTRING
+    elif geom_type in (ogr.wkbPolygon, ogr.wkbMultiPolygon):
+        kind = mvt.POLYGON
+    else:
+        return (None, [])
+
+    if kind != mvt.POINT:
+        minx, maxx, miny, maxy = geom.GetEnvelope()
+        if maxx - minx < resolution and maxy - miny < resolution:
+            return (None, [])
+
+    if not geom.Within(clip):
+        geom = geom.Intersection(clip)
+    if geom is None or geom.IsEmpty():
+        return (None, [])
+    if kind != mvt.POINT:
+        geom = geom.SimplifyPreserveTopology(resolution)
+
+    def coords(g):
+        points = np.array(g.GetPoints(), dtype=np.float64)[:,:2]
+        points[:,0] = (points[:,0] - bounds.left) * (extent / (bounds.right - bounds.left))
+        points[:,1] = (bounds.top - points[:,1]) * (extent / (bounds.top - bounds.bottom))
+        return np.rint(points).astype(np.int64)
+
+    # Clipping can turn a geometry into a collection of several types,
+    # only the parts of the original type are kept.
+    parts = []
+    stack = [geom]
+    while stack:
+        g = stack.pop(0)
+        t = ogr.GT_Flatten(g.GetGeometryType())
+        if t == ogr.wkbPoint and kind == mvt.POINT:
+            parts.append(coords(g))
+        elif t == ogr.wkbLineString and kind == mvt.LINESTRING:
+            parts.append(coords(g))
+        elif t == ogr.wkbPolygon and kind == mvt.POLYGON:
+            parts.append([coords(g.GetGeometryRef(i)) for i in range(g.GetGeometryCount())])
+        elif t in (ogr.wkbMultiPoint, ogr.wkbMultiLineString, ogr.wkbMultiPolygon, ogr.wkbGeometryCollection):
+            stack.extend(g.GetGeometryRef(i) for i in range(g.GetGeometryCount()))
+    return (kind, parts)
 
 
 class MapdropFile(object):
-    def __init__(self, path):
+    def __init__(self, path, pooled=True):
         MAPDROP_DATA = os.environ.get("MAPDROP_DATA", None)
         if not os.path.isdir(MAPDROP_DATA):
             raise Exception("Invalid MAPDROP_DATA directory.")
 
         fullpath = os.path.join(MAPDROP_DATA, path)
-        if not os.path.isfile(fullpath):
-            raise Exception("File {} does not exist.".format(fullpath))
 
         self.path = path
         self.fullpath = fullpath
 
+        # Rasters are read from their optimized copy when they have one that
+        # was made from this version of the file. Its modification time is
+        # part of the signature, so tiles and metadata from before the copy
+        # was made are not used.
+        #
+        # Handles from the pool can't be shared between threads, so threads
+        # other than those handling requests (like the job threads of the
+        # MemoryJobQueue) pass `pooled=False` to open a handle of their own.
+        if pooled:
+            opener = pool.open
+        else:
+            opener = lambda filename, signature=None: gdal.OpenEx(filename, gdal.OF_RASTER | gdal.OF_VECTOR)
+        optimized = None
+        try:
+            with timed('open'):
+                signature = pool.signature(fullpath)
+                copy = open_optimized(fullpath, signature, opener)
+                if copy is not None:
+                    ds, st = copy
+                    signature = signature + (st.st_mtime_ns,)
+                    optimized = {'state':'ready', 'original_size':signature[1], 'optimized_size':st.st_size}
+                else:
+                    ds = opener(fullpath, signature=signature)
+        except OSError:
+            raise Exception("File {} does not exist.".format(fullpath))
+
         try:
-            ds = gdal.Open(fullpath)
             if ds == None:
                 raise Exception("Can't open file at path: {}".format(path))
-            else:
-                self.ds = Raster(path, ds)
+            elif ds.RasterCount > 0:
+                self.ds = Raster(path, ds, signature=signature, optimized=optimized)
                 self.is_raster = True
                 self.is_vector = False
+            elif ds.GetLayerCount() > 0:
+                self.ds = Vector(path, ds, fullpath, signature=signature)
+                self.is_raster = False
+                self.is_vector = True
+            else:
+                raise Exception("Can't open file at path: {}".format(path))
         except Exception as e:
             raise Exception("Can't open file at path: {}".format(path))
 
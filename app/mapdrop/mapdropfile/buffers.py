@@ -0,0 +1,57 @@
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+
+class TileBuffers(threading.local):
+    """
+    Arrays that tile data is read into, reused from tile to tile by each
+    thread of a worker, so reading a tile doesn't allocate arrays for its
+    data and masks. Buffers are kept for the last `keep` combinations of
+    data type, band count, and size (like 256 and 512 pixel tiles, and the
+    metatiles they are rendered in), and at most `max_bytes` (per thread)
+    is held. Buffers for a shape larger than that are allocated for every
+    tile and never kept.
+
+    Data read into these buffers is only valid until the next tile of the
+    same shape is read in the same thread, which is after the tile (or
+    metatile) it belongs to has been encoded.
+    """
+
+    def __init__(self, keep=4, max_bytes=67108864):
+        self.keep = keep
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.buffers = OrderedDict()
+
+    def __repr__(self):
+        return "<TileBuffers shapes={} bytes={}>".format(list(self.buffers), self.bytes)
+
+    def get(self, dtype, count, width, height):
+        """
+        Return (bands, masks, valid) buffers for a tile: the data of the
+        bands as a (count, height, width) array, the masks of the bands as
+        a boolean array of the same shape, and a (height, width) uint8
+        array to read a GDAL mask band into.
+        """
+        key = (np.dtype(dtype).str, count, width, height)
+        buffers = self.buffers.get(key)
+        if buffers is not None:
+            self.buffers.move_to_end(key)
+            return buffers
+
+        size = count * width * height * (np.dtype(dtype).itemsize + 1) + width * height
+        buffers = (np.empty((count, height, width), dtype=dtype),
+                   np.empty((count, height, width), dtype=bool),
+                   np.empty((height, width), dtype=np.uint8))
+        if size > self.max_bytes:
+            return buffers
+
+        self.buffers[key] = buffers
+        self.bytes += size
+        while len(self.buffers) > self.keep or self.bytes > self.max_bytes:
+            (_, evicted) = self.buffers.popitem(last=False)
+            self.bytes -= sum(array.nbytes for array in evicted)
+        return buffers
@@ -0,0 +1,286 @@
+import os
+import uuid
+import json
+import time
+import fcntl
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from mapdrop import app, redis_store
+
+
+class TileCache(object):
+    """
+    Base class for the rendered tile caches. Entries are (mimetype, data)
+    tuples stored under a content-addressed key, so they never have to be
+    invalidated explicitly: a new version of a file simply results in new
+    keys, and old entries age out of the cache.
+
+    Caches that are `shared` are visible to all worker processes.
+    """
+
+    shared = False
+
+    def get(self, key):
+        return None
+
+    def set(self, key, mimetype, data):
+        pass
+
+    def pack(self, mimetype, data):
+        return mimetype.encode() + b'\n' + data
+
+    def unpack(self, value):
+        mimetype, data = value.split(b'\n', 1)
+        return (mimetype.decode(), data)
+
+
+class MemoryTileCache(TileCache):
+    """
+    In-process LRU cache, limited to `max_bytes` of tile data.
+    """
+
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<MemoryTileCache entries={} bytes={}>".format(len(self.entries), self.bytes)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, mimetype, data):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (mimetype, data)
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes and self.entries:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+
+class DiskTileCache(TileCache):
+    """
+    Cache that stores tiles as files in a directory, spread over 256
+    subdirectories. Files are written to a temporary name first and then
+    renamed, so other workers never read a partially written tile.
+
+    Tiles of old versions of a file are never requested again, so the
+    directory is swept every `sweep_interval` seconds: tiles older than
+    `ttl` seconds are removed, and then the oldest tiles until the cache
+    holds at most `max_bytes`.
+    """
+
+    shared = True
+
+    def __init__(self, directory, max_bytes=None, ttl=None, sweep_interval=300):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.next_sweep = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<DiskTileCache directory={} max_bytes={} ttl={}>".format(self.directory, self.max_bytes, self.ttl)
+
+    def filename(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self.filename(key), 'rb') as f:
+                return self.unpack(f.read())
+        except OSError:
+            return None
+
+    def set(self, key, mimetype, data):
+        filename = self.filename(key)
+        tmpfilename = filename + '.' + uuid.uuid4().hex
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(tmpfilename, 'wb') as f:
+                f.write(self.pack(mimetype, data))
+            os.rename(tmpfilename, filename)
+        except OSError as e:
+            print("Could not write tile to cache: {}".format(e))
+        self.schedule_sweep()
+
+    def schedule_sweep(self):
+        """
+        Start a sweep in the background when the last one in this worker
+        was more than `sweep_interval` seconds ago.
+        """
+        if not (self.max_bytes or self.ttl):
+            return
+        now = time.monotonic()
+        with self.lock:
+            if now < self.next_sweep:
+                return
+            self.next_sweep = now + self.sweep_interval
+        threading.Thread(target=self.sweep, daemon=True).start()
+
+    def sweep(self):
+        """
+        Remove expired tiles, and the oldest tiles until the cache is no
+        larger than `max_bytes`. Workers that find another one sweeping
+        skip their turn.
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, '.sweep'), 'w') as lock:
+                try:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return
+
+                now = time.time()
+                files = []
+                for subdirectory in os.scandir(self.directory):
+                    if not subdirectory.is_dir():
+                        continue
+                    for entry in os.scandir(subdirectory.path):
+                        try:
+                            stat = entry.stat()
+                            if self.ttl and now - stat.st_mtime > self.ttl:
+                                os.remove(entry.path)
+                            else:
+                                files.append((stat.st_mtime, stat.st_size, entry.path))
+                        except OSError:
+                            pass
+
+                size = sum(file_size for (_, file_size, _) in files)
+                if self.max_bytes and size > self.max_bytes:
+                    for (_, file_size, filename) in sorted(files):
+                        if size <= self.max_bytes:
+                            break
+                        try:
+                            os.remove(filename)
+                            size -= file_size
+                        except OSError:
+                            pass
+        except OSError as e:
+            print("Could not sweep tile cache: {}".format(e))
+
+
+class RedisTileCache(TileCache):
+    """
+    Cache that stores tiles in Redis with an expiry time, shared by all
+    workers.
+    """
+
+    shared = True
+
+    def __init__(self, ttl=86400, prefix='tile:'):
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def __repr__(self):
+        return "<RedisTileCache ttl={}>".format(self.ttl)
+
+    def get(self, key):
+        value = redis_store.get(self.prefix + key)
+        if value is None:
+            return None
+        return self.unpack(value)
+
+    def set(self, key, mimetype, data):
+        redis_store.set(self.prefix + key, self.pack(mimetype, data), ex=self.ttl)
+
+
+def create_tile_cache(config):
+    """
+    Create the tile cache configured by MAPDROP_TILE_CACHE.
+    """
+    backend = config.get('MAPDROP_TILE_CACHE', 'memory')
+    if backend == 'memory':
+        return MemoryTileCache(max_bytes=config.get('MAPDROP_TILE_CACHE_MAX_BYTES'))
+    if backend == 'disk':
+        directory = config.get('MAPDROP_TILE_CACHE_DIR') or os.path.join(config.get('MAPDROP_DATA'), '.mapdrop', 'tiles')
+        return DiskTileCache(directory, max_bytes=config.get('MAPDROP_TILE_CACHE_DISK_MAX_BYTES'), ttl=config.get('MAPDROP_TILE_CACHE_TTL'))
+    if backend == 'redis':
+        return RedisTileCache(ttl=config.get('MAPDROP_TILE_CACHE_TTL'))
+    if backend == 'none':
+        return TileCache()
+    raise Exception("Unknown tile cache: {}".format(backend))
+
+
+tile_cache = create_tile_cache(app.config)
+
+
+class MetadataCache(object):
+    """
+    Short-lived in-process cache of file metadata, so repeated requests for
+    a file in the same worker skip fetching and parsing it from Redis.
+    Entries are tied to the signature of the file, so a file that changes
+    on disk is never served with stale metadata.
+    """
+
+    def __init__(self, ttl=5, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, signature):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return None
+            expires, entry_signature, metadata = entry
+            if expires < time.monotonic() or entry_signature != signature:
+                del self.entries[path]
+                return None
+            return metadata
+
+    def set(self, path, signature, metadata):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            self.entries[path] = (time.monotonic() + self.ttl, signature, metadata)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, path):
+        with self.lock:
+            self.entries.pop(path, None)
+
+
+metadata_cache = MetadataCache(ttl=app.config.get('MAPDROP_METADATA_CACHE_TTL', 5))
+
+
+def generation(path):
+    """
+    Return the generation of a file. This counter is incremented every time
+    the file is uploaded or deleted, which changes the keys of all of its
+    tiles at once.
+    """
+    value = redis_store.get(path + '.generation')
+    return int(value) if value is not None else 0
+
+
+def invalidate(path):
+    """
+    Invalidate all cached tiles of a file in O(1) by bumping its generation.
+    """
+    metadata_cache.discard(path)
+    return redis_store.incr(path + '.generation')
+
+
+def tile_key(*args):
+    """
+    Return the cache key (and ETag) for a tile from a list of values that
+    can be serialized to JSON.
+    """
+    return hashlib.sha1(json.dumps(args, sort_keys=True).encode()).hexdigest()
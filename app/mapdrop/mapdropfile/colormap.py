@@ -0,0 +1,350 @@
+import functools
+
+import numpy as np
+
+# Values of 'min', 'avg', and 'max' in ranges when a band has no statistics
+FALLBACK_RANGE = {'min':0.0, 'avg':0.5, 'max':1.0}
+
+
+class Colormap(object):
+    """
+    Class that translates between our set of "mode", "ranges", and
+    "colormap" variables and a compiled color mapping.
+
+    The mapping is compiled into a palette of at most 256 RGBA colors, of
+    which the first one is transparent and used for nodata. Data is colored
+    by turning it into palette indices, either through a lookup table with
+    an entry for every possible value (8 and 16-bit integer data) or by
+    quantizing the values (other data), and then indexing the palette with
+    those indices in a single operation.
+
+    Use Colormap.compile() to get a memoised instance for a set of
+    normalised parameters.
+    """
+
+    def __init__(self, colormap='', ranges='', mode='', stats=None):
+        self.stats = stats
+        self.tables = {}
+
+        self.parse_mode(mode)
+        self.parse_colormap(colormap)
+        self.parse_ranges(ranges)
+        if self.mode != 'rgb':
+            self.palette = self.build_palette()
+            # The same palette with every color packed in a single uint32,
+            # which is a lot faster to index than the (n, 4) array.
+            self.packed_palette = self.palette.view(np.uint32).ravel()
+
+    def __repr__(self):
+        return "<Colormap mode={} ranges={} colormap={}>".format(self.mode, self.ranges, self.colormap)
+
+    @classmethod
+    @functools.lru_cache(maxsize=256)
+    def compile(cls, colormap='', ranges='', mode=''):
+        """
+        Return a memoised Colormap for parameters that were normalised with
+        Colormap.normalise(), so ranges no longer refer to the statistics.
+        """
+        return cls(colormap=colormap, ranges=ranges, mode=mode)
+
+    @staticmethod
+    def normalise(colormap='', ranges='', mode='', stats=None):
+        """
+        Return the mode, ranges, and colormap in a normalised form, so that
+        equivalent parameters (for example 'min,max' and the actual minimum
+        and maximum values) give the same result. Used to build cache keys.
+        """
+        if mode == 'rgb':
+            return {'mode':mode, 'ranges':'', 'colormap':''}
+
+        values = []
+        for r in ranges.split(","):
+            r = r.strip()
+            if r in ('avg', 'min', 'max'):
+                # Bands without any valid data have no statistics. Their
+                # tiles are transparent anyway, so any range will do.
+                value = (stats or {}).get(r)
+                values.append(value if value is not None else FALLBACK_RANGE[r])
+            else:
+                try:
+                    values.append(float(r))
+                except:
+                    pass
+
+        return {
+            'mode': mode,
+            'ranges': ','.join(repr(float(v)) for v in values),
+            'colormap': ','.join(c.strip() for c in colormap.split(','))
+        }
+
+    def parse_mode(self, mode):
+        if mode in ('discrete','linear','exact','rgb'):
+            self.mode = mode
+        else:
+            raise Exception("Invalid mode")
+
+    def parse_colormap(self, colormap):
+        self.cmap = None
+        self.colorlist = None
+        self.colormap = colormap
+
+        # Try to parse colormap as a matplotlib named colormap. Lists of
+        # colors can't be one, which saves importing matplotlib for them.
+        if ',' not in colormap:
+            try:
+                self.cmap = named_colormap(colormap)
+                return
+            except:
+                self.cmap = None
+
+        # Apparently something else was passed. Only option is
+        # a list of individual colors. Lets parse that then.
+        try:
+            from colour import Color
+            colorlist = []
+            for c in colormap.split(","):
+                colorlist.append(Color(c).rgb)
+
+            if self.mode != 'exact' and len(colorlist) < 2:
+                raise Exception("Need at least two colors in colormap.")
+            self.colorlist = np.array(colorlist, dtype=np.float64)
+            return
+        except:
+            self.colorlist = None
+
+        # If all else fails, fall back to 'Spectral'
+        self.cmap = named_colormap('Spectral')
+        return
+
+    def parse_ranges(self, ranges):
+        #TODO: check if stats are tehre
+        self.ranges = []
+        for r in ranges.split(","):
+            if r == 'avg':
+                self.ranges.append(self.stats.get("avg"))
+            elif r == 'min':
+                self.ranges.append(self.stats.get("min"))
+            elif r == 'max':
+                self.ranges.append(self.stats.get("max"))
+            else:
+                try:
+                    self.ranges.append(float(r))
+                except:
+                    pass
+
+    def colors(self, positions):
+        """
+        Return RGBA colors (uint8) at positions from 0 to 1 along the
+        colormap. Color lists are interpolated linearly.
+        """
+        if self.cmap is not None:
+            return self.cmap(positions, bytes=True)
+
+        steps = np.linspace(0, 1, len(self.colorlist))
+        rgba = np.full((len(positions), 4), 255, dtype=np.uint8)
+        for c in range(3):
+            rgba[:,c] = np.round(np.interp(positions, steps, self.colorlist[:,c]) * 255)
+        return rgba
+
+    def indexed_colors(self, indices):
+        """
+        Return RGBA colors (uint8) for the n-th colors of the colormap. Used
+        in exact mode, where each category gets the next color.
+        """
+        if self.cmap is not None:
+            return self.cmap(np.asarray(indices), bytes=True)
+
+        indices = np.minimum(indices, len(self.colorlist) - 1)
+        rgba = np.full((len(indices), 4), 255, dtype=np.uint8)
+        rgba[:,:3] = np.round(self.colorlist[indices] * 255)
+        return rgba
+
+    def build_palette(self):
+        """
+        Build the palette, with transparent nodata as its first color.
+        """
+        if self.mode == 'linear':
+            colors = self.colors(np.linspace(0, 1, 255))
+
+        elif self.mode == 'discrete':
+            regions = len(self.ranges) - 1
+            if regions < 1:
+                raise Exception("Need at least two ranges in discrete mode.")
+            if regions > 255:
+                raise Exception("Too many ranges in discrete mode.")
+            positions = np.linspace(0, 1, regions) if regions > 1 else np.array([0.5])
+            colors = self.colors(positions)
+
+        elif self.mode == 'exact':
+            if len(self.ranges) > 255:
+                raise Exception("Too many ranges in exact mode.")
+            colors = self.indexed_colors(np.arange(len(self.ranges)))
+
+        else:
+            raise Exception("Unknown mode")
+
+        palette = np.zeros((len(colors) + 1, 4), dtype=np.uint8)
+        palette[1:] = colors
+        return palette
+
+    def legend(self):
+        """
+        Return a description of every color in the palette, in the order of
+        the palette indices, with None for the nodata color. Linear colors
+        get the value at their center, discrete colors the range they cover,
+        and exact colors the category value.
+        """
+        if self.mode == 'rgb':
+            raise Exception("No legend in rgb mode.")
+
+        if getattr(self, '_legend', None) is None:
+            colors = ['#{:02x}{:02x}{:02x}'.format(*color[:3]) for color in self.palette[1:].tolist()]
+            legend = [None]
+            for i, color in enumerate(colors):
+                if self.mode == 'linear':
+                    lo, hi = self.ranges[0], self.ranges[-1]
+                    legend.append({'value':lo + i * (hi - lo) / 254.0, 'color':color})
+                elif self.mode == 'discrete':
+                    legend.append({'min':self.ranges[i], 'max':self.ranges[i+1], 'color':color})
+                elif self.mode == 'exact':
+                    legend.append({'value':self.ranges[i], 'color':color})
+            self._legend = legend
+        return self._legend
+
+    def quantize(self, data):
+        """
+        Return palette indices for data values, not taking nodata into
+        account.
+        """
+        if self.mode == 'linear':
+            lo, hi = self.ranges[0], self.ranges[-1]
+            scale = 254.0 / (hi - lo) if hi != lo else 0.0
+            ftype = data.dtype if data.dtype.kind == 'f' else np.float64
+            index = np.subtract(data, lo, dtype=ftype)
+            index *= scale
+            np.clip(index, 0, 254, out=index)
+            # Round to the nearest color, and skip the nodata color at 0
+            index += 1.5
+            with np.errstate(invalid='ignore'):
+                return index.astype(np.uint8)
+
+        elif self.mode == 'discrete':
+            regions = len(self.ranges) - 1
+            index = np.searchsorted(self.ranges, data, side='right') - 1
+            np.clip(index, 0, regions - 1, out=index)
+            return (index + 1).astype(np.uint8)
+
+        elif self.mode == 'exact':
+            index = np.zeros(data.shape, dtype=np.uint8)
+            if not self.ranges:
+                return index
+            categories = np.asarray(self.ranges)
+            order = np.argsort(categories, kind='stable')
+            ordered = categories[order]
+            position = np.clip(np.searchsorted(ordered, data), 0, len(ordered) - 1)
+            found = ordered[position] == data
+            index[found] = order[position[found]] + 1
+            return index
+
+        else:
+            raise Exception("Unknown mode")
+
+    def table(self, dtype, nodata=None):
+        """
+        Return a lookup table with the palette index of every possible value
+        of an 8 or 16-bit integer data type.
+        """
+        key = (dtype.str, nodata)
+        if key not in self.tables:
+            info = np.iinfo(dtype)
+            values = np.arange(info.min, info.max + 1, dtype=np.int64)
+            table = self.quantize(values.astype(np.float64))
+            if nodata is not None and info.min <= nodata <= info.max and float(nodata).is_integer():
+                table[int(nodata) - info.min] = 0
+            self.tables[key] = table
+        return self.tables[key]
+
+    def index(self, data, mask=None, nodata=None):
+        """
+        Return palette indices (uint8) for a 2D array of data, with nodata
+        and masked pixels at index 0.
+        """
+        dtype = data.dtype
+        if dtype.kind in 'iu' and dtype.itemsize <= 2:
+            table = self.table(dtype, nodata)
+            if dtype.kind == 'i':
+                index = np.take(table, data.astype(np.int32) - np.iinfo(dtype).min)
+            else:
+                index = np.take(table, data)
+        else:
+            index = self.quantize(data)
+            if nodata is not None:
+                index[data == nodata] = 0
+            if dtype.kind == 'f':
+                index[np.isnan(data)] = 0
+
+        if mask is not None:
+            index[mask] = 0
+        return index
+
+    def unmask(self, array, mask=None):
+        """
+        Return the data and mask of an array, which can be a masked array.
+        """
+        if np.ma.isMaskedArray(array):
+            if mask is None and array.mask is not np.ma.nomask:
+                mask = np.ma.getmaskarray(array)
+                mask = mask if mask.ndim == 2 else mask.any(axis=2)
+            array = array.data
+        return (array, mask)
+
+    def indices(self, array, mask=None, nodata=None):
+        """
+        Apply the settings to an array and return palette indices (uint8),
+        for formats that store the palette instead of the colors. Masked
+        pixels get the transparent nodata color. Not available in rgb mode.
+        """
+        if self.mode == 'rgb':
+            raise Exception("No palette in rgb mode.")
+        array, mask = self.unmask(array, mask)
+        data = array if array.ndim == 2 else array[:,:,0]
+        return self.index(data, mask=mask, nodata=nodata)
+
+    def rgba(self, array, mask=None, nodata=None):
+        """
+        Apply the settings to an array and return RGBA data (uint8).
+        Masked arrays are accepted as well, in which case masked pixels
+        become transparent.
+        """
+        if self.mode == 'rgb':
+            return self.rgb(*self.unmask(array, mask))
+
+        index = self.indices(array, mask=mask, nodata=nodata)
+        rgba = np.take(self.packed_palette, index)
+        return rgba.view(np.uint8).reshape(index.shape + (4,))
+
+    def rgb(self, array, mask=None):
+        """
+        Return RGBA data for 3-band data. 8-bit data is used as is, and
+        other data is expected to be in the 0..1 range.
+        """
+        rows, cols = array.shape[:2]
+        rgba = np.empty((rows, cols, 4), dtype=np.uint8)
+        if array.dtype == np.uint8:
+            rgba[:,:,:3] = array[:,:,:3]
+        else:
+            rgba[:,:,:3] = np.rint(np.clip(np.nan_to_num(array[:,:,:3]), 0, 1) * 255)
+        rgba[:,:,3] = 255
+        if mask is not None:
+            rgba[mask, 3] = 0
+        return rgba
+
+
+def named_colormap(name):
+    """
+    Return a matplotlib colormap by name. matplotlib takes a good part of a
+    second to import, so it is only imported once a named colormap is
+    first needed.
+    """
+    import matplotlib.cm
+    return matplotlib.cm.get_cmap(name)
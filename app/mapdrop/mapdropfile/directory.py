@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import threading
+
+from collections import OrderedDict
+
+from mapdrop import app, redis_store
+
+# Directories modified less than this many nanoseconds ago are not cached,
+# as entries added within the same mtime tick would go unnoticed.
+RACY_NS = 2 * 10**9
+
+SORT_KEYS = {
+    'name':lambda entry: entry['name'],
+    'size':lambda entry: entry['size'] if entry['type'] == 'file' else entry['children'],
+    'mtime':lambda entry: entry['mtime']
+}
+
+
+def summary_key(path):
+    return 'summaries:' + os.path.dirname(path)
+
+
+def summarize(metadata):
+    """
+    Return the summary of a file that is shown in directory listings, from
+    its metadata.
+    """
+    summary = {
+        'type':metadata.get('type'),
+        'epsg':metadata.get('epsg'),
+        'bounds':metadata.get('bounds')
+    }
+    if summary['type'] == 'raster':
+        summary.update({
+            'bands':len(metadata.get('layers', [])),
+            'width':metadata['raster']['width'],
+            'height':metadata['raster']['height']
+        })
+    elif summary['type'] == 'vector':
+        summary.update({
+            'layers':len(metadata.get('layers', [])),
+            'features':metadata['vector']['count']
+        })
+    return summary
+
+
+def store_summary(path, signature, metadata):
+    """
+    Store the summary of a file in the summaries of its directory, a hash
+    in Redis with a field for every file. The (mtime, size) signature of
+    the file is stored along with it, so summaries of files that changed
+    since are not shown.
+    """
+    summary = summarize(metadata)
+    summary['signature'] = list(signature[:2]) if signature else None
+    redis_store.hset(summary_key(path), os.path.basename(path), json.dumps(summary))
+
+
+def discard_summary(path):
+    redis_store.hdel(summary_key(path), os.path.basename(path))
+
+
+def summaries(directory, entries):
+    """
+    Add the stored summaries to the file entries of a directory listing,
+    with a single request to Redis.
+    """
+    files = [entry for entry in entries if entry['type'] == 'file']
+    if not files:
+        return entries
+    values = redis_store.hmget('summaries:' + directory.rstrip('/'), [entry['name'] for entry in files])
+    for entry, value in zip(files, values):
+        summary = json.loads(value) if value is not None else None
+        if summary is not None and summary.pop('signature', None) != entry['signature']:
+            summary = None
+        entry['summary'] = summary
+    return entries
+
+
+class Listing(object):
+    """
+    The entries of a directory, with the sort orders that were requested
+    so far.
+    """
+
+    def __init__(self, mtime, entries):
+        self.mtime = mtime
+        self.entries = entries
+        self.orders = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sorted(self, sort='name', reverse=False):
+        """
+        Return the entries sorted by name, size, or mtime. Directories
+        always come before files.
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError("Unknown sort order: {}".format(sort))
+        order = self.orders.get((sort, reverse))
+        if order is None:
+            key = SORT_KEYS[sort]
+            dirs = sorted((entry for entry in self.entries if entry['type'] == 'dir'), key=key, reverse=reverse)
+            files = sorted((entry for entry in self.entries if entry['type'] == 'file'), key=key, reverse=reverse)
+            order = self.orders[(sort, reverse)] = dirs + files
+        return order
+
+    def page(self, page=1, per_page=100, sort='name', reverse=False):
+        start = (page - 1) * per_page
+        return [dict(entry) for entry in self.sorted(sort, reverse)[start:start + per_page]]
+
+
+class DirectoryIndex(object):
+    """
+    Index of the directories below the data directory, so listings don't
+    hit the file system for every entry on every request.
+
+    Listings are made with a single os.scandir() pass over a directory and
+    cached in Redis and in each worker, along with the mtime of the
+    directory. Adding, removing, or renaming entries (which is how uploads
+    end up in place) changes that mtime, so a single stat is enough to
+    tell whether a cached listing is still valid. The number of entries of
+    subdirectories is checked against their own mtime in the same way.
+    """
+
+    def __init__(self, root, max_entries=256, prefix='dirindex:'):
+        self.root = root
+        self.max_entries = max_entries
+        self.prefix = prefix
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<DirectoryIndex directories={}>".format(len(self.entries))
+
+    def listing(self, directory):
+        """
+        Return the Listing of a directory (relative to the data directory).
+        """
+        directory = directory.rstrip('/')
+        fullpath = os.path.join(self.root, directory)
+        mtime = os.stat(fullpath).st_mtime_ns
+
+        with self.lock:
+            listing = self.entries.get(directory)
+            if listing is not None:
+                self.entries.move_to_end(directory)
+        if listing is None or listing.mtime != mtime:
+            listing = self.load(directory, mtime)
+        if listing is None:
+            listing = self.scan(directory, fullpath, mtime)
+        else:
+            self.refresh(directory, listing)
+        return listing
+
+    def load(self, directory, mtime):
+        value = redis_store.get(self.prefix + directory)
+        if value is None:
+            return None
+        value = json.loads(value)
+        if value['mtime'] != mtime:
+            return None
+        listing = Listing(mtime, value['entries'])
+        self.remember(directory, listing)
+        return listing
+
+    def save(self, directory, listing):
+        if time.time() * 1e9 - listing.mtime < RACY_NS:
+            return
+        redis_store.set(self.prefix + directory, json.dumps({'mtime':listing.mtime, 'entries':listing.entries}))
+        self.remember(directory, listing)
+
+    def remember(self, directory, listing):
+        with self.lock:
+            self.entries[directory] = listing
+            self.entries.move_to_end(directory)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def scan(self, directory, fullpath, mtime):
+        previous = self.entries.get(directory)
+        counts = {}
+        if previous is not None:
+            counts = {entry['name']:(entry['mtime_ns'], entry['children']) for entry in previous.entries if entry['type'] == 'dir'}
+
+        entries = []
+        with os.scandir(fullpath) as it:
+            for item in it:
+                # Hidden files hold temporary and cached data
+                if item.name.startswith('.'):
+                    continue
+                try:
+                    st = item.stat()
+                    if item.is_dir():
+                        count = counts.get(item.name)
+                        if count is None or count[0] != st.st_mtime_ns:
+                            count = (st.st_mtime_ns, self.count(os.path.join(fullpath, item.name)))
+                        entries.append({'name':item.name, 'type':'dir', 'mtime':st.st_mtime, 'mtime_ns':st.st_mtime_ns,
+                                        'children':count[1]})
+                    elif item.is_file():
+                        entries.append({'name':item.name, 'type':'file', 'mtime':st.st_mtime, 'size':st.st_size,
+                                        'signature':[st.st_mtime_ns, st.st_size]})
+                except OSError:
+                    # Removed while scanning
+                    continue
+
+        listing = Listing(mtime, entries)
+        self.save(directory, listing)
+        return listing
+
+    def refresh(self, directory, listing):
+        """
+        Update the number of entries of the subdirectories in a cached
+        listing, which can change without changing the mtime of the
+        directory itself.
+        """
+        changed = False
+        fullpath = os.path.join(self.root, directory)
+        for entry in listing.entries:
+            if entry['type'] != 'dir':
+                continue
+            try:
+                st = os.stat(os.path.join(fullpath, entry['name']))
+            except OSError:
+                continue
+            if st.st_mtime_ns != entry['mtime_ns']:
+                entry['mtime'] = st.st_mtime
+                entry['mtime_ns'] = st.st_mtime_ns
+                entry['children'] = self.count(os.path.join(fullpath, entry['name']))
+                changed = True
+        if changed:
+            listing.orders = {}
+            self.save(directory, listing)
+
+    def count(self, fullpath):
+        try:
+            with os.scandir(fullpath) as it:
+                return sum(1 for item in it if not item.name.startswith('.'))
+        except OSError:
+            return 0
+
+
+directory_index = DirectoryIndex(app.config.get('MAPDROP_DATA'), max_entries=app.config.get('MAPDROP_DIRECTORY_CACHE_ENTRIES', 256))
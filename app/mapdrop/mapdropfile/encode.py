@@ -0,0 +1,173 @@
+import zlib
+import base64
+import threading
+
+import numpy as np
+
+from io import BytesIO
+
+from mapdrop import app
+
+MIMETYPES = {
+    'png':'image/png',
+    'jpeg':'image/jpeg',
+    'webp':'image/webp',
+    'base64':'application/base64'
+}
+
+# zlib strategies for PNG compression, by the name used in the settings
+STRATEGIES = {
+    'default':zlib.Z_DEFAULT_STRATEGY,
+    'filtered':zlib.Z_FILTERED,
+    'huffman':zlib.Z_HUFFMAN_ONLY,
+    'rle':zlib.Z_RLE,
+    'fixed':zlib.Z_FIXED
+}
+
+# Encoded tiles of a single color, shared by all tiles that look the same
+uniform_tiles = {}
+uniform_lock = threading.Lock()
+MAX_UNIFORM_TILES = 1024
+
+
+class Indexed(object):
+    """
+    An image as palette indices (uint8) and the RGBA palette they index.
+    Colormapped tiles are kept in this form until they are encoded, so they
+    can be written as palette PNGs. Slicing works as on an RGBA array.
+    """
+
+    def __init__(self, index, palette):
+        self.index = index
+        self.palette = palette
+
+    def __repr__(self):
+        return "<Indexed shape={} colors={}>".format(self.index.shape, len(self.palette))
+
+    def __getitem__(self, key):
+        return Indexed(self.index[key], self.palette)
+
+    @property
+    def shape(self):
+        return self.index.shape
+
+    def rgba(self):
+        packed = self.palette.view(np.uint32).ravel()
+        return np.take(packed, self.index).view(np.uint8).reshape(self.index.shape + (4,))
+
+
+def png_options():
+    """
+    Return the PNG options of the settings: whether colormapped tiles are
+    written as palette PNGs, the zlib level, and the zlib strategy.
+    """
+    strategy = app.config.get('MAPDROP_PNG_STRATEGY', 'default')
+    if strategy not in STRATEGIES:
+        raise Exception("Unknown PNG strategy: {}".format(strategy))
+    return [bool(app.config.get('MAPDROP_PNG_PALETTE', True)), int(app.config.get('MAPDROP_PNG_COMPRESS_LEVEL', 6)), strategy]
+
+
+def uniform_color(image):
+    """
+    Return the RGBA color of an image that has a single color, or None.
+    """
+    if isinstance(image, Indexed):
+        index = image.index.ravel()
+        if index.size and (index == index[0]).all():
+            return tuple(image.palette[index[0]].tolist())
+        return None
+    packed = np.ascontiguousarray(image).view(np.uint32).ravel()
+    if packed.size and (packed == packed[0]).all():
+        return tuple(image[0, 0].tolist())
+    return None
+
+
+def encode(image, format, params):
+    """
+    Encode an image (an RGBA array or Indexed) into a tile of the requested
+    format, and return a tuple of its mimetype and content. Tiles of a
+    single color, like fully transparent ones, are encoded once and then
+    shared.
+    """
+    if format not in MIMETYPES:
+        raise Exception("Unknown format")
+
+    color = uniform_color(image)
+    if color is not None:
+        key = (format, image.shape[:2], color, repr(sorted(params.items())))
+        content = uniform_tiles.get(key)
+        if content is None:
+            content = encode_image(Indexed(np.zeros(image.shape[:2], dtype=np.uint8), np.array([color], dtype=np.uint8)), format, params)
+            with uniform_lock:
+                if len(uniform_tiles) >= MAX_UNIFORM_TILES:
+                    uniform_tiles.clear()
+                uniform_tiles[key] = content
+        return (MIMETYPES[format], content)
+
+    return (MIMETYPES[format], encode_image(image, format, params))
+
+
+def encode_image(image, format, params):
+    # PIL is imported on first use, which keeps it out of worker startup
+    from PIL import Image, features
+
+    data = BytesIO()
+    if format == 'png':
+        write_png(image, data, params)
+        return data.getvalue()
+
+    elif format == 'base64':
+        # Encode straight from the PNG buffer, without copying it first
+        write_png(image, data, params)
+        return b"data:image/png;base64," + base64.b64encode(data.getbuffer())
+
+    elif format == 'jpeg':
+        rgba = image.rgba() if isinstance(image, Indexed) else image
+        im = Image.fromarray(np.ascontiguousarray(rgba[:,:,:3]), mode='RGB')
+        im.save(data, format="JPEG", quality=params['quality'], optimize=True, progressive=True)
+        return data.getvalue()
+
+    elif format == 'webp':
+        if not features.check('webp'):
+            raise Exception("WebP is not supported by this installation.")
+        rgba = image.rgba() if isinstance(image, Indexed) else image
+        im = Image.fromarray(rgba, mode='RGBA')
+        im.save(data, format="WEBP", quality=params['quality'], lossless=params['lossless'],
+                method=app.config.get('MAPDROP_WEBP_METHOD', 4))
+        return data.getvalue()
+
+
+def write_png(image, f, params):
+    """
+    Write an image as PNG. Indexed images are written as palette PNGs with
+    only the colors that occur in the image, so tiles with few colors get
+    1, 2, or 4 bits per pixel, and transparency in a tRNS chunk.
+    """
+    from PIL import Image
+
+    palette, level, strategy = params.get('png') or png_options()
+    options = {'compress_level':level, 'compress_type':STRATEGIES[strategy]}
+
+    if not isinstance(image, Indexed):
+        Image.fromarray(image, mode='RGBA').save(f, format="PNG", **options)
+        return
+    if not palette:
+        Image.fromarray(image.rgba(), mode='RGBA').save(f, format="PNG", **options)
+        return
+
+    used = np.flatnonzero(np.bincount(image.index.ravel(), minlength=len(image.palette)))
+    lookup = np.zeros(max(len(image.palette), 256), dtype=np.uint8)
+    lookup[used] = np.arange(len(used))
+    colors = image.palette[used]
+
+    im = Image.fromarray(np.take(lookup, image.index), mode='P')
+    im.putpalette(colors[:,:3].tobytes())
+
+    # The transparency of the colors up to the last one that isn't opaque
+    alpha = colors[:,3]
+    transparent = np.flatnonzero(alpha < 255)
+    if len(transparent):
+        options['transparency'] = alpha[:transparent[-1] + 1].tobytes()
+
+    bits = 1 if len(used) <= 2 else 2 if len(used) <= 4 else 4 if len(used) <= 16 else 8
+    im.save(f, format="PNG", bits=bits, **options)
@@ -0,0 +1,332 @@
+import os
+import json
+import time
+import uuid
+import queue
+import threading
+
+from mapdrop import app, redis_store
+
+from .overviews import run_overviews, update_metadata
+from .optimize import optimize
+
+# Tasks of a full ingest job, in the order in which they run. Rasters are
+# converted to Cloud Optimized GeoTIFFs first when MAPDROP_OPTIMIZE is cog.
+TASKS = ['metadata', 'overviews']
+if app.config.get('MAPDROP_OPTIMIZE') == 'cog':
+    TASKS = ['optimize'] + TASKS
+
+
+class JobPending(Exception):
+    """
+    Raised when the metadata of a file is needed while its ingest job has
+    not finished yet.
+    """
+
+    def __init__(self, path, job):
+        Exception.__init__(self, "File {} is still being processed.".format(path))
+        self.path = path
+        self.job = job
+
+
+class JobFailed(Exception):
+    """
+    Raised when the metadata of a file is needed while the last ingest job
+    of this version of the file failed.
+    """
+
+    def __init__(self, path, job):
+        Exception.__init__(self, "File {} could not be processed: {}".format(path, job.get('error')))
+        self.path = path
+        self.job = job
+
+
+# Sets the job state of a file only when it is still the same as before
+replace_script = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        redis.call('set', KEYS[1], ARGV[2])
+        return 1
+    end
+    return 0
+"""
+
+
+def job_state(path):
+    """
+    Return the state of the last ingest job of a file, or None.
+    """
+    value = redis_store.get(path + '.job')
+    return json.loads(value) if value is not None else None
+
+
+def set_job_state(path, state, tasks=None, error=None, if_missing=False, replace=None, signature=None, owner=None):
+    """
+    Store the state (pending, processing, ready, or failed) of the ingest
+    job of a file, both on its own and in the metadata of the file. With
+    `if_missing` the state is only stored when the file has no job state
+    yet, and with `replace` only when the state is still that job state
+    (as returned by job_state()). None is returned when it isn't stored.
+
+    Finished jobs record the (mtime, size) `signature` of the file they
+    processed. Jobs of a queue that lives in a web worker record the
+    `owner` queue, see MemoryJobQueue.
+    """
+    job = {'state':state, 'tasks':tasks, 'error':error, 'updated':time.time(), 'signature':signature}
+    if owner is not None:
+        job['owner'] = owner
+    if replace is not None:
+        stored = redis_store.eval(replace_script, 1, path + '.job', json.dumps(replace), json.dumps(job))
+    else:
+        stored = redis_store.set(path + '.job', json.dumps(job), nx=if_missing or None)
+    if not stored:
+        return None
+    update_metadata(path, job=job)
+    return job
+
+
+def file_signature(path):
+    """
+    Return the (mtime, size) signature of a file as a list, as it is
+    stored in job states, or None when the file doesn't exist.
+    """
+    try:
+        st = os.stat(os.path.join(app.config.get('MAPDROP_DATA'), path))
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def run_task(mf, task):
+    if task == 'optimize':
+        if mf.is_raster:
+            optimize(mf.path, mf.fullpath)
+    elif task == 'metadata':
+        mf.ds.create_metadata()
+    elif task == 'overviews':
+        if mf.is_raster and mf.ds.create_metadata().get('overviews', {}).get('state') == 'pending':
+            run_overviews(mf.path)
+    else:
+        raise Exception("Unknown task: {}".format(task))
+
+
+def run_job(job):
+    """
+    Run the tasks of an ingest job, keeping track of its state.
+    """
+    # Imported here, as the file classes need this module themselves
+    from . import MapdropFile
+
+    path = job['path']
+    set_job_state(path, 'processing', tasks=job['tasks'], owner=job.get('owner'))
+    try:
+        for task in job['tasks']:
+            # Opened again for every task, as a task can change the file
+            # that is read (see optimize()). Jobs can run in threads of a
+            # web worker (see MemoryJobQueue), so they don't use the
+            # dataset pool of the worker.
+            run_task(MapdropFile(path, pooled=False), task)
+    except Exception as e:
+        print("Job for {} failed: {}".format(path, e))
+        return set_job_state(path, 'failed', tasks=job['tasks'], error=str(e), signature=file_signature(path))
+    return set_job_state(path, 'ready', tasks=job['tasks'], signature=file_signature(path))
+
+
+class JobQueue(object):
+    """
+    Base class for the ingest job queues. Jobs are dicts with the path of a
+    file and the list of tasks to run for it.
+    """
+
+    def enqueue(self, path, tasks=None, if_missing=False, replace=None):
+        """
+        Queue a job and return its state. With `if_missing` the job is only
+        queued when the file has no job yet, and with `replace` only when
+        the state of its last job is still `replace`, so many requests for
+        a file that needs a job queue a single one.
+        """
+        job = {'id':uuid.uuid4().hex, 'path':path, 'tasks':list(tasks or TASKS), 'owner':self.owner()}
+        state = set_job_state(path, 'pending', tasks=job['tasks'], if_missing=if_missing, replace=replace, owner=job['owner'])
+        if state is None:
+            return job_state(path)
+        self.push(job)
+        return state
+
+    def owner(self):
+        """
+        Return the id that jobs of this queue record as their owner, or
+        None when jobs outlive the process that queued them.
+        """
+        return None
+
+    def push(self, job):
+        raise NotImplementedError
+
+    def dequeue(self, timeout=5):
+        raise NotImplementedError
+
+    def done(self, job):
+        pass
+
+
+class MemoryJobQueue(JobQueue):
+    """
+    In-process stand-in for the Redis queue, for development and tests.
+    Jobs are run by a few daemon threads in the web worker itself, which
+    are started on the first job so they are never inherited over a fork.
+
+    Jobs are lost when the worker stops, so the queue gets an id that its
+    jobs record as their owner, and keeps a key in Redis alive for as long
+    as the worker runs. Jobs whose owner is gone are queued again (see
+    ingest()).
+    """
+
+    def __init__(self, threads=2, ttl=10):
+        self.threads = threads
+        self.ttl = ttl
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pid = None
+        self.id = None
+
+    def __repr__(self):
+        return "<MemoryJobQueue jobs={}>".format(self.queue.qsize())
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.id = uuid.uuid4().hex
+            self.queue = queue.Queue()
+            self.beat()
+            threading.Thread(target=self.keep_alive, daemon=True).start()
+            for n in range(self.threads):
+                threading.Thread(target=self.work, daemon=True).start()
+
+    def owner(self):
+        self.start()
+        return self.id
+
+    def beat(self):
+        redis_store.set(owner_key(self.id), self.pid, px=int(self.ttl*1000))
+
+    def keep_alive(self):
+        while True:
+            time.sleep(self.ttl / 3.0)
+            try:
+                self.beat()
+            except Exception as e:
+                print("Could not renew job queue {}: {}".format(self.id, e))
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                run_job(job)
+            finally:
+                self.done(job)
+
+    def push(self, job):
+        self.start()
+        self.queue.put(job)
+
+    def dequeue(self, timeout=5):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class RedisJobQueue(JobQueue):
+    """
+    Persistent queue in Redis, processed by separate worker processes (see
+    mapdrop.worker). A job that is taken from the queue is moved to a list
+    of jobs in progress in the same operation, and only removed from there
+    when it is done, so jobs of a worker that dies are not lost but put
+    back on the queue with recover().
+    """
+
+    def __init__(self, name='jobs'):
+        self.pending = name + ':pending'
+        self.processing = name + ':processing'
+
+    def __repr__(self):
+        return "<RedisJobQueue pending={}>".format(self.pending)
+
+    def push(self, job):
+        redis_store.lpush(self.pending, json.dumps(job))
+
+    def dequeue(self, timeout=5):
+        value = redis_store.brpoplpush(self.pending, self.processing, timeout=timeout)
+        if value is None:
+            return None
+        job = json.loads(value)
+        job['raw'] = value
+        return job
+
+    def done(self, job):
+        redis_store.lrem(self.processing, 1, job['raw'])
+
+    def recover(self):
+        """
+        Put jobs that were in progress when the workers stopped back on the
+        queue. Only to be called when no workers are running.
+        """
+        count = 0
+        while redis_store.rpoplpush(self.processing, self.pending) is not None:
+            count += 1
+        return count
+
+
+def owner_key(owner):
+    return 'jobs:owner:' + owner
+
+
+def is_lost(job):
+    """
+    Return whether a pending or processing job was lost, because the
+    worker whose queue it was in has stopped.
+    """
+    owner = job.get('owner')
+    return job['state'] in ('pending', 'processing') and owner is not None and not redis_store.exists(owner_key(owner))
+
+
+def create_job_queue(config):
+    """
+    Create the job queue configured by MAPDROP_JOBS.
+    """
+    backend = config.get('MAPDROP_JOBS', 'memory')
+    if backend == 'memory':
+        return MemoryJobQueue(threads=config.get('MAPDROP_JOB_THREADS', 2))
+    if backend == 'redis':
+        return RedisJobQueue()
+    raise Exception("Unknown job queue: {}".format(backend))
+
+
+job_queue = create_job_queue(app.config)
+
+
+def enqueue(path, tasks=None, if_missing=False, replace=None):
+    """
+    Queue an ingest job for a file, see JobQueue.enqueue().
+    """
+    return job_queue.enqueue(path, tasks=tasks, if_missing=if_missing, replace=replace)
+
+
+def ingest(path, signature):
+    """
+    Return the state of the ingest job of a file whose metadata is not
+    available, with (mtime, size, ...) `signature`. A job is queued for
+    files that were never ingested, whose job was lost, whose job finished
+    without leaving metadata behind, or whose job failed on an earlier
+    version of the file. A failed job is not run again until the file
+    changes.
+    """
+    job = job_state(path)
+    if job is None:
+        # Only None when the state was removed again right away
+        return enqueue(path, if_missing=True) or {'state':'pending', 'tasks':None, 'error':None}
+    changed = signature is not None and job.get('signature') != list(signature[:2])
+    if job['state'] == 'ready' or (job['state'] == 'failed' and changed) or is_lost(job):
+        return enqueue(path, replace=job) or job_state(path) or job
+    return job
@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import time
+import bisect
+import threading
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context
+
+from mapdrop import app, redis_store
+
+# Upper bounds (in seconds) of the buckets of the latency histograms
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics(object):
+    """
+    Latency histograms per endpoint and stage, and hit and miss counters of
+    the caches. Observations are aggregated in each process. When `shared`
+    they are added to hashes in Redis every `flush_interval` seconds, so
+    the totals cover all worker processes.
+    """
+
+    def __init__(self, shared=True, flush_interval=1.0, prefix='metrics:'):
+        self.shared = shared
+        self.flush_interval = flush_interval
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.flushed = time.monotonic()
+        self.clear()
+
+    def __repr__(self):
+        return "<Metrics shared={} histograms={}>".format(self.shared, len(self.histograms))
+
+    def clear(self):
+        self.histograms = defaultdict(lambda: [0] * (len(BUCKETS) + 1))
+        self.sums = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    def observe(self, endpoint, stage, seconds):
+        with self.lock:
+            self.histograms[(endpoint, stage)][bisect.bisect_left(BUCKETS, seconds)] += 1
+            self.sums[(endpoint, stage)] += seconds
+        self.maybe_flush()
+
+    def count(self, cache, result, n=1):
+        with self.lock:
+            self.counters[(cache, result)] += n
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if self.shared and time.monotonic() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Add the observations of this process to the totals in Redis.
+        """
+        with self.lock:
+            histograms, sums, counters = self.histograms, self.sums, self.counters
+            self.clear()
+            self.flushed = time.monotonic()
+        if not (histograms or counters):
+            return
+
+        pipeline = redis_store.pipeline(transaction=False)
+        for (endpoint, stage), buckets in histograms.items():
+            field = '{}|{}'.format(endpoint, stage)
+            for n, value in enumerate(buckets):
+                if value:
+                    pipeline.hincrby(self.prefix + 'histograms', '{}|{}'.format(field, n), value)
+            pipeline.hincrbyfloat(self.prefix + 'histograms', field + '|sum', sums[(endpoint, stage)])
+        for (cache, result), value in counters.items():
+            pipeline.hincrby(self.prefix + 'counters', '{}|{}'.format(cache, result), value)
+        try:
+            pipeline.execute()
+        except Exception as e:
+            # Metrics must never break a request, so these are dropped
+            print("Could not store metrics: {}".format(e))
+
+    def collect(self):
+        """
+        Return the (histograms, sums, counters) totals, of all processes
+        when the metrics are shared.
+        """
+        if not self.shared:
+            with self.lock:
+                return ({key:list(value) for (key, value) in self.histograms.items()}, dict(self.sums), dict(self.counters))
+
+        self.flush()
+        histograms = defaultdict(lambda: [0] * (len(BUCKETS) + 1))
+        sums = {}
+        for field, value in redis_store.hgetall(self.prefix + 'histograms').items():
+            endpoint, stage, n = field.decode().rsplit('|', 2)
+            if n == 'sum':
+                sums[(endpoint, stage)] = float(value)
+            else:
+                histograms[(endpoint, stage)][int(n)] = int(value)
+        counters = {}
+        for field, value in redis_store.hgetall(self.prefix + 'counters').items():
+            cache, result = field.decode().rsplit('|', 1)
+            counters[(cache, result)] = int(value)
+        return (dict(histograms), sums, counters)
+
+    def render(self):
+        """
+        Return the totals in the Prometheus text format.
+        """
+        histograms, sums, counters = self.collect()
+        lines = [
+            '# HELP mapdrop_stage_seconds Time spent in each stage of handling a request.',
+            '# TYPE mapdrop_stage_seconds histogram'
+        ]
+        for (endpoint, stage) in sorted(histograms):
+            labels = 'endpoint="{}",stage="{}"'.format(endpoint, stage)
+            total = 0
+            for n, value in enumerate(histograms[(endpoint, stage)]):
+                total += value
+                le = '{}'.format(BUCKETS[n]) if n < len(BUCKETS) else '+Inf'
+                lines.append('mapdrop_stage_seconds_bucket{{{},le="{}"}} {}'.format(labels, le, total))
+            lines.append('mapdrop_stage_seconds_sum{{{}}} {}'.format(labels, sums.get((endpoint, stage), 0.0)))
+            lines.append('mapdrop_stage_seconds_count{{{}}} {}'.format(labels, total))
+
+        lines.append('# HELP mapdrop_cache_requests_total Lookups in the caches, by result.')
+        lines.append('# TYPE mapdrop_cache_requests_total counter')
+        for (cache, result) in sorted(counters):
+            lines.append('mapdrop_cache_requests_total{{cache="{}",result="{}"}} {}'.format(cache, result, counters[(cache, result)]))
+
+        lines.append('# HELP mapdrop_cache_hit_ratio Fraction of the lookups in the caches that were hits.')
+        lines.append('# TYPE mapdrop_cache_hit_ratio gauge')
+        for cache in sorted(set(cache for (cache, _) in counters)):
+            hits = counters.get((cache, 'hit'), 0)
+            lookups = hits + counters.get((cache, 'miss'), 0)
+            if lookups:
+                lines.append('mapdrop_cache_hit_ratio{{cache="{}"}} {}'.format(cache, hits / lookups))
+        return '\n'.join(lines) + '\n'
+
+
+class Sampler(object):
+    """
+    Opt-in sampling profiler. While requests are running, a single thread
+    per process records the stack of every thread that handles one each
+    `interval` seconds. The samples of the `keep` slowest requests are
+    stored in Redis as collapsed stacks, the input format of flamegraph.pl
+    and speedscope.
+    """
+
+    def __init__(self, interval=0.005, keep=10, key='metrics:profiles'):
+        self.interval = interval
+        self.keep = keep
+        self.key = key
+        self.active = {}
+        self.threshold = 0.0
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def __repr__(self):
+        return "<Sampler keep={} active={}>".format(self.keep, len(self.active))
+
+    def start(self):
+        # The thread is started on first use, so it is never inherited
+        # over a fork.
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.active = {}
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, stacks in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[self.collapse(frame)] += 1
+
+    def collapse(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def begin(self):
+        self.start()
+        with self.lock:
+            self.active[threading.get_ident()] = Counter()
+
+    def end(self, duration, url):
+        """
+        Stop sampling the current thread, and store the samples when the
+        request was one of the slowest so far.
+        """
+        with self.lock:
+            stacks = self.active.pop(threading.get_ident(), None)
+        # Most requests are faster than the slowest ones kept so far, which
+        # is known without asking Redis after the first few.
+        if not stacks or duration <= self.threshold:
+            return
+        profiles = self.profiles()
+        if len(profiles) >= self.keep and profiles[-1]['duration'] >= duration:
+            self.threshold = profiles[-1]['duration']
+            return
+        profiles.append({
+            'url':url,
+            'duration':duration,
+            'time':time.time(),
+            'samples':sum(stacks.values()),
+            'stacks':'\n'.join('{} {}'.format(stack, n) for (stack, n) in stacks.most_common())
+        })
+        profiles = sorted(profiles, key=lambda profile: profile['duration'], reverse=True)[:self.keep]
+        if len(profiles) >= self.keep:
+            self.threshold = profiles[-1]['duration']
+        pipeline = redis_store.pipeline()
+        pipeline.delete(self.key)
+        pipeline.rpush(self.key, *[json.dumps(profile) for profile in profiles])
+        pipeline.execute()
+
+    def profiles(self):
+        """
+        Return the stored profiles, slowest first.
+        """
+        return [json.loads(value) for value in redis_store.lrange(self.key, 0, -1)]
+
+
+def create_metrics(config):
+    """
+    Create the metrics configured by MAPDROP_METRICS.
+    """
+    backend = config.get('MAPDROP_METRICS', 'redis')
+    if backend not in ('redis', 'memory', 'none'):
+        raise Exception("Unknown metrics backend: {}".format(backend))
+    if backend == 'none':
+        return None
+    return Metrics(shared=backend == 'redis', flush_interval=config.get('MAPDROP_METRICS_FLUSH_INTERVAL', 1.0))
+
+
+metrics = create_metrics(app.config)
+
+sampler = None
+if app.config.get('MAPDROP_PROFILE_SLOWEST'):
+    sampler = Sampler(interval=app.config.get('MAPDROP_PROFILE_INTERVAL', 0.005), keep=app.config.get('MAPDROP_PROFILE_SLOWEST'))
+
+
+def record(stage, seconds):
+    """
+    Record the time spent in a stage, for the Server-Timing header of the
+    current request and for the histograms.
+    """
+    if has_request_context():
+        timings = g.setdefault('timings', {})
+        timings[stage] = timings.get(stage, 0.0) + seconds
+        endpoint = request.endpoint or 'none'
+    else:
+        endpoint = 'background'
+    if metrics is not None:
+        metrics.observe(endpoint, stage, seconds)
+
+
+@contextmanager
+def timed(stage):
+    """
+    Time the code in a with block as `stage`. A stage that runs several
+    times in a request (like encoding the tiles of a metatile) is reported
+    as the total.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def count(cache, hit):
+    """
+    Count a hit or a miss of a cache.
+    """
+    if metrics is not None:
+        metrics.count(cache, 'hit' if hit else 'miss')
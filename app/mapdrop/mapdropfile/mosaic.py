@@ -0,0 +1,169 @@
+import os
+import json
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+import mercantile
+
+from mapdrop import app, redis_store
+
+from .rtree import PackedRTree
+from .stats import combine_stats
+from .directory import directory_index
+from .jobs import ingest
+
+
+class MosaicIndex(object):
+    """
+    Index of the rasters in a directory that is served as a single layer.
+    The members are found in the directory index, and their envelopes and
+    statistics are taken from the metadata in Redis, so building the index
+    never opens a file. The index is updated incrementally: only files that
+    were added or changed since the last update are looked up, and files
+    whose metadata isn't ready yet are looked up again on every update.
+
+    Rasters that don't have the band count and data type of the first
+    member are left out.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.files = {}
+        self.members = {}
+        self.pending = set()
+        self.tree = None
+        self.names = []
+        self.metadata = None
+        self.signature = None
+
+    def __repr__(self):
+        return "<MosaicIndex directory={} members={} pending={}>".format(self.directory, len(self.members), len(self.pending))
+
+    def refresh(self):
+        with self.lock:
+            listing = directory_index.listing(self.directory)
+            if listing.mtime == self.mtime and not self.pending:
+                return
+            files = {entry['name']:entry['signature'] for entry in listing.entries if entry['type'] == 'file'}
+            changed = set(name for (name, signature) in files.items() if self.files.get(name) != signature)
+            removed = set(self.files) - set(files)
+            lookup = sorted(changed | (self.pending & set(files)))
+
+            for name in removed:
+                self.members.pop(name, None)
+                self.pending.discard(name)
+
+            if lookup:
+                paths = [os.path.join(self.directory, name) for name in lookup]
+                for name, path, value in zip(lookup, paths, redis_store.mget(paths)):
+                    self.members.pop(name, None)
+                    self.pending.discard(name)
+                    if value is None:
+                        # Files that were never ingested are queued, and
+                        # added once their job has finished.
+                        job = ingest(path, files[name])
+                        if job['state'] in ('pending', 'processing'):
+                            self.pending.add(name)
+                        continue
+                    metadata = json.loads(value)
+                    if metadata.get('type') == 'raster' and metadata.get('bounds'):
+                        self.members[name] = self.member(metadata, files[name])
+
+            self.mtime = listing.mtime
+            self.files = files
+            if changed or removed or lookup:
+                self.build()
+
+    def member(self, metadata, signature):
+        west, south, east, north = metadata['bounds']
+        left, bottom = mercantile.xy(west, max(south, -85.051128))
+        right, top = mercantile.xy(east, min(north, 85.051128))
+        return {
+            'signature':signature,
+            'bounds':metadata['bounds'],
+            'xy_bounds':[left, bottom, right, top],
+            'layers':metadata['layers']
+        }
+
+    def build(self):
+        """
+        Rebuild the R-tree over the envelopes of the members, and the
+        metadata of the mosaic as a whole.
+        """
+        from shapely.geometry import box
+
+        members = sorted(self.members.items())
+        if members:
+            first = members[0][1]['layers']
+            members = [(name, member) for (name, member) in members
+                       if len(member['layers']) == len(first) and member['layers'][0]['datatype'] == first[0]['datatype']]
+
+        self.names = [name for (name, member) in members]
+        self.tree = PackedRTree.build([member['xy_bounds'] for (name, member) in members], list(range(len(members))))
+        self.signature = hashlib.sha1(json.dumps([(name, member['signature']) for (name, member) in members]).encode()).hexdigest()
+
+        if not members:
+            self.metadata = None
+            return
+
+        layers = []
+        for b, layer in enumerate(first):
+            layers.append({
+                'datatype':layer['datatype'],
+                'nodata':layer['nodata'],
+                'name':layer['name'],
+                'stats':combine_stats([member['layers'][b]['stats'] for (name, member) in members])
+            })
+        bounds = [min(member['bounds'][0] for (name, member) in members),
+                  min(member['bounds'][1] for (name, member) in members),
+                  max(member['bounds'][2] for (name, member) in members),
+                  max(member['bounds'][3] for (name, member) in members)]
+        envelope = box(*bounds)
+        self.metadata = {
+            'type':'mosaic',
+            'files':self.names,
+            'pending':sorted(self.pending),
+            'layers':layers,
+            'extent':envelope.wkt,
+            'envelope':envelope.wkt,
+            'bounds':bounds,
+            'epsg':None,
+            'gdal_metadata':{},
+            'overviews':{'state':'none', 'factors':[]}
+        }
+
+    def query(self, bounds):
+        """
+        Return the names of the members that intersect pseudomercator
+        (left, bottom, right, top) `bounds`.
+        """
+        if self.tree is None:
+            return []
+        return [self.names[i] for i in self.tree.query(bounds).tolist()]
+
+
+# Indexes of the last MAPDROP_MOSAIC_CACHE_ENTRIES mosaics used by this worker
+indexes = OrderedDict()
+indexes_lock = threading.Lock()
+
+
+def mosaic_index(directory):
+    """
+    Return the up to date MosaicIndex of a directory, which is kept in the
+    worker between requests.
+    """
+    directory = directory.rstrip('/')
+    with indexes_lock:
+        index = indexes.get(directory)
+        if index is None:
+            index = indexes[directory] = MosaicIndex(directory)
+            while len(indexes) > app.config.get('MAPDROP_MOSAIC_CACHE_ENTRIES', 64):
+                indexes.popitem(last=False)
+        else:
+            indexes.move_to_end(directory)
+    index.refresh()
+    return index
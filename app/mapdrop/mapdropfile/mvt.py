@@ -0,0 +1,209 @@
+import struct
+
+import numpy as np
+
+# Geometry types of Mapbox Vector Tile features
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+
+def varints(values):
+    """
+    Encode an array of unsigned integers as concatenated protobuf varints,
+    seven bits at a time for all values at once.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if values.size == 0:
+        return b''
+    groups = []
+    remaining = values
+    while True:
+        groups.append((remaining & np.uint64(0x7f)).astype(np.uint8))
+        remaining = remaining >> np.uint64(7)
+        if not remaining.any():
+            break
+    groups = np.column_stack(groups)
+
+    # Number of bytes of every value, and the continuation bits
+    lengths = np.ones(len(values), dtype=np.int64)
+    for n in range(1, groups.shape[1]):
+        lengths[values >= np.uint64(1 << (7 * n))] = n + 1
+    position = np.arange(groups.shape[1])
+    groups[position < (lengths[:,None] - 1)] |= 0x80
+    return groups[position < lengths[:,None]].tobytes()
+
+
+def varint(value):
+    return varints([value])
+
+
+def zigzag(values):
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def message(field, data):
+    """
+    Encode a length delimited field (string, bytes, message, packed).
+    """
+    return varint((field << 3) | 2) + varint(len(data)) + data
+
+
+def uint(field, value):
+    return varint(field << 3) + varint(value)
+
+
+def encode_value(value):
+    """
+    Encode a tag value as a Value message.
+    """
+    if isinstance(value, bool):
+        return uint(7, int(value))
+    if isinstance(value, int):
+        if value < 0:
+            return uint(6, int(zigzag([value])[0]))
+        return uint(5, value)
+    if isinstance(value, float):
+        return varint((3 << 3) | 1) + struct.pack('<d', value)
+    return message(1, str(value).encode())
+
+
+def ring_area(ring):
+    """
+    Return twice the signed area of a ring in tile coordinates, positive
+    when the ring is clockwise on screen (y pointing down).
+    """
+    x = ring[:,0]
+    y = ring[:,1]
+    return np.sum(x[:-1] * y[1:] - x[1:] * y[:-1]) + x[-1] * y[0] - x[0] * y[-1]
+
+
+def dedupe(part):
+    """
+    Remove consecutive duplicate points, which quantization to tile
+    coordinates leaves behind in simplified geometries.
+    """
+    if len(part) < 2:
+        return part
+    keep = np.ones(len(part), dtype=bool)
+    keep[1:] = np.any(part[1:] != part[:-1], axis=1)
+    return part[keep]
+
+
+def encode_geometry(geom_type, parts):
+    """
+    Encode the parts of a geometry, each an (n, 2) array of integer tile
+    coordinates, as a list of command integers. Polygon parts are lists of
+    rings of which the first is the exterior. Returns None when nothing is
+    left of the geometry after dropping degenerate parts.
+    """
+    commands = []
+    cursor = np.zeros(2, dtype=np.int64)
+
+    def path(points, close):
+        nonlocal cursor
+        deltas = np.diff(np.vstack((cursor, points)), axis=0)
+        params = zigzag(deltas).ravel()
+        commands.append(np.array([MOVE_TO | (1 << 3)], dtype=np.uint64))
+        commands.append(params[:2])
+        if len(points) > 1:
+            commands.append(np.array([LINE_TO | ((len(points) - 1) << 3)], dtype=np.uint64))
+            commands.append(params[2:])
+        if close:
+            commands.append(np.array([CLOSE_PATH | (1 << 3)], dtype=np.uint64))
+        cursor = points[-1]
+
+    if geom_type == POINT:
+        points = np.vstack(parts)
+        deltas = np.diff(np.vstack((cursor, points)), axis=0)
+        commands.append(np.array([MOVE_TO | (len(points) << 3)], dtype=np.uint64))
+        commands.append(zigzag(deltas).ravel())
+
+    elif geom_type == LINESTRING:
+        for part in parts:
+            part = dedupe(part)
+            if len(part) >= 2:
+                path(part, close=False)
+
+    elif geom_type == POLYGON:
+        for rings in parts:
+            for n, ring in enumerate(rings):
+                ring = dedupe(ring)
+                if len(ring) > 1 and np.all(ring[0] == ring[-1]):
+                    ring = ring[:-1]
+                if len(ring) < 3:
+                    continue
+                area = ring_area(ring)
+                if area == 0:
+                    if n == 0:
+                        break
+                    continue
+                # Exterior rings are clockwise, interior rings counter
+                # clockwise
+                if (n == 0) != (area > 0):
+                    ring = ring[::-1]
+                path(ring, close=True)
+
+    if not commands:
+        return None
+    return np.concatenate(commands)
+
+
+class Layer(object):
+    """
+    Builds a single layer of a vector tile. Keys and values of the feature
+    properties are deduplicated over all features of the layer.
+    """
+
+    def __init__(self, name, extent=4096):
+        self.name = name
+        self.extent = extent
+        self.keys = {}
+        self.values = {}
+        self.features = []
+
+    def add_feature(self, geom_type, parts, properties=None, id=None):
+        geometry = encode_geometry(geom_type, parts)
+        if geometry is None:
+            return False
+
+        tags = []
+        for key, value in (properties or {}).items():
+            if value is None:
+                continue
+            tags.append(self.keys.setdefault(key, len(self.keys)))
+            tags.append(self.values.setdefault((type(value).__name__, value), len(self.values)))
+
+        feature = b''
+        if id is not None and id >= 0:
+            feature += uint(1, id)
+        if tags:
+            feature += message(2, varints(tags))
+        feature += uint(3, geom_type)
+        feature += message(4, varints(geometry))
+        self.features.append(feature)
+        return True
+
+    def encode(self):
+        layer = uint(15, 2) + message(1, self.name.encode())
+        for feature in self.features:
+            layer += message(2, feature)
+        for key in self.keys:
+            layer += message(3, key.encode())
+        for (_, value) in self.values:
+            layer += message(4, encode_value(value))
+        layer += uint(5, self.extent)
+        return layer
+
+
+def encode_tile(layers):
+    """
+    Encode a list of layers into a vector tile. Layers without features
+    are left out.
+    """
+    return b''.join(message(3, layer.encode()) for layer in layers if layer.features)
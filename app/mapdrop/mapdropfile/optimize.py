@@ -0,0 +1,144 @@
+import os
+import uuid
+
+from osgeo import gdal
+
+from mapdrop import app, redis_store
+
+from .cache import metadata_cache
+from .overviews import overview_factors
+
+
+def optimized_filename(fullpath):
+    """
+    Return the filename of the optimized copy of a file, a hidden file
+    next to the original.
+    """
+    directory, filename = os.path.split(fullpath)
+    return os.path.join(directory, '.{}.cog.tif'.format(filename))
+
+
+def source_item(signature):
+    """
+    Return the value of the mapdrop_source metadata item of an optimized
+    copy made from a file with (mtime, size, ...) `signature`.
+    """
+    return '{}:{}'.format(signature[0], signature[1])
+
+
+def open_optimized(fullpath, signature, opener):
+    """
+    Open the optimized copy of a file with (mtime, size, ...) `signature`
+    with `opener`, and return the dataset and the stat result of the copy.
+    Returns None when there is no copy, or when it was made from another
+    version of the file, as recorded in its mapdrop_source metadata item.
+    A modification time alone can't tell, as a job that optimized an
+    earlier version can finish after the file was replaced.
+    """
+    filename = optimized_filename(fullpath)
+    try:
+        copy = os.stat(filename)
+    except OSError:
+        return None
+    ds = opener(filename)
+    if ds is None or ds.GetMetadataItem('mapdrop_source') != source_item(signature):
+        return None
+    return (ds, copy)
+
+
+def remove_optimized(fullpath):
+    try:
+        os.remove(optimized_filename(fullpath))
+    except OSError:
+        pass
+
+
+def is_optimized(ds):
+    """
+    Return whether a raster is laid out well for reading tiles already: a
+    tiled and compressed GeoTIFF, with overviews if it needs them.
+    """
+    if ds.GetDriver().ShortName not in ('GTiff', 'COG'):
+        return False
+    band = ds.GetRasterBand(1)
+    block_xsize, block_ysize = band.GetBlockSize()
+    if block_xsize >= ds.RasterXSize and ds.RasterXSize > 512:
+        return False
+    if block_ysize == 1 or not ds.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE'):
+        return False
+    if overview_factors(ds.RasterXSize, ds.RasterYSize) and band.GetOverviewCount() == 0:
+        return False
+    return True
+
+
+def creation_options(ds, compress, blocksize, driver):
+    options = ['COMPRESS={}'.format(compress)]
+    if driver == 'COG':
+        return options + ['BLOCKSIZE={}'.format(blocksize), 'PREDICTOR=YES', 'OVERVIEWS=IGNORE_EXISTING', 'BIGTIFF=IF_SAFER',
+                          'RESAMPLING={}'.format(app.config.get('MAPDROP_OVERVIEW_RESAMPLING', 'average').upper())]
+    floating = ds.GetRasterBand(1).DataType in (gdal.GDT_Float32, gdal.GDT_Float64)
+    return options + ['TILED=YES', 'BLOCKXSIZE={}'.format(blocksize), 'BLOCKYSIZE={}'.format(blocksize),
+                      'PREDICTOR={}'.format(3 if floating else 2), 'BIGTIFF=IF_SAFER', 'COPY_SRC_OVERVIEWS=YES']
+
+
+def optimize(path, fullpath):
+    """
+    Write a Cloud Optimized GeoTIFF copy of a raster next to it, with
+    internal tiling, compression with a predictor, and internal overviews,
+    and return its state. Rasters that are laid out well already are
+    left alone.
+
+    The copy is written to a temporary file and then moved into place, so
+    the original is served until the copy is complete. The copy records
+    the modification time and size of the original it was made from (see
+    open_optimized()). GDAL versions without the COG driver get a tiled
+    GeoTIFF with its overviews up front, which is read the same way.
+    """
+    st = os.stat(fullpath)
+    signature = (st.st_mtime_ns, st.st_size)
+    source = gdal.Open(fullpath, gdal.GA_ReadOnly)
+    if source is None or source.RasterCount == 0:
+        return {'state':'none'}
+    if is_optimized(source):
+        remove_optimized(fullpath)
+        return {'state':'skipped'}
+
+    compress = app.config.get('MAPDROP_OPTIMIZE_COMPRESS', 'DEFLATE').upper()
+    blocksize = app.config.get('MAPDROP_OPTIMIZE_BLOCKSIZE', 512)
+    filename = optimized_filename(fullpath)
+    tmpfilename = '{}.{}.tif'.format(filename, uuid.uuid4().hex)
+    stagefilename = None
+    metadata = ['mapdrop_source={}'.format(source_item(signature))]
+    try:
+        if gdal.GetDriverByName('COG') is not None:
+            ds = gdal.Translate(tmpfilename, source, format='COG', metadataOptions=metadata,
+                                creationOptions=creation_options(source, compress, blocksize, 'COG'))
+        else:
+            # Build the overviews on a tiled intermediate, and copy it with
+            # its overviews to get them in front of the full resolution data.
+            stagefilename = tmpfilename + '.stage.tif'
+            stage = gdal.Translate(stagefilename, source, format='GTiff',
+                                   creationOptions=['TILED=YES', 'BLOCKXSIZE={}'.format(blocksize), 'BLOCKYSIZE={}'.format(blocksize)])
+            factors = overview_factors(stage.RasterXSize, stage.RasterYSize)
+            if factors:
+                stage.BuildOverviews(app.config.get('MAPDROP_OVERVIEW_RESAMPLING', 'average').upper(), factors)
+            ds = gdal.Translate(tmpfilename, stage, format='GTiff', metadataOptions=metadata,
+                                creationOptions=creation_options(source, compress, blocksize, 'GTiff'))
+            stage = None
+        if ds is None:
+            raise Exception("Could not write an optimized copy of {}.".format(path))
+        ds = None
+        # Don't replace the copy of a newer version of the file
+        st = os.stat(fullpath)
+        if (st.st_mtime_ns, st.st_size) != signature:
+            raise Exception("{} changed while it was being optimized.".format(path))
+        os.rename(tmpfilename, filename)
+    finally:
+        for name in (tmpfilename, stagefilename):
+            if name is not None and os.path.exists(name):
+                os.remove(name)
+
+    # Metadata that was made from the original is out of date now
+    redis_store.delete(path)
+    metadata_cache.discard(path)
+    return {'state':'ready', 'original_size':os.path.getsize(fullpath), 'optimized_size':os.path.getsize(filename)}
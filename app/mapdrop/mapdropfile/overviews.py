@@ -0,0 +1,117 @@
+import os
+import uuid
+import json
+
+from osgeo import gdal
+
+from mapdrop import app, redis_store
+
+from .cache import metadata_cache
+
+
+def overview_factors(width, height, tile_size=256):
+    """
+    Return the list of overview factors (2, 4, 8, ...) needed until the
+    smallest overview fits within a single tile.
+    """
+    factors = []
+    factor = 2
+    while max(width, height) / (factor / 2) > tile_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def existing_factors(ds):
+    """
+    Return the decimation factors of the overviews present in a dataset.
+    """
+    band = ds.GetRasterBand(1)
+    factors = []
+    for n in range(band.GetOverviewCount()):
+        ov = band.GetOverview(n)
+        factors.append(int(round(ds.RasterXSize / ov.XSize)))
+    return factors
+
+
+def build_overviews(fullpath, resampling='average', location='external'):
+    """
+    Build overviews for the file at `fullpath` and return the factors.
+
+    External overviews are first written to a temporary .ovr file next to
+    the original (by way of a symlink), and then moved into place, so the
+    file can be read and served as usual while the overviews are built.
+    Internal overviews are written into the file itself.
+    """
+    if location == 'internal':
+        ds = gdal.Open(fullpath, gdal.GA_Update)
+        factors = overview_factors(ds.RasterXSize, ds.RasterYSize)
+        if factors:
+            ds.BuildOverviews(resampling.upper(), factors)
+        ds = None
+        return factors
+
+    directory, filename = os.path.split(fullpath)
+    linkpath = os.path.join(directory, '.{}.{}'.format(filename, uuid.uuid4().hex))
+    os.symlink(filename, linkpath)
+    try:
+        source = linkpath
+        ds = gdal.Open(linkpath, gdal.GA_ReadOnly)
+        if ds is None:
+            # Formats that rely on sidecar files (.hdr and such) can't be
+            # opened through the symlink, write their .ovr file directly.
+            source = fullpath
+            ds = gdal.Open(fullpath, gdal.GA_ReadOnly)
+        factors = overview_factors(ds.RasterXSize, ds.RasterYSize)
+        if factors:
+            ds.BuildOverviews(resampling.upper(), factors)
+        ds = None
+        if factors and source == linkpath:
+            os.rename(linkpath + '.ovr', fullpath + '.ovr')
+    finally:
+        os.remove(linkpath)
+        if os.path.exists(linkpath + '.ovr'):
+            os.remove(linkpath + '.ovr')
+    return factors
+
+
+def update_metadata(path, **kwargs):
+    """
+    Update keys in the stored metadata of a file, if there is any.
+    """
+    metadata = redis_store.get(path)
+    if metadata != None:
+        metadata = json.loads(metadata)
+        metadata.update(kwargs)
+        redis_store.set(path, json.dumps(metadata))
+        metadata_cache.discard(path)
+
+
+def run_overviews(path):
+    """
+    Build the overviews of a file and keep track of their state in its
+    metadata. A lock in Redis makes sure only a single worker builds the
+    overviews of a file.
+    """
+    location = app.config.get('MAPDROP_OVERVIEWS', 'external')
+    resampling = app.config.get('MAPDROP_OVERVIEW_RESAMPLING', 'average')
+    if location not in ('external', 'internal'):
+        return
+
+    lock_key = path + '.overviews.lock'
+    if not redis_store.set(lock_key, 1, nx=True, ex=3600):
+        return
+
+    fullpath = os.path.join(app.config.get('MAPDROP_DATA'), path)
+    state = {'state':'building', 'location':location, 'resampling':resampling, 'factors':[]}
+    update_metadata(path, overviews=state)
+    try:
+        state['factors'] = build_overviews(fullpath, resampling=resampling, location=location)
+        state['state'] = 'ready'
+    except Exception as e:
+        print("Building overviews for {} failed: {}".format(path, e))
+        state['state'] = 'failed'
+    finally:
+        redis_store.delete(lock_key)
+    update_metadata(path, overviews=state)
+    return state
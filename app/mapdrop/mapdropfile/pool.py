@@ -0,0 +1,144 @@
+import os
+import stat
+import threading
+
+from collections import OrderedDict
+
+from osgeo import gdal
+
+from .metrics import count
+
+
+class DatasetPool(object):
+    """
+    Per-process pool of open GDAL dataset handles with LRU eviction.
+
+    Handles are keyed on the full path of the file, and every lookup checks
+    the mtime and size of the file (and of its external .ovr overviews)
+    against the signature recorded when the handle was opened. When a file
+    has been replaced on disk, or overviews were added, the old handle is
+    evicted and the file is opened again. The pool is capped on both the
+    number of open handles and on the total size of the files behind them.
+
+    GDAL dataset handles are not safe to share between threads, so this is
+    meant for the (default) sync gunicorn workers where every worker process
+    handles one request at a time.
+    """
+
+    def __init__(self, max_handles=64, max_bytes=0):
+        self.max_handles = max_handles
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.reset()
+
+    def __repr__(self):
+        return "<DatasetPool handles={} bytes={} hits={} misses={}>".format(len(self.handles), self.bytes, self.hits, self.misses)
+
+    def reset(self):
+        """
+        Drop all open handles and zero the counters.
+        """
+        self.pid = os.getpid()
+        self.handles = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def signature(self, fullpath):
+        """
+        Return the (mtime, size, overviews mtime) signature of a file on
+        disk. Raises an OSError when the path does not exist or is not a
+        regular file.
+        """
+        st = os.stat(fullpath)
+        if not stat.S_ISREG(st.st_mode):
+            raise FileNotFoundError(fullpath)
+        try:
+            ovr_mtime = os.stat(fullpath + '.ovr').st_mtime_ns
+        except OSError:
+            ovr_mtime = None
+        return (st.st_mtime_ns, st.st_size, ovr_mtime)
+
+    def open(self, fullpath, signature=None):
+        """
+        Return an open GDAL dataset for `fullpath`, either from the pool or
+        by opening it and adding it to the pool. Returns None when GDAL can't
+        open the file.
+        """
+        if signature is None:
+            signature = self.signature(fullpath)
+
+        with self.lock:
+            # Handles inherited from a parent process over a fork must not
+            # be used in the child, start with a clean pool instead.
+            if self.pid != os.getpid():
+                self.reset()
+
+            entry = self.handles.get(fullpath)
+            if entry is not None:
+                if entry['signature'] == signature:
+                    self.handles.move_to_end(fullpath)
+                    self.hits += 1
+                    count('pool', True)
+                    return entry['ds']
+                else:
+                    self.evict(fullpath)
+
+            self.misses += 1
+            count('pool', False)
+            ds = gdal.OpenEx(fullpath, gdal.OF_RASTER | gdal.OF_VECTOR)
+            if ds is None:
+                return None
+
+            self.handles[fullpath] = {'ds':ds, 'signature':signature, 'bytes':signature[1]}
+            self.bytes += signature[1]
+            self.shrink()
+            return ds
+
+    def evict(self, fullpath):
+        """
+        Remove a handle from the pool. The dataset is closed once the last
+        reference to it goes away.
+        """
+        with self.lock:
+            entry = self.handles.pop(fullpath, None)
+            if entry is not None:
+                self.bytes -= entry['bytes']
+                self.evictions += 1
+
+    def shrink(self):
+        """
+        Evict least recently used handles until the pool is within its caps,
+        always keeping the most recently opened one.
+        """
+        with self.lock:
+            while len(self.handles) > 1 and (self.over_handles() or self.over_bytes()):
+                fullpath = next(iter(self.handles))
+                self.evict(fullpath)
+
+    def over_handles(self):
+        return self.max_handles > 0 and len(self.handles) > self.max_handles
+
+    def over_bytes(self):
+        return self.max_bytes > 0 and self.bytes > self.max_bytes
+
+    def clear(self):
+        with self.lock:
+            for fullpath in list(self.handles):
+                self.evict(fullpath)
+
+    def stats(self):
+        """
+        Return the pool counters as a dict.
+        """
+        with self.lock:
+            return {
+                'handles': len(self.handles),
+                'bytes': self.bytes,
+                'max_handles': self.max_handles,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
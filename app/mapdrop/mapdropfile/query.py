@@ -0,0 +1,343 @@
+import re
+import time
+
+import numpy as np
+
+from osgeo import ogr, gdal
+
+
+def parse_stats(value):
+    """
+    Parse a comma separated list of statistics, for example
+    'avg,min,max,q50'. Percentiles are given as qNN with NN from 0 to 100.
+    """
+    names = []
+    for name in (value or 'avg,min,max').split(','):
+        name = name.strip()
+        if name == 'median':
+            name = 'q50'
+        if name in ('avg', 'min', 'max', 'sum', 'std', 'count'):
+            names.append(name)
+        elif re.match(r'^q(\d{1,2}(\.\d+)?|100)$', name):
+            names.append(name)
+        else:
+            raise Exception("Unknown statistic: {}".format(name))
+    return names
+
+
+def compute_stats(values, names):
+    """
+    Compute the named statistics of a 1-D array of values.
+    """
+    stats = {}
+    percentiles = [name for name in names if name.startswith('q')]
+    if values.size == 0:
+        for name in names:
+            stats[name] = 0 if name == 'count' else None
+        return stats
+
+    if percentiles:
+        q = np.percentile(values, [float(name[1:]) for name in percentiles])
+        stats.update(zip(percentiles, q.tolist()))
+
+    for name in names:
+        if name == 'avg':
+            stats[name] = values.mean(dtype=np.float64).item()
+        elif name == 'min':
+            stats[name] = values.min().item()
+        elif name == 'max':
+            stats[name] = values.max().item()
+        elif name == 'sum':
+            stats[name] = values.sum(dtype=np.float64).item()
+        elif name == 'std':
+            stats[name] = values.std(dtype=np.float64).item()
+        elif name == 'count':
+            stats[name] = int(values.size)
+    return stats
+
+
+def reproject(geoms, crs, ds):
+    """
+    Reproject shapely geometries from `crs` into the CRS of a dataset.
+    """
+    import pyproj
+    from shapely.ops import transform
+    src = pyproj.CRS.from_user_input(crs)
+    dst = pyproj.CRS.from_wkt(ds.GetProjectionRef())
+    if src == dst:
+        return list(geoms)
+    transformer = pyproj.Transformer.from_crs(src, dst, always_xy=True)
+    return [transform(transformer.transform, geom) for geom in geoms]
+
+
+def pixel_window(bounds, geotransform, xsize, ysize):
+    """
+    Return the (xoff, yoff, xsize, ysize) pixel window covering the bounds
+    of a geometry, clipped to the raster, or None when they don't overlap.
+    """
+    inverse = gdal.InvGeoTransform(geotransform)
+    minx, miny, maxx, maxy = bounds
+    cols = []
+    rows = []
+    for (x, y) in ((minx, miny), (minx, maxy), (maxx, miny), (maxx, maxy)):
+        cols.append(inverse[0] + x * inverse[1] + y * inverse[2])
+        rows.append(inverse[3] + x * inverse[4] + y * inverse[5])
+
+    xoff = max(int(np.floor(min(cols))), 0)
+    yoff = max(int(np.floor(min(rows))), 0)
+    xend = min(int(np.ceil(max(cols))), xsize)
+    yend = min(int(np.ceil(max(rows))), ysize)
+    # Points and thin lines still cover the pixel they fall in
+    xend = max(xend, min(xoff + 1, xsize))
+    yend = max(yend, min(yoff + 1, ysize))
+    if xoff >= xsize or yoff >= ysize or xend <= 0 or yend <= 0:
+        return None
+    return (xoff, yoff, xend - xoff, yend - yoff)
+
+
+class BlockReader(object):
+    """
+    Reads windows of a band from blocks that are each read at most once for
+    a batch of windows. Blocks are kept in memory only for as long as a
+    window that still has to be read needs them.
+
+    The blocks are the natural blocks of the band, grouped to at least 256
+    rows for striped files and capped to 1024 columns.
+    """
+
+    def __init__(self, band, windows):
+        self.band = band
+        block_xsize, block_ysize = band.GetBlockSize()
+        self.block_xsize = min(block_xsize, 1024)
+        self.block_ysize = block_ysize * max(1, 256 // block_ysize)
+        self.blocks = {}
+        self.refcounts = {}
+        self.reads = 0
+        for window in windows:
+            if window is not None:
+                for block in self.window_blocks(window):
+                    self.refcounts[block] = self.refcounts.get(block, 0) + 1
+
+    def window_blocks(self, window):
+        xoff, yoff, xsize, ysize = window
+        for by in range(yoff // self.block_ysize, (yoff + ysize - 1) // self.block_ysize + 1):
+            for bx in range(xoff // self.block_xsize, (xoff + xsize - 1) // self.block_xsize + 1):
+                yield (bx, by)
+
+    def block(self, bx, by):
+        if (bx, by) not in self.blocks:
+            xoff = bx * self.block_xsize
+            yoff = by * self.block_ysize
+            xsize = min(self.block_xsize, self.band.XSize - xoff)
+            ysize = min(self.block_ysize, self.band.YSize - yoff)
+            self.blocks[(bx, by)] = self.band.ReadAsArray(xoff, yoff, xsize, ysize)
+            self.reads += 1
+        return self.blocks[(bx, by)]
+
+    def read(self, window):
+        """
+        Return the data for a window, assembled from its blocks.
+        """
+        xoff, yoff, xsize, ysize = window
+        data = None
+        for (bx, by) in self.window_blocks(window):
+            block = self.block(bx, by)
+            if data is None:
+                data = np.empty((ysize, xsize), dtype=block.dtype)
+            # Overlap of the block and the window, in raster pixels
+            x0 = max(xoff, bx * self.block_xsize)
+            y0 = max(yoff, by * self.block_ysize)
+            x1 = min(xoff + xsize, bx * self.block_xsize + block.shape[1])
+            y1 = min(yoff + ysize, by * self.block_ysize + block.shape[0])
+            data[y0-yoff:y1-yoff, x0-xoff:x1-xoff] = block[y0-by*self.block_ysize:y1-by*self.block_ysize, x0-bx*self.block_xsize:x1-bx*self.block_xsize]
+
+            self.refcounts[(bx, by)] -= 1
+            if self.refcounts[(bx, by)] == 0:
+                del self.blocks[(bx, by)]
+        return data
+
+
+def rasterize(geom, window, geotransform, all_touched=False):
+    """
+    Rasterize a geometry into a boolean mask covering a pixel window.
+    """
+    xoff, yoff, xsize, ysize = window
+    x_min, x_size, x_rot, y_max, y_rot, y_size = geotransform
+    window_geotransform = (x_min + xoff * x_size + yoff * x_rot, x_size, x_rot,
+                           y_max + xoff * y_rot + yoff * y_size, y_rot, y_size)
+
+    target = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, gdal.GDT_Byte)
+    target.SetGeoTransform(window_geotransform)
+
+    source = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = source.CreateLayer('geom')
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(ogr.CreateGeometryFromWkb(geom.wkb))
+    layer.CreateFeature(feature)
+
+    options = ['ALL_TOUCHED=TRUE'] if all_touched else []
+    gdal.RasterizeLayer(target, [1], layer, burn_values=[1], options=options)
+    return target.GetRasterBand(1).ReadAsArray().astype(bool)
+
+
+def zonal_stats(ds, geoms, names, crs='EPSG:4326', band=1, all_touched=False):
+    """
+    Generate statistics of the pixels of a band within each geometry.
+
+    Only the window covering each geometry is read, and geometries are
+    processed in block order through a BlockReader, so every block that is
+    shared by several geometries in a batch is read just once. Results are
+    generated in processing order, each with the index of its geometry in
+    the input and the time spent on it.
+
+    The geometries are reprojected before this returns, so an invalid `crs`
+    or a geometry that can't be reprojected raises right away, rather than
+    when the first result is generated.
+    """
+    raster_band = ds.GetRasterBand(band)
+    geotransform = ds.GetGeoTransform()
+
+    projected = reproject(geoms, crs, ds)
+    windows = [pixel_window(geom.bounds, geotransform, ds.RasterXSize, ds.RasterYSize) if not geom.is_empty else None for geom in projected]
+    return zonal_results(raster_band, geotransform, projected, windows, names, all_touched)
+
+
+def zonal_results(raster_band, geotransform, projected, windows, names, all_touched):
+    """
+    Generate the results of zonal_stats() for reprojected geometries and
+    their pixel windows.
+    """
+    nodata = raster_band.GetNoDataValue()
+    reader = BlockReader(raster_band, windows)
+
+    order = sorted(range(len(projected)), key=lambda n: (0, 0, 0) if windows[n] is None else (1, windows[n][1], windows[n][0]))
+    for n in order:
+        started = time.perf_counter()
+        window = windows[n]
+        if window is None:
+            values = np.empty(0)
+        else:
+            data = reader.read(window)
+            mask = rasterize(projected[n], window, geotransform, all_touched=all_touched)
+            if nodata is not None:
+                mask &= (data != nodata)
+            if data.dtype.kind == 'f':
+                mask &= ~np.isnan(data)
+            values = data[mask]
+
+        yield {
+            'index': n,
+            'stats': compute_stats(values, names),
+            'time_ms': (time.perf_counter() - started) * 1000
+        }
+
+
+def transform_coords(xs, ys, crs, ds):
+    """
+    Transform arrays of coordinates from `crs` into the CRS of a dataset in
+    a single vectorised call.
+    """
+    import pyproj
+    src = pyproj.CRS.from_user_input(crs)
+    dst = pyproj.CRS.from_wkt(ds.GetProjectionRef())
+    if src == dst:
+        return (xs, ys)
+    transformer = pyproj.Transformer.from_crs(src, dst, always_xy=True)
+    return transformer.transform(xs, ys)
+
+
+def read_pixels(band, cols, rows):
+    """
+    Return the values (float64) of a band at arrays of pixel indices, with
+    NaN for nodata and pixels outside the raster. The indices are grouped
+    by block, and every block that is needed is read only once.
+    """
+    values = np.full(cols.shape, np.nan)
+    inside = np.nonzero((cols >= 0) & (cols < band.XSize) & (rows >= 0) & (rows < band.YSize))[0]
+    if inside.size == 0:
+        return values
+
+    reader = BlockReader(band, [])
+    cols = cols[inside]
+    rows = rows[inside]
+    bx = cols // reader.block_xsize
+    by = rows // reader.block_ysize
+    blocks = by * (band.XSize // reader.block_xsize + 1) + bx
+
+    order = np.argsort(blocks, kind='stable')
+    _, starts = np.unique(blocks[order], return_index=True)
+    for group in np.split(order, starts[1:]):
+        block_x, block_y = int(bx[group[0]]), int(by[group[0]])
+        block = reader.block(block_x, block_y)
+        values[inside[group]] = block[rows[group] - block_y * reader.block_ysize, cols[group] - block_x * reader.block_xsize]
+        del reader.blocks[(block_x, block_y)]
+
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        values[values == nodata] = np.nan
+    return values
+
+
+def sample(ds, xs, ys, crs='EPSG:4326', band=1, interpolation='nearest'):
+    """
+    Sample a band at arrays of coordinates in `crs`. Returns a float64 array
+    of values, with NaN where there is no data.
+
+    With bilinear interpolation the four pixels around each point are
+    weighted by distance, and nodata pixels are left out of the weights.
+    """
+    xs, ys = transform_coords(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64), crs, ds)
+    inverse = gdal.InvGeoTransform(ds.GetGeoTransform())
+    cols = inverse[0] + xs * inverse[1] + ys * inverse[2]
+    rows = inverse[3] + xs * inverse[4] + ys * inverse[5]
+    raster_band = ds.GetRasterBand(band)
+
+    if interpolation == 'nearest':
+        return read_pixels(raster_band, np.floor(cols).astype(np.int64), np.floor(rows).astype(np.int64))
+
+    if interpolation != 'bilinear':
+        raise Exception("Unknown interpolation: {}".format(interpolation))
+
+    # Offsets relative to pixel centers
+    cols = cols - 0.5
+    rows = rows - 0.5
+    col0 = np.floor(cols).astype(np.int64)
+    row0 = np.floor(rows).astype(np.int64)
+    dx = cols - col0
+    dy = rows - row0
+
+    # Look up the four neighbours in one go so blocks are read just once
+    n = xs.size
+    neighbours = read_pixels(raster_band,
+                             np.concatenate((col0, col0 + 1, col0, col0 + 1)),
+                             np.concatenate((row0, row0, row0 + 1, row0 + 1))).reshape(4, n)
+    weights = np.stack(((1 - dx) * (1 - dy), dx * (1 - dy), (1 - dx) * dy, dx * dy))
+    weights[np.isnan(neighbours)] = 0
+    total = weights.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = np.nansum(neighbours * weights, axis=0) / total
+    values[total == 0] = np.nan
+    return values
+
+
+def densify(line, points, crs='EPSG:4326'):
+    """
+    Return (distances, xs, ys) arrays for `points` points spaced evenly
+    along a line. Distances are in meters along the ellipsoid for
+    geographic coordinate systems, and in the units of `crs` otherwise.
+    """
+    import pyproj
+    if points < 2:
+        raise Exception("Need at least two points on a transect.")
+    coords = [line.interpolate(fraction, normalized=True) for fraction in np.linspace(0, 1, points)]
+    xs = np.array([point.x for point in coords])
+    ys = np.array([point.y for point in coords])
+
+    crs = pyproj.CRS.from_user_input(crs)
+    if crs.is_geographic:
+        geod = crs.get_geod()
+        _, _, steps = geod.inv(xs[:-1], ys[:-1], xs[1:], ys[1:])
+    else:
+        steps = np.hypot(np.diff(xs), np.diff(ys))
+    distances = np.concatenate(([0.0], np.cumsum(steps)))
+    return (distances, xs, ys)
@@ -0,0 +1,141 @@
+import os
+import uuid
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+class PackedRTree(object):
+    """
+    Static R-tree over bounding boxes, packed with the Sort-Tile-Recursive
+    algorithm. The tree is stored as a list of levels, each an (n, 4) array
+    of (minx, miny, maxx, maxy) boxes, where node i of a level covers nodes
+    i*node_size up to (i+1)*node_size of the level below it. The leaves are
+    the boxes of the items themselves, with their ids in `ids`.
+
+    Queries are answered level by level with vectorised box tests, and the
+    whole tree can be saved to and loaded from a single .npz file.
+    """
+
+    def __init__(self, levels, ids, node_size=16):
+        self.levels = levels
+        self.ids = ids
+        self.node_size = node_size
+
+    def __repr__(self):
+        return "<PackedRTree items={} levels={}>".format(len(self.ids), len(self.levels))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, boxes, ids, node_size=16):
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        ids = np.asarray(ids, dtype=np.int64)
+
+        if len(boxes):
+            # Sort into vertical slices by x, and each slice by y
+            cx = (boxes[:,0] + boxes[:,2]) / 2
+            cy = (boxes[:,1] + boxes[:,3]) / 2
+            leaves = -(-len(boxes) // node_size)
+            slice_size = node_size * int(np.ceil(np.sqrt(leaves)))
+            slices = np.empty(len(boxes), dtype=np.int64)
+            slices[np.argsort(cx, kind='stable')] = np.arange(len(boxes)) // slice_size
+            order = np.lexsort((cy, slices))
+            boxes = boxes[order]
+            ids = ids[order]
+
+        levels = [boxes]
+        while len(levels[-1]) > node_size:
+            levels.append(cls.parents(levels[-1], node_size))
+        return cls(levels, ids, node_size=node_size)
+
+    @staticmethod
+    def parents(boxes, node_size):
+        """
+        Return the boxes of the nodes one level up.
+        """
+        count = -(-len(boxes) // node_size)
+        padded = np.empty((count * node_size, 4), dtype=np.float64)
+        padded[:len(boxes)] = boxes
+        # Padding with the last box doesn't change the extent of a node
+        padded[len(boxes):] = boxes[-1]
+        padded = padded.reshape(count, node_size, 4)
+        return np.column_stack((padded[:,:,0].min(axis=1), padded[:,:,1].min(axis=1),
+                                padded[:,:,2].max(axis=1), padded[:,:,3].max(axis=1)))
+
+    @property
+    def bounds(self):
+        top = self.levels[-1]
+        if not len(top):
+            return None
+        return (top[:,0].min(), top[:,1].min(), top[:,2].max(), top[:,3].max())
+
+    def query(self, bounds):
+        """
+        Return the ids of all items whose box intersects `bounds`, in the
+        order of the tree.
+        """
+        minx, miny, maxx, maxy = bounds
+        nodes = np.arange(len(self.levels[-1]))
+        for depth in range(len(self.levels) - 1, -1, -1):
+            boxes = self.levels[depth][nodes]
+            hits = nodes[(boxes[:,0] <= maxx) & (boxes[:,2] >= minx) & (boxes[:,1] <= maxy) & (boxes[:,3] >= miny)]
+            if depth == 0:
+                return self.ids[hits]
+            children = (hits[:,None] * self.node_size + np.arange(self.node_size)).ravel()
+            nodes = children[children < len(self.levels[depth-1])]
+
+    def save(self, filename, **extra):
+        """
+        Save the tree to a .npz file, written to a temporary name first so
+        readers never see a partially written index. Extra arrays (like the
+        signature of the indexed file) are stored along with it.
+        """
+        arrays = {'level{}'.format(n):level for (n, level) in enumerate(self.levels)}
+        arrays['ids'] = self.ids
+        arrays['node_size'] = np.array(self.node_size)
+        arrays.update(extra)
+        tmpfilename = '{}.{}.npz'.format(filename, uuid.uuid4().hex)
+        np.savez(tmpfilename, **arrays)
+        os.rename(tmpfilename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a tree from a .npz file, and return it with a dict of any extra
+        arrays that were saved with it.
+        """
+        with np.load(filename) as data:
+            count = len([name for name in data.files if name.startswith('level')])
+            levels = [data['level{}'.format(n)] for n in range(count)]
+            extra = {name:data[name] for name in data.files if not name.startswith('level') and name not in ('ids', 'node_size')}
+            return (cls(levels, data['ids'], node_size=int(data['node_size'])), extra)
+
+
+class IndexCache(object):
+    """
+    Small LRU cache of loaded indexes, so the index of a file is read from
+    disk once per worker instead of for every tile.
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
@@ -0,0 +1,150 @@
+import os
+import re
+import time
+import fnmatch
+
+from datetime import datetime, timezone
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import gdal
+
+from . import query
+from .directory import directory_index, summaries
+from .optimize import open_optimized
+
+# Timestamps in filenames, like 20261001, 2026-10-01, or 2026-10-01T1200
+TIMESTAMP = re.compile(r'(\d{4})-?(\d{2})-?(\d{2})(?:[T_\-]?(\d{2}):?(\d{2})(?::?(\d{2}))?)?')
+
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d', '%Y%m%dT%H%M%S', '%Y%m%d')
+
+
+def parse_time(value):
+    """
+    Parse an ISO 8601 date or date and time, without a timezone.
+    """
+    for format in TIME_FORMATS:
+        try:
+            return datetime.strptime(value.rstrip('Z'), format)
+        except ValueError:
+            continue
+    raise Exception("Invalid time: {}".format(value))
+
+
+def file_time(entry):
+    """
+    Return the time of a file in a series: the timestamp in its name, or
+    its modification time (in UTC) when it has none. Times are naive, like
+    those of parse_time().
+    """
+    match = TIMESTAMP.search(entry['name'])
+    if match is not None:
+        try:
+            return datetime(*[int(part) for part in match.groups() if part is not None])
+        except ValueError:
+            pass
+    return datetime.fromtimestamp(entry['mtime'], timezone.utc).replace(tzinfo=None)
+
+
+def series_files(directory, pattern='*', start=None, end=None, geom=None, crs='EPSG:4326'):
+    """
+    Return the file entries of a directory that are part of a series, in
+    order of time: those matching the glob `pattern` with a time between
+    `start` and `end`. Rasters whose extent does not intersect `geom` are
+    left out, using the summaries in the directory listing, so those files
+    are never opened. Files without a summary are kept.
+    """
+    import pyproj
+    from shapely.ops import transform
+    from shapely.geometry import box
+
+    entries = [dict(entry) for entry in directory_index.listing(directory).entries
+               if entry['type'] == 'file' and fnmatch.fnmatchcase(entry['name'], pattern)]
+    for entry in entries:
+        entry['time'] = file_time(entry)
+    entries = [entry for entry in entries
+               if (start is None or entry['time'] >= start) and (end is None or entry['time'] <= end)]
+
+    extent = None
+    if geom is not None:
+        src = pyproj.CRS.from_user_input(crs)
+        dst = pyproj.CRS.from_epsg(4326)
+        extent = geom
+        if src != dst:
+            transformer = pyproj.Transformer.from_crs(src, dst, always_xy=True)
+            extent = transform(transformer.transform, geom)
+
+    files = []
+    for entry in summaries(directory, entries):
+        summary = entry.get('summary')
+        if summary is not None:
+            if summary['type'] != 'raster':
+                continue
+            if extent is not None and summary.get('bounds') and not box(*summary['bounds']).intersects(extent):
+                continue
+        files.append(entry)
+    return sorted(files, key=lambda entry: (entry['time'], entry['name']))
+
+
+def open_file(fullpath, signature):
+    """
+    Open a raster for a query in a worker thread. Handles of the dataset
+    pool can't be shared between threads, so each read opens its own.
+    """
+    copy = open_optimized(fullpath, signature, lambda filename: gdal.Open(filename, gdal.GA_ReadOnly))
+    ds = copy[0] if copy is not None else gdal.Open(fullpath, gdal.GA_ReadOnly)
+    if ds is None or ds.RasterCount == 0:
+        raise Exception("Not a raster")
+    return ds
+
+
+def query_file(fullpath, signature, kind, geoms, options):
+    """
+    Run a sample (`geoms` is a (xs, ys) tuple) or stats query on a single
+    file, and return its values or statistics.
+    """
+    ds = open_file(fullpath, signature)
+    if options['band'] < 1 or options['band'] > ds.RasterCount:
+        raise Exception("Band {} does not exist".format(options['band']))
+    if kind == 'sample':
+        xs, ys = geoms
+        return query.sample(ds, xs, ys, crs=options['crs'], band=options['band'],
+                            interpolation=options['interpolation']).tolist()
+    result = next(query.zonal_stats(ds, geoms, options['stats'], crs=options['crs'], band=options['band'],
+                                    all_touched=options['all_touched']))
+    return result['stats']
+
+
+def query_series(root, directory, files, kind, geoms, options, workers=8):
+    """
+    Generate the results of a query on each file of a series, in the order
+    of `files`. Files are read by a pool of threads, as GDAL releases the
+    GIL while reading, and results are generated as soon as those of all
+    files before them are ready. At most a few reads per thread are queued
+    ahead, and those are cancelled when the generator is closed (when the
+    client goes away, for instance).
+    """
+    def run(entry):
+        started = time.perf_counter()
+        result = {'name':entry['name'], 'time':entry['time'].isoformat()}
+        try:
+            result['stats' if kind == 'stats' else 'values'] = query_file(
+                os.path.join(root, directory, entry['name']), entry['signature'], kind, geoms, options)
+        except Exception as e:
+            result['error'] = str(e)
+        result['time_ms'] = (time.perf_counter() - started) * 1000
+        return result
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = deque()
+    try:
+        for entry in files:
+            futures.append(executor.submit(run, entry))
+            if len(futures) >= workers * 4:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
@@ -0,0 +1,185 @@
+import time
+import uuid
+import threading
+
+from mapdrop import redis_store
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key within a process. The
+    first caller runs the function, and callers that arrive while it is
+    still running wait for it and share its result.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event':threading.Event(), 'result':None, 'error':None}
+                self.calls[key] = call
+
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['event'].set()
+
+
+class Lease(object):
+    """
+    Redis lock for work that can take a long time. The lock is set with a
+    short expiry, and renewed by a background thread for as long as its
+    owner holds it, so it doesn't expire in the middle of the work but is
+    freed soon after an owner dies.
+
+    The lock holds a token that is unique to the lease. Renewing,
+    releasing, and writes through set() only succeed while the lock still
+    holds the token, so an owner that lost its lock (for example after a
+    long pause) can't overwrite the result of the worker that took over.
+    A `fenced` lease takes its token from a single counter that is shared
+    by all leases, so later leases always have higher tokens. Other leases
+    use a random token, which saves a round trip.
+    """
+
+    fence_key = 'lease:fence'
+
+    renew_script = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('pexpire', KEYS[1], ARGV[2])
+        end
+        return 0
+    """
+
+    release_script = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+    """
+
+    set_script = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            redis.call('set', KEYS[2], ARGV[2])
+            return 1
+        end
+        return 0
+    """
+
+    def __init__(self, key, ttl=10, fenced=False):
+        self.key = key
+        self.ttl = ttl
+        self.fenced = fenced
+        self.token = None
+        self.lost = False
+        self.stopped = threading.Event()
+
+    def __repr__(self):
+        return "<Lease key={} token={}>".format(self.key, self.token)
+
+    def acquire(self):
+        if self.fenced:
+            token = str(redis_store.incr(self.fence_key))
+        else:
+            token = uuid.uuid4().hex
+        if not redis_store.set(self.key, token, nx=True, px=int(self.ttl*1000)):
+            return False
+        self.token = token
+        thread = threading.Thread(target=self.renew, daemon=True)
+        thread.start()
+        return True
+
+    def renew(self):
+        while not self.stopped.wait(self.ttl / 3.0):
+            try:
+                renewed = redis_store.eval(self.renew_script, 1, self.key, self.token, int(self.ttl*1000))
+            except Exception as e:
+                print("Could not renew lock {}: {}".format(self.key, e))
+                continue
+            if not renewed:
+                self.lost = True
+                return
+
+    def set(self, key, value):
+        """
+        Set `key` to `value` only if the lease is still held.
+        """
+        if self.token is None:
+            return False
+        return bool(redis_store.eval(self.set_script, 2, self.key, key, self.token, value))
+
+    def release(self):
+        """
+        Stop renewing the lease, delete the lock if it is still ours, and
+        notify the workers that are waiting for it.
+        """
+        self.stopped.set()
+        redis_store.eval(self.release_script, 1, self.key, self.token)
+        redis_store.publish(self.key, 'done')
+
+
+def coalesce(key, fn, lookup, timeout=30, ttl=10, fenced=False):
+    """
+    Run `fn` for `key` in a single worker at a time, across processes. A
+    worker that finds the key locked by another worker waits until that
+    worker publishes that it is done, and then calls `lookup` to fetch the
+    result from wherever the other worker stored it.
+
+    The lock is a Lease, which is kept alive for as long as `fn` runs. When
+    the lock goes away without a result (the other worker failed or died),
+    the waiters try to take it over, so `fn` still runs only once. A waiter
+    that has waited for more than `timeout` seconds (None to wait as long
+    as the lock is held) runs `fn` itself.
+
+    With `fenced`, `fn` is called with the lease, so it can store its result
+    with Lease.set() and the result of a worker that lost its lock is never
+    stored.
+    """
+    lock_key = 'singleflight:' + key
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    while True:
+        lease = Lease(lock_key, ttl=ttl, fenced=fenced)
+        if lease.acquire():
+            try:
+                return fn(lease) if fenced else fn()
+            finally:
+                lease.release()
+
+        pubsub = redis_store.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(lock_key)
+        try:
+            while True:
+                # Check after subscribing, so a notification that was sent
+                # in between the lock attempt and the subscription is not
+                # missed.
+                result = lookup()
+                if result is not None:
+                    return result
+                if not redis_store.exists(lock_key):
+                    break
+                remaining = deadline - time.monotonic() if deadline is not None else 1.0
+                if remaining <= 0:
+                    result = lookup()
+                    if result is not None:
+                        return result
+                    return fn(Lease(lock_key, ttl=ttl, fenced=True)) if fenced else fn()
+                pubsub.get_message(timeout=min(remaining, 1.0))
+        finally:
+            pubsub.close()
@@ -0,0 +1,296 @@
+import math
+
+import numpy as np
+
+from osgeo import gdal_array
+
+
+class StreamingStats(object):
+    """
+    Accumulates min/max/sum/count and a histogram over values that are fed
+    in one block at a time, so statistics of a band can be calculated
+    without ever holding the full band in memory.
+
+    Percentiles are estimated from the histogram. The bins have a width
+    that is a power of two and are aligned on multiples of that width, so
+    when a block falls outside of the current histogram range the width is
+    doubled by merging pairs of neighbouring bins. This keeps the histogram
+    mergeable and at a fixed size, and the final bin width is at most
+    four times (max-min)/bins.
+
+    Error bound: every estimated percentile is within one bin width
+    (reported as `error`) of the exact value that np.percentile would
+    return. For integer data whose range fits in the histogram the bin
+    width is 1, and the percentiles are exact. Values that are all the
+    same are counted in a single bin, whatever its width, until a different
+    value comes along and the width can be derived from their range.
+    """
+
+    def __init__(self, bins=4096, integer=False):
+        self.bins = bins
+        self.integer = integer
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.width = None
+        self.offset = 0
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def __repr__(self):
+        return "<StreamingStats count={} min={} max={}>".format(self.count, self.min, self.max)
+
+    def cover(self, lo, hi):
+        """
+        Make sure the histogram range covers the values from lo to hi,
+        widening the bins where needed.
+        """
+        if self.width is None:
+            span = (hi - lo) / self.bins
+            self.width = 2.0 ** math.ceil(math.log2(span)) if span > 0 else 1.0
+            if self.integer:
+                self.width = max(self.width, 1.0)
+            self.offset = math.floor(lo / self.width)
+
+        while True:
+            # Range of bins that needs to be covered, including the bins
+            # that already hold values.
+            first = math.floor(lo / self.width)
+            last = math.floor(hi / self.width)
+            nonzero = np.flatnonzero(self.counts)
+            if nonzero.size:
+                first = min(first, self.offset + nonzero[0])
+                last = max(last, self.offset + nonzero[-1])
+            if last - first < self.bins:
+                break
+            self.widen()
+
+        if first < self.offset or last >= self.offset + self.bins:
+            self.shift(min(first, max(self.offset, last - self.bins + 1)))
+
+    def shift(self, offset):
+        """
+        Move the start of the histogram to another bin without changing
+        the bin width.
+        """
+        counts = np.zeros(self.bins, dtype=np.int64)
+        nonzero = np.flatnonzero(self.counts)
+        counts[nonzero + self.offset - offset] = self.counts[nonzero]
+        self.counts = counts
+        self.offset = offset
+
+    def unbin(self, lo, hi):
+        """
+        While all values so far are the same, the bin width was derived
+        from a range of nothing, and can be far too wide for the values
+        from lo to hi. In that case the histogram is cleared, so the width
+        is derived again from the range that is known now, and the value
+        and its count are returned to be added back with add(). Returns
+        None otherwise.
+        """
+        if self.count == 0 or self.min != self.max or lo == hi == self.min:
+            return None
+        single = (self.min, self.count)
+        self.width = None
+        self.counts[:] = 0
+        return single
+
+    def add(self, value, count):
+        """
+        Add `count` times the same value.
+        """
+        self.cover(value, value)
+        self.counts[math.floor(value / self.width) - self.offset] += count
+
+    def widen(self):
+        """
+        Double the bin width by merging pairs of neighbouring bins.
+        """
+        index = (self.offset + np.arange(self.bins)) // 2
+        self.offset = self.offset // 2
+        counts = np.zeros(self.bins + 1, dtype=np.int64)
+        np.add.at(counts, index - self.offset, self.counts)
+        if counts[-1]:
+            self.offset += 1
+            counts = counts[1:]
+        else:
+            counts = counts[:-1]
+        self.counts = counts
+        self.width *= 2
+
+    def update(self, values):
+        """
+        Add a 1-D array of valid (not nodata) values.
+        """
+        if values.size == 0:
+            return
+
+        lo = values.min().item()
+        hi = values.max().item()
+        single = self.unbin(lo, hi)
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+        self.sum += np.sum(values, dtype=np.float64).item()
+        self.count += values.size
+
+        self.cover(self.min, self.max)
+        index = np.floor(values / self.width).astype(np.int64) - self.offset
+        np.clip(index, 0, self.bins - 1, out=index)
+        self.counts += np.bincount(index, minlength=self.bins)
+        if single is not None:
+            self.add(*single)
+
+    def merge(self, other):
+        """
+        Merge the statistics of another accumulator into this one.
+        """
+        if other.count == 0:
+            return
+
+        single = self.unbin(other.min, other.max)
+        if other.min == other.max:
+            # The other histogram holds a single value, which can be added
+            # without taking on its (arbitrary) bin width.
+            if single is not None:
+                self.cover(min(other.min, single[0]), max(other.max, single[0]))
+            self.add(other.min, other.count)
+        else:
+            if self.width is None:
+                self.width = other.width
+                self.offset = other.offset
+            while self.width < other.width:
+                self.widen()
+            self.cover(other.min, other.max)
+
+            # Bin widths are both powers of two, so every bin of the other
+            # histogram falls entirely within a single bin of this one.
+            factor = int(self.width / other.width)
+            nonzero = np.flatnonzero(other.counts)
+            index = (other.offset + nonzero) // factor - self.offset
+            np.add.at(self.counts, index, other.counts[nonzero])
+        if single is not None:
+            self.add(*single)
+
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.sum += other.sum
+        self.count += other.count
+
+    @property
+    def exact(self):
+        return self.integer and self.width == 1.0
+
+    def order_statistics(self, ranks):
+        """
+        Estimate the values at the given (0-based) positions in the sorted
+        data.
+        """
+        cumulative = np.cumsum(self.counts)
+        ranks = np.asarray(ranks)
+        bins = np.searchsorted(cumulative, ranks, side='right')
+        if self.exact:
+            values = (self.offset + bins) * self.width
+        else:
+            # Assume values are spread evenly within a bin
+            before = cumulative[bins] - self.counts[bins]
+            position = (ranks - before + 0.5) / self.counts[bins]
+            values = (self.offset + bins + position) * self.width
+        return np.clip(values, self.min, self.max)
+
+    def percentiles(self, q):
+        """
+        Return the estimated percentiles q (0-100), using the same linear
+        interpolation between data points as np.percentile.
+        """
+        rank = np.asarray(q, dtype=np.float64) / 100 * (self.count - 1)
+        lower = np.floor(rank).astype(np.int64)
+        upper = np.ceil(rank).astype(np.int64)
+        lower_values = self.order_statistics(lower)
+        upper_values = self.order_statistics(upper)
+        return lower_values + (upper_values - lower_values) * (rank - lower)
+
+    def to_dict(self, q=range(0, 105, 5)):
+        if self.count == 0:
+            return {'max':None, 'min':None, 'avg':None, 'q':[], 'count':0, 'error':None}
+        return {
+            'max': self.max,
+            'min': self.min,
+            'avg': self.sum / self.count,
+            'q': self.percentiles(list(q)).tolist(),
+            'count': self.count,
+            'error': 0.0 if self.exact or self.min == self.max else self.width
+        }
+
+
+def windows(xsize, ysize, block_xsize, block_ysize, pixels):
+    """
+    Generate (xoff, yoff, xsize, ysize) windows over a band that are aligned
+    on its natural blocks. Small blocks (for example single scanlines) are
+    grouped until a window holds about `pixels` pixels.
+    """
+    cols = min(xsize, block_xsize * max(1, pixels // (block_xsize * block_ysize)))
+    rows = min(ysize, block_ysize * max(1, pixels // (cols * block_ysize)))
+    for yoff in range(0, ysize, rows):
+        for xoff in range(0, xsize, cols):
+            yield (xoff, yoff, min(cols, xsize - xoff), min(rows, ysize - yoff))
+
+
+def band_stats(band, bins=4096, pixels=1048576, approximate=False):
+    """
+    Calculate statistics of a GDAL band in a single streaming pass over its
+    blocks, so peak memory use depends on the window size instead of the
+    size of the raster.
+
+    With `approximate` the statistics are taken from the smallest overview
+    with at least `pixels` pixels (or the largest overview there is), which
+    is much faster on big rasters that have overviews.
+    """
+    nodata = band.GetNoDataValue()
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+    is_approximate = False
+
+    if approximate and band.GetOverviewCount() > 0:
+        overviews = [band.GetOverview(n) for n in range(band.GetOverviewCount())]
+        overviews.sort(key=lambda ov: ov.XSize * ov.YSize)
+        large_enough = [ov for ov in overviews if ov.XSize * ov.YSize >= pixels]
+        band = large_enough[0] if large_enough else overviews[-1]
+        is_approximate = True
+
+    stats = StreamingStats(bins=bins, integer=np.issubdtype(dtype, np.integer))
+    block_xsize, block_ysize = band.GetBlockSize()
+    for (xoff, yoff, xsize, ysize) in windows(band.XSize, band.YSize, block_xsize, block_ysize, pixels):
+        data = band.ReadAsArray(xoff, yoff, xsize, ysize)
+        valid = np.ones(data.shape, dtype=bool)
+        if nodata is not None:
+            valid &= (data != nodata)
+        if np.issubdtype(dtype, np.floating):
+            valid &= ~np.isnan(data)
+        stats.update(data[valid])
+
+    result = stats.to_dict()
+    result['approximate'] = is_approximate
+    return result
+
+
+def combine_stats(stats):
+    """
+    Combine the statistics of the same band of several files into
+    statistics of all of them. The minimum, maximum, average, and count are
+    exact, and percentiles are the count weighted average of those of the
+    files, which is an approximation.
+    """
+    stats = [s for s in stats if s and s.get('count')]
+    if not stats:
+        return {'max':None, 'min':None, 'avg':None, 'q':[], 'count':0, 'error':None}
+    count = sum(s['count'] for s in stats)
+    q = []
+    if all(len(s['q']) == len(stats[0]['q']) for s in stats):
+        q = (np.sum([np.asarray(s['q'], dtype=np.float64) * s['count'] for s in stats], axis=0) / count).tolist()
+    return {
+        'max': max(s['max'] for s in stats),
+        'min': min(s['min'] for s in stats),
+        'avg': sum(s['avg'] * s['count'] for s in stats) / count,
+        'q': q,
+        'count': count,
+        'error': None
+    }
@@ -0,0 +1,54 @@
+import json
+
+import numpy as np
+
+
+def encode_id(ids):
+    """
+    Encode an array of key ids into UTFGrid codepoints: ids are offset by
+    32, and the codepoints of '"' (34) and '\\' (92) are skipped.
+    """
+    codes = ids.astype(np.uint32) + 32
+    codes += codes >= 34
+    codes += codes >= 92
+    return codes
+
+
+def downsample(array, resolution=4):
+    """
+    Return the pixels at the centers of `resolution` x `resolution` cells
+    of a 2D array, one for every character of the grid.
+    """
+    return array[resolution//2::resolution, resolution//2::resolution]
+
+
+def encode_grid(grid, legend):
+    """
+    Encode a 2D array of palette indices as a UTFGrid. Index 0 (nodata)
+    gets the empty key, and the data of the other keys is taken from
+    `legend`.
+
+    Keys are assigned with np.unique() on the grid, and the rows are
+    decoded from a single buffer of UTF-32 codepoints.
+    """
+    values, ids = np.unique(grid, return_inverse=True)
+    ids = ids.reshape(grid.shape)
+
+    # The empty key has to be first, so it is encoded as a space
+    if values[0] != 0:
+        values = np.concatenate(([0], values))
+        ids += 1
+
+    rows, cols = grid.shape
+    text = encode_id(ids).astype('<u4').tobytes().decode('utf-32-le')
+    keys = [''] + [str(value) for value in values[1:].tolist()]
+
+    return {
+        'grid': [text[row*cols:(row+1)*cols] for row in range(rows)],
+        'keys': keys,
+        'data': {key:legend[int(key)] for key in keys[1:]}
+    }
+
+
+def dumps(grid):
+    return json.dumps(grid, separators=(',', ':')).encode()
@@ -0,0 +1,166 @@
+"""
+Pre-render the tiles of a file into the tile cache.
+
+    python3 -m mapdrop.seed path/to/file.tif --zoom 0-14 --format png --workers 4
+
+Tiles are rendered as metatiles by a pool of processes, and only the
+metatiles that intersect the extent of the file are rendered. Rendering
+options (--colormap, --mode, --ranges, --quality, --lossless) are the same as the query
+parameters of the tiles endpoint, so seeded tiles are served to requests
+with the same options.
+
+Finished metatiles are recorded in Redis, so an interrupted run picks up
+where it left off when it is started again with the same options. Use
+--restart to render everything again.
+"""
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+import mercantile
+
+from shapely.geometry import box
+from shapely.prepared import prep
+from shapely.wkt import loads
+
+from mapdrop import app, redis_store
+from mapdrop.mapdropfile import MapdropFile
+from mapdrop.mapdropfile.cache import tile_cache, tile_key
+
+# Options of the current run, set in every worker process
+options = None
+
+
+def parse_zoom(value):
+    """
+    Parse a zoom level ('5'), range ('0-14'), or list ('3,5,7').
+    """
+    zooms = []
+    for part in value.split(','):
+        start, _, end = part.partition('-')
+        zooms.extend(range(int(start), int(end or start) + 1))
+    return sorted(set(zooms))
+
+
+def metatiles(extent, z, n):
+    """
+    Generate the (z, mx, my) metatiles of n x n tiles at zoom level z that
+    intersect an extent (a shapely geometry in EPSG:4326).
+    """
+    west, south, east, north = extent.bounds
+    south = max(south, -85.051128)
+    north = min(north, 85.051128)
+    extent = prep(extent)
+
+    top_left = mercantile.tile(west, north, z)
+    bottom_right = mercantile.tile(east, south, z)
+    last = 2**z - 1
+    for mx in range(top_left.x - top_left.x % n, min(bottom_right.x, last) + 1, n):
+        for my in range(top_left.y - top_left.y % n, min(bottom_right.y, last) + 1, n):
+            ul = mercantile.bounds(mx, my, z)
+            lr = mercantile.bounds(min(mx + n - 1, last), min(my + n - 1, last), z)
+            if extent.intersects(box(ul.west, lr.south, lr.east, ul.north)):
+                yield (z, mx, my)
+
+
+def init_worker(run_options):
+    global options
+    options = run_options
+
+
+def render(metatile):
+    """
+    Render a metatile in a worker process, and return it with the number
+    of tiles in it.
+    """
+    z, mx, my = metatile
+    mf = MapdropFile(options['path'])
+    n = mf.ds.metatile_size(z, options['width'], options['height'], options['metatile'])
+    params = mf.ds.tile_params(options['format'], options['request_args'])
+    tiles = mf.ds.metatile(z, mx, my, n, options['width'], options['height'], options['format'], params)
+    return (metatile, len(tiles))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-render the tiles of a file into the tile cache.")
+    parser.add_argument('path', help="path of the file, relative to the data directory")
+    parser.add_argument('--zoom', default='0-10', help="zoom levels, for example 0-14 or 3,5,7 (default 0-10)")
+    parser.add_argument('--format', default='png', help="tile format (default png)")
+    parser.add_argument('--colormap', help="colormap option of the tiles")
+    parser.add_argument('--mode', help="mode option of the tiles")
+    parser.add_argument('--ranges', help="ranges option of the tiles")
+    parser.add_argument('--quality', help="quality option of jpeg and webp tiles")
+    parser.add_argument('--lossless', help="lossless option of webp tiles")
+    parser.add_argument('--size', type=int, default=256, help="tile size in pixels (default 256)")
+    parser.add_argument('--metatile', type=int, default=app.config.get('MAPDROP_METATILE_SIZE'), help="tiles along each side of a metatile")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument('--restart', action='store_true', help="render all tiles again, instead of resuming")
+    args = parser.parse_args()
+
+    if not tile_cache.shared:
+        raise SystemExit("Seeding needs a tile cache that is shared with the web workers, set MAPDROP_TILE_CACHE to disk or redis.")
+
+    request_args = {name:getattr(args, name) for name in ('colormap', 'mode', 'ranges', 'quality', 'lossless') if getattr(args, name) is not None}
+    run_options = {
+        'path':args.path,
+        'format':args.format.lower(),
+        'request_args':request_args,
+        'width':args.size,
+        'height':args.size,
+        'metatile':max(args.metatile, 1)
+    }
+
+    mf = MapdropFile(args.path)
+    if not mf.is_raster:
+        raise SystemExit("Only raster files can be seeded.")
+    metadata = mf.ds.create_metadata()
+    extent = loads(metadata['extent'])
+    params = mf.ds.tile_params(run_options['format'], request_args)
+
+    # Finished metatiles are recorded under a key that changes along with
+    # the file and the options, so a run only resumes an identical run.
+    progress_key = 'seed:' + tile_key(args.path, mf.ds.version, run_options, params)
+    if args.restart:
+        redis_store.delete(progress_key)
+    finished = set(member.decode() for member in redis_store.smembers(progress_key))
+
+    todo = []
+    skipped = 0
+    for z in parse_zoom(args.zoom):
+        n = mf.ds.metatile_size(z, run_options['width'], run_options['height'], run_options['metatile'])
+        for metatile in metatiles(extent, z, n):
+            if '{}/{}/{}'.format(*metatile) in finished:
+                skipped += 1
+            else:
+                todo.append(metatile)
+
+    print(" * Seeding {} metatiles of {} at zoom {} with {} workers ({} done already)".format(len(todo), args.path, args.zoom, args.workers, skipped))
+    mf.close()
+
+    started = time.monotonic()
+    reported = started
+    done = 0
+    tiles = 0
+    with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(run_options,)) as pool:
+        for metatile, count in pool.imap_unordered(render, todo, chunksize=4):
+            redis_store.sadd(progress_key, '{}/{}/{}'.format(*metatile))
+            done += 1
+            tiles += count
+            now = time.monotonic()
+            if now - reported >= 1 or done == len(todo):
+                reported = now
+                rate = tiles / (now - started)
+                remaining = (len(todo) - done) * (now - started) / done
+                sys.stderr.write("\r   {}/{} metatiles ({:.1f}%), z{}, {:.1f} tiles/sec, {:.0f}s remaining   ".format(
+                    done, len(todo), 100.0 * done / len(todo), metatile[0], rate, remaining))
+                sys.stderr.flush()
+
+    elapsed = time.monotonic() - started
+    sys.stderr.write("\n")
+    print(" * Rendered {} tiles in {:.1f}s ({:.1f} tiles/sec)".format(tiles, elapsed, tiles / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    main()
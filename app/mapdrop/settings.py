@@ -0,0 +1,148 @@
+import os
+
+# Maximum number of open GDAL dataset handles kept in the pool of each
+# worker process, and the maximum total size (in bytes) of the files behind
+# those handles. Use 0 to disable a limit.
+MAPDROP_POOL_MAX_HANDLES = int(os.environ.get('MAPDROP_POOL_MAX_HANDLES', 64))
+MAPDROP_POOL_MAX_BYTES = int(os.environ.get('MAPDROP_POOL_MAX_BYTES', 0))
+
+# Band statistics are calculated in a single pass over windows of about
+# MAPDROP_STATS_WINDOW_PIXELS pixels, with percentiles estimated from a
+# histogram of MAPDROP_STATS_BINS bins. With MAPDROP_STATS_APPROXIMATE the
+# statistics are taken from an overview when the file has them.
+MAPDROP_STATS_BINS = int(os.environ.get('MAPDROP_STATS_BINS', 4096))
+MAPDROP_STATS_WINDOW_PIXELS = int(os.environ.get('MAPDROP_STATS_WINDOW_PIXELS', 1048576))
+MAPDROP_STATS_APPROXIMATE = os.environ.get('MAPDROP_STATS_APPROXIMATE', '').lower() in ('1', 'true', 'yes')
+
+# Overviews are built in the background for new files, either as a
+# separate .ovr file ('external'), inside the file itself ('internal'), or
+# not at all ('none').
+MAPDROP_OVERVIEWS = os.environ.get('MAPDROP_OVERVIEWS', 'external')
+MAPDROP_OVERVIEW_RESAMPLING = os.environ.get('MAPDROP_OVERVIEW_RESAMPLING', 'average')
+
+# Rendered tiles are cached in memory ('memory', limited to
+# MAPDROP_TILE_CACHE_MAX_BYTES per worker), on disk ('disk', in
+# MAPDROP_TILE_CACHE_DIR, limited to MAPDROP_TILE_CACHE_DISK_MAX_BYTES),
+# in Redis ('redis'), or not at all ('none'). Tiles on disk and in Redis
+# expire after MAPDROP_TILE_CACHE_TTL seconds.
+MAPDROP_TILE_CACHE = os.environ.get('MAPDROP_TILE_CACHE', 'memory')
+MAPDROP_TILE_CACHE_MAX_BYTES = int(os.environ.get('MAPDROP_TILE_CACHE_MAX_BYTES', 64*1024*1024))
+MAPDROP_TILE_CACHE_DIR = os.environ.get('MAPDROP_TILE_CACHE_DIR', None)
+MAPDROP_TILE_CACHE_DISK_MAX_BYTES = int(os.environ.get('MAPDROP_TILE_CACHE_DISK_MAX_BYTES', 1024*1024*1024))
+MAPDROP_TILE_CACHE_TTL = int(os.environ.get('MAPDROP_TILE_CACHE_TTL', 86400))
+
+# Number of tiles along each side of a metatile. Tiles are warped in
+# blocks of MAPDROP_METATILE_SIZE x MAPDROP_METATILE_SIZE tiles, and all
+# of them are stored in the tile cache. Use 1 to render single tiles.
+MAPDROP_METATILE_SIZE = int(os.environ.get('MAPDROP_METATILE_SIZE', 4))
+
+# Largest number of pixels in a metatile, which bounds the memory used to
+# warp one. Metatiles of large tiles (for example 1024 pixel tiles, or
+# @2x tiles with a large MAPDROP_METATILE_SIZE) get fewer tiles along each
+# side, down to single tiles. The default fits 4 x 4 tiles of 512 pixels.
+MAPDROP_METATILE_MAX_PIXELS = int(os.environ.get('MAPDROP_METATILE_MAX_PIXELS', 2048*2048))
+
+# Tiles outside the extent of a file are served as a shared, pre-encoded
+# empty tile. Set MAPDROP_EMPTY_TILE_STATUS to 204 to send an empty
+# '204 No Content' response instead.
+MAPDROP_EMPTY_TILE_STATUS = int(os.environ.get('MAPDROP_EMPTY_TILE_STATUS', 200))
+
+# Largest tile size in pixels that can be requested, with @2x tile URLs or
+# the tilesize parameter.
+MAPDROP_MAX_TILE_SIZE = int(os.environ.get('MAPDROP_MAX_TILE_SIZE', 1024))
+
+# Bytes of tile buffers that every thread of a worker keeps for reuse
+# between tiles. Tiles (or metatiles) that need more get buffers of their
+# own, which are freed after use.
+MAPDROP_TILE_BUFFER_MAX_BYTES = int(os.environ.get('MAPDROP_TILE_BUFFER_MAX_BYTES', 67108864))
+
+# Uploads are streamed to disk in chunks of MAPDROP_UPLOAD_CHUNK_SIZE bytes
+MAPDROP_UPLOAD_CHUNK_SIZE = int(os.environ.get('MAPDROP_UPLOAD_CHUNK_SIZE', 1048576))
+
+# Partial files of resumable uploads that were not written to for
+# MAPDROP_UPLOAD_PARTIAL_TTL seconds are removed, and have to be started
+# over. Use 0 to keep them forever.
+MAPDROP_UPLOAD_PARTIAL_TTL = int(os.environ.get('MAPDROP_UPLOAD_PARTIAL_TTL', 86400))
+
+# Query results for batches of more than MAPDROP_QUERY_STREAM_THRESHOLD
+# geometries are streamed as newline delimited JSON.
+MAPDROP_QUERY_STREAM_THRESHOLD = int(os.environ.get('MAPDROP_QUERY_STREAM_THRESHOLD', 100))
+
+# Maximum number of points in a single sample or transect query.
+MAPDROP_QUERY_MAX_POINTS = int(os.environ.get('MAPDROP_QUERY_MAX_POINTS', 100000))
+
+# Series queries on a directory read MAPDROP_SERIES_WORKERS files at a time,
+# from a pool of threads, and cover at most MAPDROP_SERIES_MAX_FILES files.
+MAPDROP_SERIES_WORKERS = int(os.environ.get('MAPDROP_SERIES_WORKERS', 16))
+MAPDROP_SERIES_MAX_FILES = int(os.environ.get('MAPDROP_SERIES_MAX_FILES', 10000))
+
+# Metadata is kept in each worker for MAPDROP_METADATA_CACHE_TTL seconds
+# (0 to disable), so repeated requests skip Redis. The lock held while the
+# metadata of a file is created expires MAPDROP_METADATA_LOCK_TTL seconds
+# after the worker that creates it stops renewing it.
+MAPDROP_METADATA_CACHE_TTL = float(os.environ.get('MAPDROP_METADATA_CACHE_TTL', 5))
+MAPDROP_METADATA_LOCK_TTL = float(os.environ.get('MAPDROP_METADATA_LOCK_TTL', 10))
+
+# Metadata and overviews of new files are created by ingest jobs, which
+# are run by MAPDROP_JOB_THREADS threads in each web worker ('memory'), or
+# queued in Redis for separate worker processes started with
+# `python -m mapdrop.worker` ('redis'). Until a file is processed its
+# raster tiles are rendered without statistics, and other requests that
+# need its metadata get a 503 response with a Retry-After header.
+MAPDROP_JOBS = os.environ.get('MAPDROP_JOBS', 'memory')
+MAPDROP_JOB_THREADS = int(os.environ.get('MAPDROP_JOB_THREADS', 2))
+MAPDROP_JOB_RETRY_AFTER = int(os.environ.get('MAPDROP_JOB_RETRY_AFTER', 2))
+MAPDROP_WATCH_INTERVAL = float(os.environ.get('MAPDROP_WATCH_INTERVAL', 5))
+
+# Set MAPDROP_RAW_ACCEL_REDIRECT to the internal nginx location that serves
+# the data directory (for example /_raw/) to have nginx send ~/raw
+# downloads. Subsets downloaded with ~/raw?bbox= are limited to
+# MAPDROP_RAW_SUBSET_MAX_PIXELS pixels.
+MAPDROP_RAW_ACCEL_REDIRECT = os.environ.get('MAPDROP_RAW_ACCEL_REDIRECT', None)
+MAPDROP_RAW_SUBSET_MAX_PIXELS = int(os.environ.get('MAPDROP_RAW_SUBSET_MAX_PIXELS', 100000000))
+
+# Directory listings are split in pages of MAPDROP_DIRECTORY_PAGE_SIZE
+# entries (at most MAPDROP_DIRECTORY_MAX_PAGE_SIZE with the per_page
+# parameter). Each worker keeps the listings of the last
+# MAPDROP_DIRECTORY_CACHE_ENTRIES directories in memory.
+MAPDROP_DIRECTORY_PAGE_SIZE = int(os.environ.get('MAPDROP_DIRECTORY_PAGE_SIZE', 100))
+MAPDROP_DIRECTORY_MAX_PAGE_SIZE = int(os.environ.get('MAPDROP_DIRECTORY_MAX_PAGE_SIZE', 1000))
+MAPDROP_DIRECTORY_CACHE_ENTRIES = int(os.environ.get('MAPDROP_DIRECTORY_CACHE_ENTRIES', 256))
+
+# Directories are served as mosaics of their rasters. Each worker keeps the
+# spatial indexes of the last MAPDROP_MOSAIC_CACHE_ENTRIES mosaics in memory.
+MAPDROP_MOSAIC_CACHE_ENTRIES = int(os.environ.get('MAPDROP_MOSAIC_CACHE_ENTRIES', 64))
+
+# Latency histograms and cache counters are aggregated in Redis ('redis')
+# for all workers, kept in each worker ('memory'), or not at all ('none'),
+# and served on /metrics. Workers add their numbers to Redis every
+# MAPDROP_METRICS_FLUSH_INTERVAL seconds. MAPDROP_SERVER_TIMING adds a
+# Server-Timing header with the time spent in each stage to responses.
+MAPDROP_METRICS = os.environ.get('MAPDROP_METRICS', 'redis')
+MAPDROP_METRICS_FLUSH_INTERVAL = float(os.environ.get('MAPDROP_METRICS_FLUSH_INTERVAL', 1))
+MAPDROP_SERVER_TIMING = os.environ.get('MAPDROP_SERVER_TIMING', 'true').lower() in ('1', 'true', 'yes')
+
+# Set MAPDROP_PROFILE_SLOWEST to sample the stacks of requests every
+# MAPDROP_PROFILE_INTERVAL seconds, and keep the samples of that many of
+# the slowest requests on /metrics/profiles.
+MAPDROP_PROFILE_SLOWEST = int(os.environ.get('MAPDROP_PROFILE_SLOWEST', 0))
+MAPDROP_PROFILE_INTERVAL = float(os.environ.get('MAPDROP_PROFILE_INTERVAL', 0.005))
+
+# Colormapped PNG tiles are written as palette PNGs with only the colors
+# they use (set MAPDROP_PNG_PALETTE to false for RGBA PNGs), compressed
+# with zlib level MAPDROP_PNG_COMPRESS_LEVEL (0-9) and strategy
+# MAPDROP_PNG_STRATEGY (default, filtered, huffman, rle, or fixed). WebP
+# tiles are encoded with effort MAPDROP_WEBP_METHOD (0-6, slow is small).
+MAPDROP_PNG_PALETTE = os.environ.get('MAPDROP_PNG_PALETTE', 'true').lower() in ('1', 'true', 'yes')
+MAPDROP_PNG_COMPRESS_LEVEL = int(os.environ.get('MAPDROP_PNG_COMPRESS_LEVEL', 6))
+MAPDROP_PNG_STRATEGY = os.environ.get('MAPDROP_PNG_STRATEGY', 'default')
+MAPDROP_WEBP_METHOD = int(os.environ.get('MAPDROP_WEBP_METHOD', 4))
+
+# With MAPDROP_OPTIMIZE set to cog, ingest jobs write a Cloud Optimized
+# GeoTIFF copy of rasters that are not tiled and compressed already, with
+# tiles of MAPDROP_OPTIMIZE_BLOCKSIZE pixels, MAPDROP_OPTIMIZE_COMPRESS
+# compression (DEFLATE, ZSTD, LZW), and internal overviews. Tiles are then
+# read from that copy instead of from the original.
+MAPDROP_OPTIMIZE = os.environ.get('MAPDROP_OPTIMIZE', 'none')
+MAPDROP_OPTIMIZE_COMPRESS = os.environ.get('MAPDROP_OPTIMIZE_COMPRESS', 'DEFLATE')
+MAPDROP_OPTIMIZE_BLOCKSIZE = int(os.environ.get('MAPDROP_OPTIMIZE_BLOCKSIZE', 512))
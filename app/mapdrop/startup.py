@@ -0,0 +1,45 @@
+"""
+Warming up the application before gunicorn forks its workers, and resetting
+what the workers must not share afterwards. See gunicorn.conf.py.
+"""
+
+
+def warm():
+    """
+    Import the modules that requests import on first use, and compile the
+    default colormap, so workers forked from a preloaded master start with
+    them in memory (shared copy-on-write). Nothing that holds a file handle
+    or a connection (GDAL datasets, Redis, PROJ contexts) is created here.
+    """
+    import matplotlib.cm
+    import shapely.geometry
+    import shapely.ops
+    import shapely.wkt
+    import pyproj
+    import epsg_ident
+    import colour
+
+    from PIL import Image
+    Image.init()
+
+    from .mapdropfile.colormap import Colormap
+    Colormap.compile(colormap='Spectral', ranges='0.0,1.0', mode='linear')
+
+
+def after_fork():
+    """
+    Reset the state a worker inherits from the master: open GDAL datasets,
+    Redis connections, and metrics that were recorded before the fork.
+    """
+    from mapdrop import redis_store
+    from .mapdropfile import pool
+    from .mapdropfile.metrics import metrics
+
+    pool.reset()
+    # Drop the inherited connections without closing them, as the sockets
+    # are shared with the master.
+    client = getattr(redis_store, '_redis_client', None)
+    if client is not None:
+        client.connection_pool.reset()
+    if metrics is not None:
+        metrics.clear()
@@ -0,0 +1,132 @@
+"""
+Worker processes for the ingest job queue in Redis (MAPDROP_JOBS=redis).
+
+    python3 -m mapdrop.worker --processes 4 --watch
+
+Starts a pool of processes that take jobs from the queue, and restarts any
+of them that die. With --watch the data directory is polled for files that
+were added, changed, or removed by other means than an upload, and jobs are
+queued for them. Run a single instance of this command, with as many
+processes as needed: on startup it puts jobs that were in progress back on
+the queue.
+"""
+import os
+import time
+import argparse
+import multiprocessing
+
+from mapdrop import app, redis_store
+from mapdrop.mapdropfile.jobs import job_queue, job_state, run_job, enqueue, RedisJobQueue
+from mapdrop.mapdropfile.cache import invalidate
+from mapdrop.mapdropfile.directory import discard_summary
+from mapdrop.mapdropfile.optimize import remove_optimized
+
+
+def work():
+    """
+    Take jobs from the queue and run them, forever.
+    """
+    while True:
+        job = job_queue.dequeue(timeout=5)
+        if job is None:
+            continue
+        try:
+            run_job(job)
+        finally:
+            job_queue.done(job)
+
+
+class Watcher(object):
+    """
+    Polls the data directory for changes. A file is only processed once
+    its size and modification time are the same in two consecutive polls,
+    so files that are still being written are left alone.
+    """
+
+    # Files written next to the data files by Mapdrop and GDAL themselves
+    ignore = ('.ovr', '.aux.xml')
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.previous = {}
+        self.indexed = {}
+
+    def scan(self):
+        stack = ['']
+        while stack:
+            relative = stack.pop()
+            try:
+                entries = list(os.scandir(os.path.join(self.directory, relative)))
+            except OSError:
+                continue
+            for entry in entries:
+                # Hidden files hold temporary and cached data
+                if entry.name.startswith('.') or entry.name.endswith(self.ignore):
+                    continue
+                path = os.path.join(relative, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(path)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat()
+                    yield (path, (st.st_mtime_ns, st.st_size))
+
+    def poll(self):
+        current = dict(self.scan())
+        for path, signature in current.items():
+            if self.previous.get(path) != signature or self.indexed.get(path) == signature:
+                continue
+            if path not in self.indexed:
+                # Files that were processed before the watcher started, or
+                # that were uploaded and have a job already.
+                job = job_state(path)
+                if redis_store.exists(path) or (job is not None and job['state'] in ('pending', 'processing')):
+                    self.indexed[path] = signature
+                    continue
+            else:
+                redis_store.delete(path)
+                invalidate(path)
+            print(" * Queueing {}".format(path))
+            enqueue(path)
+            self.indexed[path] = signature
+
+        for path in list(self.indexed):
+            if path not in current:
+                redis_store.delete(path, path + '.job')
+                discard_summary(path)
+                remove_optimized(os.path.join(self.directory, path))
+                invalidate(path)
+                del self.indexed[path]
+        self.previous = current
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Mapdrop ingest workers.")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument('--watch', action='store_true', help="queue jobs for files that change in the data directory")
+    args = parser.parse_args()
+
+    if not isinstance(job_queue, RedisJobQueue):
+        raise SystemExit("The worker needs the Redis job queue, set MAPDROP_JOBS=redis.")
+
+    recovered = job_queue.recover()
+    if recovered:
+        print(" * Requeued {} unfinished jobs".format(recovered))
+
+    def spawn():
+        process = multiprocessing.Process(target=work, daemon=True)
+        process.start()
+        return process
+
+    processes = [spawn() for n in range(args.processes)]
+    print(" * Started {} worker processes".format(len(processes)))
+
+    watcher = Watcher(app.config.get('MAPDROP_DATA')) if args.watch else None
+    while True:
+        processes = [process if process.is_alive() else spawn() for process in processes]
+        if watcher is not None:
+            watcher.poll()
+        time.sleep(app.config.get('MAPDROP_WATCH_INTERVAL'))
+
+
+if __name__ == '__main__':
+    main()
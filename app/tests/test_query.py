@@ -0,0 +1,56 @@
+"""
+Tests of the query endpoints, run from the app directory with
+
+    python3 -m pytest tests
+
+They need GDAL and fakeredis (pip3 install -r requirements-test.txt).
+"""
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+osr = pytest.importorskip('osgeo.osr')
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture(scope='module')
+def client():
+    data = tempfile.mkdtemp()
+    os.environ['MAPDROP_DATA'] = data
+    os.environ['MAPDROP_JOBS'] = 'redis'
+    os.environ['MAPDROP_METRICS'] = 'none'
+    os.environ['MAPDROP_TILE_CACHE'] = 'memory'
+
+    ds = gdal.GetDriverByName('GTiff').Create(os.path.join(data, 'test.tif'), 64, 64, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((4.0, 0.01, 0, 52.0, 0, -0.01))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).WriteArray(np.arange(64 * 64, dtype=np.float32).reshape(64, 64))
+    ds = None
+    os.mkdir(os.path.join(data, 'series'))
+
+    from mapdrop import app, redis_store
+    redis_store._redis_client = fakeredis.FakeStrictRedis()
+    return app.test_client()
+
+
+def test_stats(client):
+    response = client.get('/test.tif~/query/stats.json?geom=POLYGON((4.1 51.9,4.2 51.9,4.2 51.8,4.1 51.8,4.1 51.9))&stats=count')
+    assert response.status_code == 200
+    assert response.get_json()['results'][0]['stats']['count'] > 0
+
+
+@pytest.mark.parametrize('format', ['json', 'ndjson'])
+def test_stats_invalid_crs(client, format):
+    response = client.get('/test.tif~/query/stats.{}?geom=POINT(4.1 51.9)&crs=bogus'.format(format))
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('format', ['ndjson', 'csv'])
+def test_series_invalid_crs(client, format):
+    response = client.get('/series/~/query/series.{}?geom=POINT(4.1 51.9)&crs=bogus'.format(format))
+    assert response.status_code == 400
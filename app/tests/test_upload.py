@@ -0,0 +1,163 @@
+"""
+Tests of receiving uploads, run from the app directory with
+
+    python3 -m pytest tests
+
+The upload module is plain Python, so it is loaded on its own and these
+tests don't need GDAL or Redis.
+"""
+import io
+import os
+import time
+import base64
+import hashlib
+import importlib.util
+
+import pytest
+
+spec = importlib.util.spec_from_file_location('upload', os.path.join(os.path.dirname(__file__), '..', 'mapdrop', 'blueprints', 'main', 'upload.py'))
+upload = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(upload)
+
+
+def digest(data):
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+def send(fullpath, data, content_range, **kwargs):
+    return upload.receive_range(io.BytesIO(data), fullpath, content_range, chunk_size=4, **kwargs)
+
+
+@pytest.fixture
+def fullpath(tmpdir):
+    return str(tmpdir.join('test.tif'))
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('bytes 0-9/20', (0, 9, 20)),
+    ('bytes 10-19/20', (10, 19, 20)),
+    ('bytes */20', (None, None, 20)),
+])
+def test_parse_content_range(value, expected):
+    assert upload.parse_content_range(value) == expected
+
+
+@pytest.mark.parametrize('value,status_code', [
+    ('bytes 0-9', 400),
+    ('items 0-9/20', 400),
+    ('bytes 9-0/20', 416),
+    ('bytes 0-20/20', 416),
+])
+def test_parse_content_range_invalid(value, status_code):
+    with pytest.raises(upload.UploadError) as e:
+        upload.parse_content_range(value)
+    assert e.value.status_code == status_code
+
+
+def test_receive(fullpath):
+    data = b'0123456789'
+    assert upload.receive(io.BytesIO(data), fullpath, content_length=10, expected_digest=digest(data), chunk_size=4) == digest(data)
+    assert open(fullpath, 'rb').read() == data
+    assert os.listdir(os.path.dirname(fullpath)) == ['test.tif']
+
+
+def test_receive_digest_mismatch(fullpath):
+    with pytest.raises(upload.UploadError) as e:
+        upload.receive(io.BytesIO(b'0123456789'), fullpath, expected_digest=digest(b'other'), chunk_size=4)
+    assert e.value.status_code == 400
+    assert os.listdir(os.path.dirname(fullpath)) == []
+
+
+def test_receive_incomplete(fullpath):
+    with pytest.raises(upload.UploadError) as e:
+        upload.receive(io.BytesIO(b'01234'), fullpath, content_length=10, chunk_size=4)
+    assert e.value.status_code == 400
+    assert os.listdir(os.path.dirname(fullpath)) == []
+
+
+def test_receive_existing(fullpath):
+    open(fullpath, 'wb').write(b'first')
+    with pytest.raises(upload.UploadError) as e:
+        upload.receive(io.BytesIO(b'second'), fullpath, chunk_size=4)
+    assert e.value.status_code == 409
+    assert open(fullpath, 'rb').read() == b'first'
+    assert os.listdir(os.path.dirname(fullpath)) == ['test.tif']
+
+
+def test_receive_range(fullpath):
+    data = b'0123456789'
+    with pytest.raises(upload.UploadError) as e:
+        send(fullpath, data[:6], 'bytes 0-5/10')
+    assert e.value.status_code == 308
+    assert e.value.headers == {'Range':'bytes=0-5'}
+
+    assert send(fullpath, data[6:], 'bytes 6-9/10', expected_digest=digest(data)) == digest(data)
+    assert open(fullpath, 'rb').read() == data
+    assert os.listdir(os.path.dirname(fullpath)) == ['test.tif']
+
+
+def test_receive_range_status(fullpath):
+    with pytest.raises(upload.UploadError) as e:
+        send(fullpath, b'', 'bytes */10')
+    assert e.value.status_code == 308
+    assert e.value.headers == {}
+    assert os.listdir(os.path.dirname(fullpath)) == []
+
+    with pytest.raises(upload.UploadError):
+        send(fullpath, b'0123', 'bytes 0-3/10')
+    with pytest.raises(upload.UploadError) as e:
+        send(fullpath, b'', 'bytes */10')
+    assert e.value.status_code == 308
+    assert e.value.headers == {'Range':'bytes=0-3'}
+
+
+def test_receive_range_out_of_order(fullpath):
+    with pytest.raises(upload.UploadError) as e:
+        send(fullpath, b'4567', 'bytes 4-7/10')
+    assert e.value.status_code == 416
+    assert e.value.headers == {}
+
+    with pytest.raises(upload.UploadError):
+        send(fullpath, b'0123', 'bytes 0-3/10')
+    with pytest.raises(upload.UploadError) as e:
+        send(fullpath, b'6789', 'bytes 6-9/10')
+    assert e.value.status_code == 416
+    assert e.value.headers == {'Range':'bytes=0-3'}
+
+
+def test_receive_range_restart(fullpath):
+    with pytest.raises(upload.UploadError):
+        send(fullpath, b'abcd', 'bytes 0-3/10')
+    with pytest.raises(upload.UploadError) as e:
+        send(fullpath, b'01', 'bytes 0-1/10')
+    assert e.value.headers == {'Range':'bytes=0-1'}
+
+    # An upload of another size starts over as well, and never continues
+    # the upload that was in progress.
+    with pytest.raises(upload.UploadError) as e:
+        send(fullpath, b'23', 'bytes 2-3/12')
+    assert e.value.status_code == 416
+    data = b'0123456789ab'
+    assert send(fullpath, data, 'bytes 0-11/12') == digest(data)
+    assert open(fullpath, 'rb').read() == data
+    assert os.listdir(os.path.dirname(fullpath)) == ['test.tif']
+
+
+def test_receive_range_digest_mismatch(fullpath):
+    with pytest.raises(upload.UploadError) as e:
+        send(fullpath, b'0123456789', 'bytes 0-9/10', expected_digest=digest(b'other'))
+    assert e.value.status_code == 400
+    assert os.listdir(os.path.dirname(fullpath)) == []
+
+
+def test_receive_range_expired(fullpath):
+    with pytest.raises(upload.UploadError):
+        send(fullpath, b'0123', 'bytes 0-3/10')
+    partfilename = os.path.join(os.path.dirname(fullpath), '.test.tif.upload.10')
+    os.utime(partfilename, (time.time() - 120, time.time() - 120))
+
+    with pytest.raises(upload.UploadError) as e:
+        send(fullpath, b'4567', 'bytes 4-7/10', ttl=60)
+    assert e.value.status_code == 416
+    assert e.value.headers == {}
+    assert os.listdir(os.path.dirname(fullpath)) == []